@@ -0,0 +1,179 @@
+import os
+import json
+import random
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, NamedTuple, AsyncIterator, Callable
+from providers import cacheable_system_prompt
+
+
+class BatchRequest(NamedTuple):
+    """One chat completion request inside a batch"""
+    custom_id: str
+    messages: List[Dict[str, str]]
+    model: str
+    max_tokens: int
+    temperature: float = 0
+    system: Optional[str] = None
+
+
+class BatchResult(NamedTuple):
+    """The outcome of one request of an ended batch: text on success, error otherwise"""
+    custom_id: str
+    text: Optional[str]
+    error: Optional[str]
+
+
+class BatchClient(ABC):
+    """
+    Minimal interface to a provider's batch API, so enrichment can run against the
+    Anthropic Message Batches API or against a local fake for offline testing.
+    """
+
+    @abstractmethod
+    async def create(self, requests: List[BatchRequest]) -> str:
+        """Submit requests as one batch and return its ID"""
+
+    @abstractmethod
+    async def is_ended(self, batch_id: str) -> bool:
+        """Whether the batch has finished processing (successfully or not)"""
+
+    @abstractmethod
+    def results(self, batch_id: str) -> AsyncIterator[BatchResult]:
+        """Iterate over the results of an ended batch"""
+
+
+class AnthropicBatchClient(BatchClient):
+    """BatchClient backed by the Anthropic Message Batches API"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _params(request: BatchRequest) -> dict:
+        params = {
+            "model": request.model,
+            "max_tokens": request.max_tokens,
+            "temperature": request.temperature,
+            "messages": request.messages,
+        }
+        if request.system:
+            params["system"] = cacheable_system_prompt(request.system)
+        return params
+
+    async def create(self, requests: List[BatchRequest]) -> str:
+        batch = await self.client.messages.batches.create(requests=[
+            {"custom_id": request.custom_id, "params": self._params(request)}
+            for request in requests
+        ])
+        return batch.id
+
+    async def is_ended(self, batch_id: str) -> bool:
+        batch = await self.client.messages.batches.retrieve(batch_id)
+        return batch.processing_status == "ended"
+
+    async def results(self, batch_id: str) -> AsyncIterator[BatchResult]:
+        async for entry in await self.client.messages.batches.results(batch_id):
+            result = entry.result
+            if result.type == "succeeded":
+                yield BatchResult(entry.custom_id, result.message.content[0].text, None)
+            elif result.type == "errored":
+                yield BatchResult(entry.custom_id, None, str(result.error))
+            else:  # canceled or expired
+                yield BatchResult(entry.custom_id, None, result.type)
+
+
+def placeholder_response(request: BatchRequest) -> str:
+    """A response that parses as a no-code file summary"""
+    prompt_chars = sum(len(message['content']) for message in request.messages)
+    return f"<file-summary>Placeholder summary of a {prompt_chars}-character prompt.</file-summary>"
+
+
+class FakeBatchClient(BatchClient):
+    """
+    Local stand-in for a batch API, to run the batch path offline. Each request is
+    answered by `respond` when the batch is created, except for `error_ratio` of them
+    which fail, and the batch ends once it has been polled `polls_to_end` times. With a
+    path, batches are kept in a JSON file, so an interrupted run can resume polling them.
+    """
+
+    def __init__(self, path: Optional[str] = None, polls_to_end: int = 1, error_ratio: float = 0.0,
+                 respond: Callable[[BatchRequest], str] = placeholder_response, seed: int = 0):
+        self.path = path
+        self.polls_to_end = polls_to_end
+        self.error_ratio = error_ratio
+        self.respond = respond
+        self.rng = random.Random(seed)
+        self.batches: Dict[str, dict] = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.batches = json.load(f)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.batches, f)
+        os.replace(tmp_path, self.path)
+
+    async def create(self, requests: List[BatchRequest]) -> str:
+        batch_id = f"fake_batch_{len(self.batches) + 1}"
+        results = []
+        for request in requests:
+            if self.rng.random() < self.error_ratio:
+                results.append([request.custom_id, None, 'fake error'])
+            else:
+                results.append([request.custom_id, self.respond(request), None])
+        self.batches[batch_id] = {'polls': 0, 'results': results}
+        self.save()
+        return batch_id
+
+    async def is_ended(self, batch_id: str) -> bool:
+        batch = self.batches[batch_id]
+        batch['polls'] += 1
+        self.save()
+        return batch['polls'] >= self.polls_to_end
+
+    async def results(self, batch_id: str) -> AsyncIterator[BatchResult]:
+        for custom_id, text, error in self.batches[batch_id]['results']:
+            yield BatchResult(custom_id, text, error)
+
+
+class BatchState:
+    """
+    Batches submitted by this run and the files they cover, persisted as JSON after
+    every change so that an interrupted run resumes polling instead of resubmitting.
+
+    Layout: {"batches": {batch_id: {"collected": bool,
+                                    "requests": {custom_id: {"path": ..., "key": ...}}}}}
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.batches: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.batches = json.load(f)['batches']
+
+    def save(self) -> None:
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'batches': self.batches}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def add_batch(self, batch_id: str, requests: Dict[str, dict]) -> None:
+        self.batches[batch_id] = {'collected': False, 'requests': requests}
+        self.save()
+
+    def mark_collected(self, batch_id: str) -> None:
+        self.batches[batch_id]['collected'] = True
+        self.save()
+
+    def pending_batch_ids(self) -> List[str]:
+        return [batch_id for batch_id, batch in self.batches.items() if not batch['collected']]
+
+    def pending_paths(self) -> set:
+        """Relative paths of files that are in a submitted batch not collected yet"""
+        return {request['path']
+                for batch_id in self.pending_batch_ids()
+                for request in self.batches[batch_id]['requests'].values()}
@@ -0,0 +1,360 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Any
+from utils import log, RateLimiter, load_encoding, DEFAULT_ENCODING_NAME
+from providers import MockProvider, Router, Route, DEFAULT_MODEL, DEFAULT_MAX_TOKENS
+from generate_xml_filetree import generate_xml_tree
+from get_input_tokens_info import traverse_xml, count_file_tokens
+from enrich_filetree import process_filetree, write_enriched_filetree
+from summary_store import SummaryStore, SUMMARY_STORE_FILENAME
+from run_journal import RunJournal, RUN_JOURNAL_FILENAME
+from telemetry import Telemetry
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Shape of the synthetic repository: directories nest `depth` levels below the root with
+# `fan_out` subdirectories each, every directory holds `files_per_dir` files, file sizes
+# follow a log-normal distribution around `median_file_bytes`, `binary_ratio` of the
+# files are binary and `gitignore_ratio` of the directories have their own .gitignore
+DEFAULT_SHAPE = {
+    'depth': 3,
+    'fan_out': 4,
+    'files_per_dir': 8,
+    'median_file_bytes': 2048,
+    'size_sigma': 1.2,
+    'max_file_bytes': 512 * 1024,
+    'binary_ratio': 0.1,
+    'gitignore_ratio': 0.3,
+    'seed': 0,
+}
+
+# Mock provider: each request takes latency ± jitter seconds, and rate_limit_ratio of
+# requests are answered with a 429 asking to retry after retry_after seconds
+DEFAULT_PROVIDER = {
+    'latency': 0.05,
+    'jitter': 0.02,
+    'rate_limit_ratio': 0.02,
+    'retry_after': 0.05,
+    'output_tokens': 200,
+}
+
+STAGES = ('startup', 'scan', 'stats', 'enrich')
+DEFAULT_SEMAPHORE_SIZE = 32
+DEFAULT_TOLERANCE = 0.10
+
+# Offline tools whose cold start the startup stage times, and modules they should not
+# import at startup (the provider SDKs, tiktoken and asyncio are loaded on first use)
+STARTUP_SCRIPTS = {'stats': 'get_input_tokens_info.py', 'count': 'quick_token_count.py'}
+HEAVY_MODULES = ('anthropic', 'httpx', 'tiktoken', 'asyncio')
+STARTUP_RUNS = 5
+
+TEXT_EXTENSIONS = ('.py', '.md', '.txt', '.json', '.js')
+BINARY_EXTENSIONS = ('.bin', '.dat')
+# Written to each .gitignore, with matching entries created next to it
+IGNORED_FILE = 'debug.log'
+IGNORED_DIR = 'build'
+WORDS = ('def', 'return', 'value', 'self', 'import', 'class', 'for', 'in', 'if', 'data', 'result', 'items')
+
+
+def random_text(rng: random.Random, size: int) -> str:
+    """Source-like text of about size bytes"""
+    lines = []
+    length = 0
+    while length < size:
+        indent = '    ' * rng.randint(0, 2)
+        line = indent + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 10)))
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+
+def generate_synthetic_repo(root: str, shape: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Create a repository of the given shape under root (same shape and seed, same repo).
+    Returns the number of directories, files, ignored entries and bytes written.
+    """
+    rng = random.Random(shape['seed'])
+    counts = {'directories': 0, 'files': 0, 'ignored': 0, 'bytes': 0}
+    stack = [(root, 0)]
+    while stack:
+        dir_path, level = stack.pop()
+        os.makedirs(dir_path, exist_ok=True)
+        counts['directories'] += 1
+        for i in range(shape['files_per_dir']):
+            size = min(shape['max_file_bytes'], int(rng.lognormvariate(0, shape['size_sigma'])
+                                                    * shape['median_file_bytes']))
+            if rng.random() < shape['binary_ratio']:
+                path = os.path.join(dir_path, f"blob_{i}{rng.choice(BINARY_EXTENSIONS)}")
+                with open(path, 'wb') as f:
+                    f.write(b'\x00' + rng.randbytes(size))
+                counts['bytes'] += size + 1
+            else:
+                path = os.path.join(dir_path, f"file_{i}{rng.choice(TEXT_EXTENSIONS)}")
+                with open(path, 'w', encoding='utf-8') as f:
+                    counts['bytes'] += f.write(random_text(rng, size))
+            counts['files'] += 1
+        if rng.random() < shape['gitignore_ratio']:
+            with open(os.path.join(dir_path, '.gitignore'), 'w', encoding='utf-8') as f:
+                f.write(f"*.log\n{IGNORED_DIR}/\n")
+            with open(os.path.join(dir_path, IGNORED_FILE), 'w', encoding='utf-8') as f:
+                f.write(random_text(rng, 256))
+            os.makedirs(os.path.join(dir_path, IGNORED_DIR), exist_ok=True)
+            with open(os.path.join(dir_path, IGNORED_DIR, 'output.txt'), 'w', encoding='utf-8') as f:
+                f.write(random_text(rng, 256))
+            counts['ignored'] += 2
+        if level < shape['depth']:
+            for i in range(shape['fan_out']):
+                stack.append((os.path.join(dir_path, f"dir_{level}_{i}"), level + 1))
+    return counts
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process so far, in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # Bytes on macOS, KB elsewhere
+
+
+def benchmark_startup(repo_dir: str, work_dir: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Time the cold start of the offline tools, `--help` in a fresh interpreter without
+    ANTHROPIC_API_KEY (best of STARTUP_RUNS), and list the heavy modules they import
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env = {name: value for name, value in os.environ.items() if name != 'ANTHROPIC_API_KEY'}
+    results = {}
+    for name, script in STARTUP_SCRIPTS.items():
+        runs = []
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script, '--help'], cwd=package_dir, env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+            runs.append(time.perf_counter() - start)
+        check = (f"import sys, {os.path.splitext(script)[0]}; "
+                 f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+        loaded = subprocess.run([sys.executable, '-c', check], cwd=package_dir, env=env, check=True,
+                                capture_output=True, text=True).stdout.split()
+        if loaded:
+            log.warning(f"{script} imports {', '.join(loaded)} at startup")
+        results[f'{name}_startup_seconds'] = min(runs)
+        results[f'{name}_heavy_imports'] = ','.join(loaded) or 'none'
+    results['seconds'] = sum(results[f'{name}_startup_seconds'] for name in STARTUP_SCRIPTS)
+    return results
+
+
+def benchmark_scan(repo_dir: str, work_dir: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Time generate_xml_tree over the repository, without the sniff cache"""
+    filetree_path = os.path.join(work_dir, 'filetree.xml')
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):  # Keep stdout for the results
+        generate_xml_tree(repo_dir, output_filepath=filetree_path, output_overwrite=True,
+                          workers=options['workers'], sniff_cache_path=None)
+    seconds = time.perf_counter() - start
+    entries = sum(1 for element in ET.parse(filetree_path).iter() if element.tag in ('file', 'directory'))
+    return {'entries': entries, 'seconds': seconds, 'entries_per_sec': entries / seconds,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def benchmark_stats(repo_dir: str, work_dir: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Time traverse_xml and count_file_tokens over the scanned filetree, without the token cache"""
+    ft_root = ET.parse(os.path.join(work_dir, 'filetree.xml')).getroot()
+    encoding = load_encoding(options['encoding'])  # Loaded before timing starts
+    start = time.perf_counter()
+    stats = {'total_files': 0, 'total_directories': 0, 'file_types': {}}
+    file_paths = []
+    traverse_xml(ft_root, repo_dir, stats, {'dir_items_threshold': float('inf')}, file_paths)
+    counts = count_file_tokens(file_paths, encoding, options['jobs'])
+    seconds = time.perf_counter() - start
+    tokens = sum(count for count in counts if count is not None)
+    return {'files': len(file_paths), 'tokens': tokens, 'seconds': seconds,
+            'files_per_sec': len(file_paths) / seconds, 'tokens_per_sec': tokens / seconds,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def benchmark_enrich(repo_dir: str, work_dir: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Time process_filetree (file and directory summaries) against the mock provider,
+    then write_enriched_filetree, starting from an empty summary store. Runs from the
+    package directory, where the prompt paths are relative to, and fails if no request
+    was sent or any summary failed.
+    """
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # The stage has a process of its own
+    router = Router({'mock': MockProvider(seed=options['seed'], **options['provider'])},
+                    [Route('default', 'mock', DEFAULT_MODEL, DEFAULT_MAX_TOKENS)])
+    ft_root = ET.parse(os.path.join(work_dir, 'filetree.xml')).getroot()
+    store_path = os.path.join(work_dir, SUMMARY_STORE_FILENAME)
+    if os.path.exists(store_path):
+        os.remove(store_path)
+    store = SummaryStore(store_path)
+    journal_path = os.path.join(work_dir, RUN_JOURNAL_FILENAME)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = RunJournal(journal_path)
+    journal.start_run()
+    semaphore_size = options['semaphore_size']
+    rate_limiter = RateLimiter(max_concurrency=semaphore_size)
+    telemetry = Telemetry()
+
+    async def enrich() -> None:
+        try:
+            await process_filetree(ft_root, repo_dir, repo_dir, store, os.path.basename(repo_dir), True,
+                                   asyncio.Semaphore(semaphore_size), None, semaphore_size,
+                                   telemetry=telemetry, rate_limiter=rate_limiter, directory_summaries=True,
+                                   journal=journal, router=router)
+        finally:
+            await router.close()
+
+    start = time.perf_counter()
+    asyncio.run(enrich())
+    seconds = time.perf_counter() - start
+    assembly_start = time.perf_counter()
+    write_enriched_filetree(os.path.join(work_dir, 'enriched_filetree.xml'), ft_root, repo_dir, store)
+    assembly_seconds = time.perf_counter() - assembly_start
+    summaries = len(store)  # The store started empty, so it holds the successful summaries alone
+    store.close()
+    failed = journal.failed()
+    journal.close()
+    if rate_limiter.stats['requests'] == 0 or failed:
+        raise RuntimeError(f"Enrich stage sent {rate_limiter.stats['requests']} requests and "
+                           f"{len(failed)} summaries failed (see {journal_path})")
+
+    api = telemetry.span_stats().get('api', {})
+    return {'summaries': summaries, 'requests': rate_limiter.stats['requests'],
+            'rate_limited': rate_limiter.stats['rate_limited'], 'seconds': seconds,
+            'summaries_per_sec': summaries / seconds,
+            'output_tokens_per_sec': telemetry.usage['output_tokens'] / seconds,
+            'api_p50_seconds': api.get('p50'), 'api_p95_seconds': api.get('p95'),
+            'assembly_seconds': assembly_seconds, 'peak_rss_mb': peak_rss_mb()}
+
+
+BENCHMARKS = {'startup': benchmark_startup, 'scan': benchmark_scan, 'stats': benchmark_stats, 'enrich': benchmark_enrich}
+
+
+def run_stage(stage: str, repo_dir: str, work_dir: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one benchmark in a fresh process, so peak RSS covers that stage alone"""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(BENCHMARKS[stage], repo_dir, work_dir, options).result()
+
+
+def is_better(metric: str, value: float, baseline: float) -> Optional[bool]:
+    """Whether value improves on baseline (None for metrics that are counts, not performance)"""
+    if metric.endswith('_per_sec'):
+        return value > baseline
+    if metric.endswith('_seconds') or metric in ('seconds', 'peak_rss_mb'):
+        return value < baseline
+    return None
+
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Print each performance metric next to its baseline and return the ones that regressed beyond tolerance"""
+    if results['shape'] != baseline.get('shape') or results['provider'] != baseline.get('provider'):
+        log.warning("The baseline was measured with a different repo shape or provider; comparisons are rough")
+    regressions = []
+    print("\n=== Comparison to baseline ===")
+    for stage, metrics in results['stages'].items():
+        baseline_metrics = baseline.get('stages', {}).get(stage, {})
+        for metric, value in metrics.items():
+            base = baseline_metrics.get(metric)
+            if value is None or not base or is_better(metric, value, base) is None:
+                continue
+            change = value / base - 1
+            worse = not is_better(metric, value, base) and abs(change) > tolerance
+            if worse:
+                regressions.append(f"{stage}.{metric}")
+            print(f"{stage}.{metric}: {value:.4g} (baseline {base:.4g}, {change:+.1%})"
+                  + ("  REGRESSION" if worse else ""))
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark tool startup, the scanner, token counting and enrichment on a synthetic repository '
+                    'with a mock LLM provider.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='Stages to run, in order; stats and enrich use the filetree from scan (default: all)')
+    for name, value in DEFAULT_SHAPE.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value,
+                            help=f'Repository shape: {name} (default: {value})')
+    for name, value in DEFAULT_PROVIDER.items():
+        parser.add_argument(f"--mock-{name.replace('_', '-')}", dest=f'mock_{name}', type=type(value), default=value,
+                            help=f'Mock provider: {name} (default: {value})')
+    parser.add_argument('--repo-dir',
+                        help='Generate the repository here and keep it (default: a temporary directory)')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Scanner threads (default: the ThreadPoolExecutor default)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Token counting threads (default: all CPUs)')
+    parser.add_argument('--encoding-name', default=DEFAULT_ENCODING_NAME,
+                        help=f'tiktoken encoding for token counting (default: {DEFAULT_ENCODING_NAME})')
+    parser.add_argument('-s', '--semaphore-size', type=int, default=DEFAULT_SEMAPHORE_SIZE,
+                        help=f'Concurrent enrichment requests (default: {DEFAULT_SEMAPHORE_SIZE})')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Runs of each stage; the fastest is kept (default: 1)')
+    parser.add_argument('-o', '--output',
+                        help='Write the results as JSON to this file (use it as a baseline later)')
+    parser.add_argument('--baseline',
+                        help='Results file to compare against; exits with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'Relative slowdown tolerated before a metric counts as a regression '
+                             f'(default: {DEFAULT_TOLERANCE})')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.repeat < 1:
+        raise ValueError("Repeat must be at least 1")
+    shape = {name: getattr(args, name) for name in DEFAULT_SHAPE}
+    provider = {name: getattr(args, f'mock_{name}') for name in DEFAULT_PROVIDER}
+    options = {'workers': args.workers, 'jobs': args.jobs, 'encoding': args.encoding_name,
+               'semaphore_size': args.semaphore_size, 'provider': provider, 'seed': shape['seed']}
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir:
+        repo_dir = os.path.abspath(args.repo_dir) if args.repo_dir else os.path.join(work_dir, 'repo')
+        repo = generate_synthetic_repo(repo_dir, shape)
+        log.info(f"Synthetic repository: {repo['directories']} directories, {repo['files']} files, "
+                 f"{repo['bytes'] / 1e6:.1f} MB")
+        stages = [stage for stage in STAGES if stage in args.stages]
+        if 'scan' not in stages and {'stats', 'enrich'} & set(stages):
+            stages.insert(stages.index('stats' if 'stats' in stages else 'enrich'), 'scan')
+            log.info("Also running scan, which the stats and enrich stages need")
+
+        results = {'shape': shape, 'provider': provider, 'repo': repo, 'stages': {}}
+        for stage in stages:
+            runs = [run_stage(stage, repo_dir, work_dir, options) for _ in range(args.repeat)]
+            best = min(runs, key=lambda run: run['seconds'])
+            results['stages'][stage] = best
+            log.info(f"{stage}: " + ', '.join(f"{metric}={value:.4g}" if isinstance(value, float)
+                                               else f"{metric}={value}" for metric, value in best.items()))
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
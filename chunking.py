@@ -0,0 +1,82 @@
+import re
+from typing import List, Tuple, Callable, NamedTuple
+
+# Lines that start a top-level definition (no indentation) in common languages
+TOP_LEVEL_DEFINITION = re.compile(
+    r'^(?:export\s+)?(?:default\s+)?(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?(?:unsafe\s+)?'
+    r'(?:def|class|function|fn|func|impl|struct|enum|trait|interface|type|mod|module|namespace)\b'
+)
+# Lines directly above a definition that belong to it (decorators and comments)
+DEFINITION_PREAMBLE = re.compile(r'^(?:@|#(?!include|define|if|endif|else|pragma)|//|/\*|\*|///)')
+
+
+class Chunk(NamedTuple):
+    """A contiguous range of lines of a file: lines[start_line:end_line] (0-based, end exclusive)"""
+    start_line: int
+    end_line: int
+    text: str
+
+
+def _definition_starts(lines: List[str]) -> List[int]:
+    """Indices where top-level units begin, moving each boundary above its decorators/comments"""
+    starts = [0]
+    for index, line in enumerate(lines):
+        if index == 0 or not TOP_LEVEL_DEFINITION.match(line):
+            continue
+        start = index
+        while start > starts[-1] + 1 and DEFINITION_PREAMBLE.match(lines[start - 1]):
+            start -= 1
+        if start > starts[-1]:
+            starts.append(start)
+    return starts
+
+
+def _blank_line_starts(lines: List[str], start: int, end: int) -> List[int]:
+    """Indices where paragraphs (runs of lines after a blank line) begin within [start, end)"""
+    starts = [start]
+    for index in range(start + 1, end):
+        if not lines[index - 1].strip() and lines[index].strip():
+            starts.append(index)
+    return starts
+
+
+def _pack(pieces: List[Tuple[int, int, int]], max_tokens: int) -> List[Tuple[int, int, int]]:
+    """Greedily merge consecutive (start, end, tokens) pieces while they fit in max_tokens"""
+    packed: List[Tuple[int, int, int]] = []
+    for start, end, tokens in pieces:
+        if packed and packed[-1][2] + tokens <= max_tokens:
+            packed[-1] = (packed[-1][0], end, packed[-1][2] + tokens)
+        else:
+            packed.append((start, end, tokens))
+    return packed
+
+
+def _split_range(lines: List[str], starts: List[int], end: int, max_tokens: int,
+                 count_tokens: Callable[[str], int], fallbacks: List[Callable]) -> List[Tuple[int, int, int]]:
+    """Split lines[starts[0]:end] at the given starts, recursing into pieces that are too large"""
+    pieces = []
+    bounds = starts + [end]
+    for piece_start, piece_end in zip(bounds, bounds[1:]):
+        tokens = count_tokens(''.join(lines[piece_start:piece_end]))
+        if tokens <= max_tokens or piece_end - piece_start == 1 or not fallbacks:
+            pieces.append((piece_start, piece_end, tokens))
+            continue
+        sub_starts = fallbacks[0](lines, piece_start, piece_end)
+        pieces.extend(_split_range(lines, sub_starts, piece_end, max_tokens, count_tokens, fallbacks[1:]))
+    return pieces
+
+
+def split_into_chunks(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[Chunk]:
+    """
+    Split text into chunks of at most max_tokens (by count_tokens), cutting on
+    syntactic boundaries where possible: first before top-level definitions (with
+    their decorators and comments), then at blank lines inside definitions that are
+    too large, and finally between lines. A single line longer than max_tokens
+    becomes its own chunk.
+    """
+    lines = text.splitlines(keepends=True)
+    if not lines:
+        return [Chunk(0, 0, text)]
+    fallbacks = [_blank_line_starts, lambda lines, start, end: list(range(start, end))]
+    pieces = _split_range(lines, _definition_starts(lines), len(lines), max_tokens, count_tokens, fallbacks)
+    return [Chunk(start, end, ''.join(lines[start:end])) for start, end, _ in _pack(pieces, max_tokens)]
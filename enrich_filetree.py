@@ -1,168 +1,1407 @@
 import os
+import re
 import xml.etree.ElementTree as ET
 import argparse
+import time
 import asyncio
-import tiktoken
+import hashlib
+import itertools
+import socket
+from typing import Optional, List, Dict, Callable, NamedTuple, Tuple, Union
 from utils import (
     request_chat_completion, 
     extract_xml, 
+    find_xml,
     read_file_to_text, 
-    replace_placeholders,
-    log
+    load_prompt_template,
+    PromptTemplate,
+    log,
+    RateLimiter,
+    is_transient_error,
+    estimate_tokens,
+    IncrementalTokenCounter,
+    get_tiktoken_encoding,
+    escape_xml_text,
+    escape_xml_attrib,
+    xml_start_tag
 )
+from providers import Route, Router, AnthropicProvider, default_router, build_router, load_router, DEFAULT_MODEL
+from chunking import split_into_chunks, Chunk
+from summary_cache import SummaryCache, DEFAULT_SUMMARY_CACHE_PATH
+from summary_store import SummaryStore, SUMMARY_STORE_FILENAME, FILE_SUMMARY, DIRECTORY_SUMMARY, relative_path
+from token_cache import TokenCountCache
+from batches import BatchClient, AnthropicBatchClient, FakeBatchClient, BatchRequest, BatchState
+from work_queue import WorkQueue, QueueJob, WORK_QUEUE_FILENAME, FAILED
+from telemetry import Telemetry, METRICS_FORMATS, timed
+from run_journal import RunJournal, RUN_JOURNAL_FILENAME, RUN_RETRY_FAILED, IN_FLIGHT, DONE, FAILED
 
 DEFAULT_SEMAPHORE_SIZE = 10
+SUMMARIZE_FILE_PROMPT_PATH = 'inputs/prompts/summarize_file.md'
+REDUCE_FILE_SUMMARIES_PROMPT_PATH = 'inputs/prompts/reduce_file_summaries.md'
+SUMMARIZE_DIRECTORY_PROMPT_PATH = 'inputs/prompts/summarize_directory.md'
+SUMMARIZE_FILES_PROMPT_PATH = 'inputs/prompts/summarize_files.md'
 
-def create_mirrored_repo_structure(source_dir: str, mirror_base: str) -> None:
-    for root, _, _ in os.walk(source_dir):
-        # Calculate relative path from source_dir
-        rel_path = os.path.relpath(root, source_dir)
-        mirror_path = os.path.join(mirror_base, rel_path)
-        
-        # Create the directory in mirror location
-        os.makedirs(mirror_path, exist_ok=True)
+# When exported to the mirror layout, directory summaries are saved inside the directory's mirror
+DIRECTORY_SUMMARY_FILENAME = '.directory-summary.xml'
+# Token cap on the {{FILETREE_BRANCH}} sent for one directory
+DEFAULT_DIRECTORY_BRANCH_TOKENS = 16_000
 
+# Attribute on the root of each exported summary file recording the summary cache key it was made from
+SUMMARY_KEY_ATTRIBUTE = 'content-key'
 
-def get_mirror_path(original_path: str, root_dir: str, mirror_base: str) -> str:
-    """Get the corresponding path in the mirror structure"""
-    rel_path = os.path.relpath(original_path, root_dir)
-    return os.path.join(mirror_base, rel_path)
+# Rough bytes-per-token ratio, used to rank files before they are read
+BYTES_PER_TOKEN_ESTIMATE = 4
 
 
-def summary_exists(mirror_path: str) -> bool:
-    """Check if a summary file already exists"""
-    return os.path.exists(mirror_path)
+class FileJob(NamedTuple):
+    """A file to summarize, as flattened out of the filetree"""
+    file_element: ET.Element
+    current_dir: str
+    estimated_tokens: int
+
+
+class FilePack(NamedTuple):
+    """Small files on the same route, summarized together in one request"""
+    files: List[FileJob]
+    route: Route
+    estimated_tokens: int
+
+
+class PackedFile(NamedTuple):
+    """A member of a pack that needs a new summary, with its contents"""
+    job: FileJob
+    filepath: str
+    rel_path: str
+    text: str
+    key: Optional[str]
+
+
+class FileText(NamedTuple):
+    """The contents of a file read ahead of summarization, with its token count if known"""
+    text: str
+    tokens: Optional[int] = None
+
+
+class DirectoryJob(NamedTuple):
+    """A directory to summarize once all of its children are done"""
+    dir_element: ET.Element
+    dir_path: str
+    parent_path: Optional[str]
+
+
+# Ordering policies for the work queue: each maps a job to a sort key (lowest goes first).
+# Sorting is stable, so ties keep filetree order.
+ORDERING_POLICIES: Dict[str, Callable[[Union[FileJob, FilePack]], int]] = {
+    'tree': lambda job: 0,
+    'largest-first': lambda job: -job.estimated_tokens,  # Keeps long files from becoming the tail
+    'smallest-first': lambda job: job.estimated_tokens,
+}
+DEFAULT_ORDERING_POLICY = 'largest-first'
+
+# Files estimated above 'threshold' tokens are split into chunks of at most 'chunk_tokens'
+# tokens, summarized separately and merged (keeps long files within the output budget)
+DEFAULT_CHUNKING = {'threshold': 24_000, 'chunk_tokens': 12_000}
+# Files estimated at or below 'max_file_tokens' tokens are packed together, up to 'pack_tokens'
+# tokens and 'max_files' files per request, and no more files than the route's max_tokens
+# leaves 'file_output_tokens' of output for (keeps each response within the output budget)
+DEFAULT_PACKING = {'max_file_tokens': 1_000, 'pack_tokens': 8_000, 'max_files': 10, 'file_output_tokens': 800}
+# A file section of a packed response
+PACKED_FILE_PATTERN = re.compile(r'<file\b[^>]*\bpath="([^"]*)"[^>]*>(.*?)</file>', re.DOTALL)
+# Sections of a code summary whose entries are concatenated across chunks, in file order
+MERGED_SUMMARY_SECTIONS = ('declarations', 'dependencies', 'function-defs')
+
+# Batch mode: state file in the output directory, and limits per submitted batch
+BATCH_STATE_FILENAME = 'batches.json'
+# Batches of the local fake batch client (--fake-batch), in the output directory
+FAKE_BATCHES_FILENAME = 'fake_batches.json'
+DEFAULT_BATCH_SIZE = 10_000
+MAX_BATCH_BYTES = 200 * 1024 * 1024  # The API accepts up to 256 MB per batch
+DEFAULT_POLL_INTERVAL = 30.0
+MAX_POLL_INTERVAL = 300.0
+
+# Shared work queue: leases not renewed within this many seconds are handed to another
+# worker (heartbeats renew them every third of that), and idle workers check back this often
+DEFAULT_LEASE_SECONDS = 120.0
+QUEUE_POLL_INTERVAL = 2.0
+
+# Summaries that fail with a transient error (after the rate limiter's own retries) are
+# queued again after a backoff, up to this many attempts in total
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 15.0
+MAX_RETRY_DELAY = 300.0
+
+def build_summary_element(summary: str, filepath: str, telemetry: Optional[Telemetry] = None) -> ET.Element:
+    """
+    Parse the model's response into a <file> element holding the summary. Responses
+    that don't follow the response template are counted as parse failures in telemetry.
+    """
+    # Create root element for the summary
+    root = ET.Element('file')
+    
+    if "<declarations>" in summary:
+        # Code file
+        if telemetry is not None and find_xml(summary, "file") is None:
+            telemetry.count('parse_failures')
+        file_xml = extract_xml(summary, "file")
+        if file_xml.startswith("<declarations"):
+            # Wrap the content in a root element before parsing
+            wrapped_xml = f"<root>{file_xml}</root>"
+            try:
+                summary_xml = ET.fromstring(wrapped_xml)
+                for child in summary_xml:
+                    root.append(child)
+            except ET.ParseError as e:
+                log.error(f"Failed to parse code summary XML for {filepath}: {e}, saving entire output")
+                if telemetry is not None:
+                    telemetry.count('parse_failures')
+                summary_elem = ET.SubElement(root, 'summary')
+                summary_elem.text = file_xml
+    else:
+        # No-code file
+        if telemetry is not None and find_xml(summary, "file-summary") is None:
+            telemetry.count('parse_failures')
+        summary_text = extract_xml(summary, "file-summary")
+        summary_elem = ET.SubElement(root, 'file-summary')
+        summary_elem.text = summary_text
+    return root
+
+
+def save_summary(store: SummaryStore, kind: str, rel_path: str, root: ET.Element, key: Optional[str],
+                 summary_cache: Optional[SummaryCache]) -> None:
+    """Store a freshly generated summary in the cache (if any) and the summary store"""
+    summary = ET.tostring(root, encoding='unicode')
+    if summary_cache is not None:
+        summary_cache.put(key, summary)
+    store.put(kind, rel_path, summary, key)
+
+
+def take_file_text(filepath: str, preloaded: Optional[Dict[str, FileText]] = None) -> FileText:
+    """The file's preloaded contents, released from preloaded, or else its contents read now"""
+    if preloaded is not None:
+        file_text = preloaded.pop(filepath, None)
+        if file_text is not None:
+            return file_text
+    return FileText(read_file_to_text(filepath))
+
+
+def release_file_text(filepath: str, preloaded: Optional[Dict[str, FileText]] = None) -> None:
+    """Drop the preloaded contents of a file that turned out not to need summarizing"""
+    if preloaded is not None:
+        preloaded.pop(filepath, None)
+
+
+def should_summarize(file_element: ET.Element) -> bool:
+    """Files marked as ignored or not text-readable are never summarized"""
+    return not (file_element.get('ignore', '').lower() == 'true' or
+                file_element.get('text-readable', '').lower() == 'false')
+
+
+def render_file_prompt(prompt_template: PromptTemplate, filepath: str, repo_name: str,
+                       file_content: str) -> Tuple[str, str]:
+    """Return the (system, user) prompts; only the user prompt depends on the file"""
+    return prompt_template.render({
+        "{{FILEPATH}}": filepath,
+        "{{FILE_NAME}}": os.path.basename(filepath),
+        "{{REPO_NAME}}": repo_name,
+        "{{FILE_CONTENTS}}": file_content
+    })
+
+
+def use_existing_summary(description: str, store: SummaryStore, kind: str, rel_path: str,
+                         key: Optional[str], summary_cache: Optional[SummaryCache], overwrite: bool,
+                         accepted_keys: Tuple[str, ...] = ()) -> bool:
+    """
+    Return True if no request is needed for this file or directory: its summary is up
+    to date, or a cached summary of identical inputs was copied to the summary store.
+    A summary stored or cached under one of accepted_keys (made from the same file with
+    another prompt) counts as up to date too.
+    """
+    if overwrite:
+        return False
+    exists, existing_key = store.get_key(kind, rel_path)
+    if summary_cache is None:
+        # Without a cache, skip if summary already exists
+        if exists:
+            log.info(f"Summary already exists for {description}, skipping...")
+            return True
+        return False
+
+    # A summary without a key (from before the cache existed) can't be checked against
+    # the current inputs, so it is redone rather than trusted
+    if exists and (existing_key == key or existing_key in accepted_keys):
+        log.info(f"Summary is up to date for {description}, skipping...")
+        return True
+    # Accepted keys are only looked up if present, so that a miss is counted once
+    for accepted_key in accepted_keys:
+        if summary_cache.contains(accepted_key):
+            key = accepted_key
+            break
+    cached = summary_cache.get(key)
+    if cached is not None:
+        log.info(f"Using cached summary for {description}")
+        store.put(kind, rel_path, cached, key)
+        return True
+    return False
+
+
+def export_summaries(store: SummaryStore, mirror_base: str) -> int:
+    """
+    Write every summary in the store as a loose XML file in the mirror layout (one
+    file per source file, directory summaries inside their directory). Returns the
+    number of files written.
+    """
+    exported = 0
+    for kind, rel_path, summary, key in store.items():
+        base_path = os.path.join(mirror_base, *rel_path.split('/')) if rel_path else mirror_base
+        if kind == DIRECTORY_SUMMARY:
+            export_path = os.path.join(base_path, DIRECTORY_SUMMARY_FILENAME)
+        else:
+            export_path = base_path + '.xml'
+        os.makedirs(os.path.dirname(export_path), exist_ok=True)
+        root = ET.fromstring(summary)
+        if key is not None:
+            root.set(SUMMARY_KEY_ATTRIBUTE, key)
+        ET.ElementTree(root).write(export_path, encoding='utf-8', xml_declaration=False, method='xml')
+        exported += 1
+    return exported
+
+
+def import_mirror_summaries(store: SummaryStore, mirror_base: str) -> int:
+    """
+    Load loose summary files written by earlier versions (or by export_summaries) from
+    the mirror layout into the store. Returns the number of summaries imported.
+    """
+    imported = 0
+    for dirpath, _, filenames in os.walk(mirror_base):
+        for filename in filenames:
+            if not filename.endswith('.xml') or filename == 'enriched_filetree.xml':
+                continue
+            export_path = os.path.join(dirpath, filename)
+            if filename == DIRECTORY_SUMMARY_FILENAME:
+                kind, rel_path = DIRECTORY_SUMMARY, relative_path(dirpath, mirror_base)
+            else:
+                kind, rel_path = FILE_SUMMARY, relative_path(export_path[:-len('.xml')], mirror_base)
+            try:
+                root = ET.parse(export_path).getroot()
+            except ET.ParseError as e:
+                log.error(f"Failed to parse summary XML {export_path}: {e}")
+                continue
+            key = root.attrib.pop(SUMMARY_KEY_ATTRIBUTE, None)
+            store.put(kind, rel_path, ET.tostring(root, encoding='unicode'), key)
+            imported += 1
+    return imported
+
+
+def merge_summary_section(target: ET.Element, source: ET.Element) -> None:
+    """Append the text and entries of a partial summary section to target, dropping duplicates"""
+    text = (source.text or '').strip()
+    if text:
+        existing_text = (target.text or '').strip()
+        target.text = f"{existing_text}\n{text}" if existing_text else text
+    seen = {ET.tostring(child).strip() for child in target}
+    for child in source:
+        child_xml = ET.tostring(child).strip()
+        if child_xml not in seen:
+            target.append(child)
+            seen.add(child_xml)
+
+
+def merge_partial_summaries(parts: List[ET.Element]) -> Tuple[ET.Element, List[str]]:
+    """
+    Merge the summaries of a file's chunks (in file order) into one <file> element.
+    Returns the merged element, without a <file-summary>, and the partial file
+    summaries still to be reduced into one.
+    """
+    root = ET.Element('file')
+    partial_summaries = []
+    for part in parts:
+        for child in part:
+            if child.tag in MERGED_SUMMARY_SECTIONS:
+                section = root.find(child.tag)
+                if section is None:
+                    section = ET.SubElement(root, child.tag)
+                merge_summary_section(section, child)
+            elif child.tag == 'file-summary':
+                partial_summaries.append((child.text or '').strip())
+            else:
+                root.append(child)  # Unparsable partial output, kept as is
+    return root, partial_summaries
+
+
+async def reduce_file_summaries(filepath: str, repo_name: str, chunks: List[Chunk],
+                                partial_summaries: List[str], route: Route,
+                                rate_limiter: Optional[RateLimiter] = None,
+                                telemetry: Optional[Telemetry] = None,
+                                router: Optional[Router] = None) -> str:
+    """Combine the partial summaries of a file's chunks into one summary with one more request on route"""
+    sections = [f"[Part {i} of {len(chunks)}, lines {chunk.start_line + 1}-{chunk.end_line}]\n{summary}"
+                for i, (chunk, summary) in enumerate(zip(chunks, partial_summaries), start=1)
+                if summary]
+    if len(sections) <= 1:
+        return partial_summaries[0] if partial_summaries else ''
+    system, prompt = load_prompt_template(REDUCE_FILE_SUMMARIES_PROMPT_PATH).render({
+        "{{FILEPATH}}": filepath,
+        "{{FILE_NAME}}": os.path.basename(filepath),
+        "{{REPO_NAME}}": repo_name,
+        "{{NUM_PARTS}}": str(len(chunks)),
+        "{{PARTIAL_SUMMARIES}}": '\n\n'.join(sections),
+    })
+    if router is None:
+        router = default_router()
+    try:
+        response = await request_chat_completion([("user", prompt)], rate_limiter=rate_limiter,
+                                                 system=system, telemetry=telemetry,
+                                                 **router.request_options(route))
+        if telemetry is not None and find_xml(response, "file-summary") is None:
+            telemetry.count('parse_failures')
+        return extract_xml(response, "file-summary")
+    except Exception as e:
+        log.warning(f"Could not reduce partial summaries of {filepath} ({e}), concatenating them")
+        return '\n\n'.join(sections)
+
+
+async def summarize_in_chunks(filepath: str, repo_name: str, file_content: str,
+                              prompt_template: PromptTemplate, chunking: Dict[str, int], route: Route,
+                              rate_limiter: Optional[RateLimiter] = None,
+                              telemetry: Optional[Telemetry] = None,
+                              router: Optional[Router] = None) -> Optional[ET.Element]:
+    """
+    Map-reduce summary of a file too large for one request: the file is split on
+    top-level definitions (or blank lines), the chunks are summarized concurrently
+    through the same rate limiter, their sections are merged in file order and their
+    file summaries reduced into one. Every request goes to the route of the whole
+    file, whose model is the one in its cache key. Returns None if the file fits in a
+    single chunk.
+    """
+    chunks = split_into_chunks(file_content, chunking['chunk_tokens'], estimate_tokens)
+    if len(chunks) <= 1:
+        return None
+    log.info(f"Summarizing {filepath} in {len(chunks)} chunks")
+    if router is None:
+        router = default_router()
+
+    async def summarize_chunk(index: int, chunk: Chunk) -> ET.Element:
+        system, prompt = render_file_prompt(prompt_template, filepath, repo_name, chunk.text)
+        prompt += (f"\n\n[Chunk information]\nThe file is too large to read at once. These contents are "
+                   f"part {index} of {len(chunks)} (lines {chunk.start_line + 1}-{chunk.end_line}). "
+                   f"Only describe what appears in this part.")
+        summary = await request_chat_completion([("user", prompt)], rate_limiter=rate_limiter,
+                                                system=system, telemetry=telemetry,
+                                                **router.request_options(route))
+        return build_summary_element(summary, f"{filepath} (part {index})", telemetry)
+
+    parts = await asyncio.gather(*(summarize_chunk(i, chunk) for i, chunk in enumerate(chunks, start=1)))
+    root, partial_summaries = merge_partial_summaries(parts)
+    file_summary = ET.SubElement(root, 'file-summary')
+    file_summary.text = await reduce_file_summaries(filepath, repo_name, chunks, partial_summaries, route,
+                                                    rate_limiter, telemetry, router)
+    return root
 
 
 async def summarize_file(file_element: ET.Element, current_dir: str, root_dir: str, 
-                        mirror_base: str, repo_name: str, overwrite: bool, 
-                        semaphore: asyncio.Semaphore) -> None:
-    """Summarize a single file and save to mirror location"""
-    if file_element.get('ignore', '').lower() == 'true' or \
-       file_element.get('text-readable', '').lower() == 'false':
-        return
+                        store: SummaryStore, repo_name: str, overwrite: bool, 
+                        semaphore: asyncio.Semaphore,
+                        summary_cache: Optional[SummaryCache] = None,
+                        telemetry: Optional[Telemetry] = None,
+                        rate_limiter: Optional[RateLimiter] = None,
+                        chunking: Optional[Dict[str, int]] = None,
+                        journal: Optional[RunJournal] = None,
+                        router: Optional[Router] = None,
+                        preloaded: Optional[Dict[str, FileText]] = None,
+                        in_flight: bool = False) -> bool:
+    """
+    Summarize a single file and save it to the summary store. The router picks the
+    provider, model and max_tokens from the file's token count and extension. Files
+    in preloaded are taken from it instead of being read.
 
+    With a summary cache, an existing summary is kept only if it was made from the
+    current file contents and prompt, and summaries of identical contents are reused
+    instead of requesting new ones. The semaphore wait, read, render, request and parse
+    stages are timed as spans in telemetry, if given. With chunking, files estimated above chunking['threshold'] tokens
+    are summarized in chunks (see summarize_in_chunks). With a journal, the file's
+    progress is recorded in it, and files it already has as done are skipped unread;
+    with in_flight, the caller has already recorded this attempt (e.g. a packed file
+    summarized again on its own). Returns False if the summary failed (the error is
+    logged), True otherwise.
+    """
     filepath = os.path.join(current_dir, file_element.get('name'))
-    mirror_path = get_mirror_path(filepath, root_dir, mirror_base) + '.xml'
+    if not should_summarize(file_element):
+        release_file_text(filepath, preloaded)
+        return True
+
+    rel_path = relative_path(filepath, root_dir)
+    if journal is not None and not in_flight:
+        if journal.should_skip(FILE_SUMMARY, rel_path):
+            release_file_text(filepath, preloaded)
+            return True
+        journal.record(FILE_SUMMARY, rel_path, IN_FLIGHT)
     
-    # Skip if summary already exists
-    if summary_exists(mirror_path) and not overwrite:
-        log.info(f"Summary already exists for {filepath}, skipping...")
-        return
+    # Without a cache, skip if summary already exists (before taking a semaphore slot)
+    if summary_cache is None and use_existing_summary(filepath, store, FILE_SUMMARY, rel_path,
+                                                      None, None, overwrite):
+        release_file_text(filepath, preloaded)
+        if journal is not None:
+            journal.record(FILE_SUMMARY, rel_path, DONE)
+        return True
     
+    if router is None:
+        router = default_router()
     try:
+        wait_start = time.perf_counter()
         async with semaphore:
-            file_content = read_file_to_text(filepath)
-            prompt = read_file_to_text('inputs/prompts/summarize_file.md')
-            prompt = replace_placeholders(prompt, {
-                "{{FILEPATH}}": filepath,
-                "{{FILE_NAME}}": os.path.basename(filepath),
-                "{{REPO_NAME}}": repo_name,
-                "{{FILE_CONTENTS}}": file_content
-            })
-            
-            messages = [("user", prompt)]
-            summary = await request_chat_completion(messages)
-            
-            # Create root element for the summary
-            root = ET.Element('file')
-            
-            if "<declarations>" in summary:
-                # Code file
-                file_xml = extract_xml(summary, "file")
-                if file_xml.startswith("<declarations"):
-                    # Wrap the content in a root element before parsing
-                    wrapped_xml = f"<root>{file_xml}</root>"
-                    try:
-                        summary_xml = ET.fromstring(wrapped_xml)
-                        for child in summary_xml:
-                            root.append(child)
-                    except ET.ParseError as e:
-                        log.error(f"Failed to parse code summary XML for {filepath}: {e}, saving entire output")
-                        summary_elem = ET.SubElement(root, 'summary')
-                        summary_elem.text = file_xml
-            else:
-                # No-code file
-                summary_text = extract_xml(summary, "file-summary")
-                summary_elem = ET.SubElement(root, 'file-summary')
-                summary_elem.text = summary_text
+            if telemetry is not None:
+                telemetry.observe('semaphore_wait', time.perf_counter() - wait_start)
+            with timed(telemetry, 'read'):
+                file_content, file_tokens = take_file_text(filepath, preloaded)
+            prompt_template = load_prompt_template(SUMMARIZE_FILE_PROMPT_PATH)
+            if file_tokens is None:
+                file_tokens = estimate_tokens(file_content)
+            route = router.route(filepath, file_tokens)
+
+            key = None
+            if summary_cache is not None:
+                key = summary_cache.make_key(file_content, prompt_template.text, route.model)
+                if use_existing_summary(filepath, store, FILE_SUMMARY, rel_path, key, summary_cache, overwrite):
+                    if journal is not None:
+                        journal.record(FILE_SUMMARY, rel_path, DONE)
+                    return True
+
+            root = None
+            if chunking is not None and file_tokens > chunking['threshold']:
+                root = await summarize_in_chunks(filepath, repo_name, file_content, prompt_template,
+                                                 chunking, route, rate_limiter, telemetry, router)
+            if root is None:
+                with timed(telemetry, 'render'):
+                    system, prompt = render_file_prompt(prompt_template, filepath, repo_name, file_content)
+                
+                messages = [("user", prompt)]
+                summary = await request_chat_completion(messages, rate_limiter=rate_limiter, system=system,
+                                                        telemetry=telemetry, **router.request_options(route))
+                with timed(telemetry, 'parse'):
+                    root = build_summary_element(summary, filepath, telemetry)
             
             # Save the summary
-            tree = ET.ElementTree(root)
-            tree.write(mirror_path, encoding='utf-8', xml_declaration=False, method='xml')
+            save_summary(store, FILE_SUMMARY, rel_path, root, key, summary_cache)
+            if journal is not None:
+                journal.record(FILE_SUMMARY, rel_path, DONE)
+            return True
             
     except Exception as e:
         log.error(f"Error summarizing file {filepath}: {e}")
+        if journal is not None:
+            journal.record(FILE_SUMMARY, rel_path, FAILED, e, is_transient_error(e))
+        return False
 
 
-async def process_filetree(dir_element: ET.Element, current_dir: str, root_dir: str,
-                          mirror_base: str, repo_name: str, overwrite: bool,
-                        semaphore: asyncio.Semaphore) -> None:
-    """Process a directory and all its contents"""
-    # Process all files in directory concurrently
-    file_tasks = []
-    for file_elem in dir_element.findall('file'):
-        task = asyncio.create_task(
-            summarize_file(file_elem, current_dir, root_dir, mirror_base, repo_name, overwrite, semaphore)
-        )
-        file_tasks.append(task)
-    
-    # Wait for all file summaries
-    await asyncio.gather(*file_tasks)
-    
-    # Process subdirectories recursively
-    for subdir in dir_element.findall('directory'):
-        subdir_path = os.path.join(current_dir, subdir.get('name'))
-        await process_filetree(subdir, subdir_path, root_dir, mirror_base, repo_name, 
-                               overwrite, semaphore)
-
-
-def enrich_filetree_element(element: ET.Element, current_dir: str, root_dir: str, mirror_base: str) -> None:
-    """Recursively enrich the filetree by incorporating summaries"""
-    # Process files in the current directory
-    for file_elem in element.findall('file'):
-        # Skip if file is marked as ignored
-        if file_elem.get('ignore', '').lower() == 'true':
-            element.remove(file_elem)
+def render_pack_prompt(prompt_template: PromptTemplate, members: List[PackedFile],
+                       repo_name: str) -> Tuple[str, str]:
+    """Return the (system, user) prompts of a pack, with each file between <source> tags"""
+    sources = '\n\n'.join(f'<source path="{escape_xml_attrib(member.rel_path)}">\n{member.text}\n</source>'
+                          for member in members)
+    return prompt_template.render({
+        "{{NUM_FILES}}": str(len(members)),
+        "{{REPO_NAME}}": repo_name,
+        "{{FILES}}": sources
+    })
+
+
+def split_packed_response(response: str) -> Dict[str, str]:
+    """The stripped contents of each <file path="..."> section of a packed response, by (escaped) path"""
+    return {path: content.strip() for path, content in PACKED_FILE_PATTERN.findall(response)}
+
+
+def parse_packed_summary(section: Optional[str], filepath: str,
+                         telemetry: Optional[Telemetry] = None) -> Optional[ET.Element]:
+    """
+    Parse one file's section of a packed response into a <file> element like
+    build_summary_element, or return None if it is missing or doesn't follow either
+    response template (the file is then summarized on its own).
+    """
+    if section is None:
+        return None
+    if "<declarations>" in section:
+        if not section.startswith("<declarations"):
+            return None
+        try:
+            ET.fromstring(f"<root>{section}</root>")
+        except ET.ParseError:
+            return None
+    elif find_xml(section, "file-summary") is None:
+        return None
+    return build_summary_element(f"<file>{section}</file>", filepath, telemetry)
+
+
+async def summarize_file_pack(pack: FilePack, root_dir: str, store: SummaryStore, repo_name: str,
+                              overwrite: bool, semaphore: asyncio.Semaphore,
+                              summary_cache: Optional[SummaryCache] = None,
+                              telemetry: Optional[Telemetry] = None,
+                              rate_limiter: Optional[RateLimiter] = None,
+                              chunking: Optional[Dict[str, int]] = None,
+                              journal: Optional[RunJournal] = None,
+                              router: Optional[Router] = None,
+                              preloaded: Optional[Dict[str, FileText]] = None) -> None:
+    """
+    Summarize a pack of small files with a single request along the pack's route and
+    split the response into one summary per file in the summary store.
+
+    Members with an up-to-date or cached summary are left out of the request, as in
+    summarize_file; a summary made for the file on its own is up to date too. Packed
+    summaries come from another prompt, so they are cached under keys of the pack
+    template, and a run without packing makes its own. Members whose section of the
+    response is missing or can't be parsed (or every member, if the request fails) are
+    summarized on their own with summarize_file, from the contents already read, as
+    the same journaled attempt. A pack left with one member to summarize sends it on
+    its own.
+    """
+    if router is None:
+        router = default_router()
+    prompt_template = load_prompt_template(SUMMARIZE_FILES_PROMPT_PATH)
+    file_prompt_template = load_prompt_template(SUMMARIZE_FILE_PROMPT_PATH)
+    members: List[PackedFile] = []
+    wait_start = time.perf_counter()
+    async with semaphore:
+        if telemetry is not None:
+            telemetry.observe('semaphore_wait', time.perf_counter() - wait_start)
+        for job in pack.files:
+            filepath = os.path.join(job.current_dir, job.file_element.get('name'))
+            rel_path = relative_path(filepath, root_dir)
+            if journal is not None:
+                if journal.should_skip(FILE_SUMMARY, rel_path):
+                    release_file_text(filepath, preloaded)
+                    continue
+                journal.record(FILE_SUMMARY, rel_path, IN_FLIGHT)
+            if summary_cache is None and use_existing_summary(filepath, store, FILE_SUMMARY, rel_path,
+                                                              None, None, overwrite):
+                release_file_text(filepath, preloaded)
+                if journal is not None:
+                    journal.record(FILE_SUMMARY, rel_path, DONE)
+                continue
+            try:
+                with timed(telemetry, 'read'):
+                    file_content = take_file_text(filepath, preloaded).text
+            except Exception as e:
+                log.error(f"Error summarizing file {filepath}: {e}")
+                if journal is not None:
+                    journal.record(FILE_SUMMARY, rel_path, FAILED, e, is_transient_error(e))
+                continue
+            key = None
+            if summary_cache is not None:
+                key = summary_cache.make_key(file_content, prompt_template.text, pack.route.model)
+                single_key = summary_cache.make_key(file_content, file_prompt_template.text, pack.route.model)
+                if use_existing_summary(filepath, store, FILE_SUMMARY, rel_path, key, summary_cache, overwrite,
+                                        (single_key,)):
+                    if journal is not None:
+                        journal.record(FILE_SUMMARY, rel_path, DONE)
+                    continue
+            members.append(PackedFile(job, filepath, rel_path, file_content, key))
+
+        unparsed = members
+        if len(members) > 1:
+            with timed(telemetry, 'render'):
+                system, prompt = render_pack_prompt(prompt_template, members, repo_name)
+            sections: Dict[str, str] = {}
+            try:
+                response = await request_chat_completion([("user", prompt)], rate_limiter=rate_limiter,
+                                                         system=system, telemetry=telemetry,
+                                                         **router.request_options(pack.route))
+                with timed(telemetry, 'parse'):
+                    sections = split_packed_response(response)
+            except Exception as e:
+                log.warning(f"Packed request for {len(members)} files failed ({e}), summarizing them one by one")
+            unparsed = []
+            for member in members:
+                root = parse_packed_summary(sections.get(escape_xml_attrib(member.rel_path)), member.filepath,
+                                            telemetry)
+                if root is None:
+                    unparsed.append(member)
+                    continue
+                save_summary(store, FILE_SUMMARY, member.rel_path, root, member.key, summary_cache)
+                if journal is not None:
+                    journal.record(FILE_SUMMARY, member.rel_path, DONE)
+            if telemetry is not None:
+                telemetry.count('packed_files', len(members) - len(unparsed))
+
+    # Outside the pack's semaphore slot, since each of these takes its own
+    if len(members) > 1 and unparsed:
+        log.info(f"Summarizing {len(unparsed)} of {len(members)} packed files on their own")
+        if telemetry is not None:
+            telemetry.count('unpacked_retries', len(unparsed))
+    contents = {member.filepath: FileText(member.text) for member in unparsed}
+    await asyncio.gather(*(summarize_file(member.job.file_element, member.job.current_dir, root_dir, store,
+                                          repo_name, overwrite, semaphore, summary_cache, telemetry, rate_limiter,
+                                          chunking, journal, router, contents, in_flight=True)
+                           for member in unparsed))
+
+
+def read_summary_text(store: SummaryStore, kind: str, rel_path: str, tag: str) -> Optional[str]:
+    """Return the text of the first <tag> of a stored summary, or None if there is none"""
+    summary = store.get(kind, rel_path)
+    if summary is None:
+        return None
+    try:
+        element = ET.fromstring(summary).find(tag)
+    except ET.ParseError:
+        return None
+    if element is None or not (element.text or '').strip():
+        return None
+    return element.text.strip()
+
+
+def build_filetree_branch(dir_element: ET.Element, dir_path: str, root_dir: str, store: SummaryStore,
+                          max_tokens: int) -> str:
+    """
+    Describe a directory's direct children with their file and directory summaries.
+    If that exceeds max_tokens, children keep only their names, starting from the
+    end, and if the names alone still don't fit the remaining children are omitted.
+    """
+    entries = []  # (name only, with summary) XML for each child
+    for child in dir_element:
+        if child.tag not in ('file', 'directory') or child.get('ignore', '').lower() == 'true':
             continue
-            
-        filepath = os.path.join(current_dir, file_elem.get('name'))
-        mirror_path = get_mirror_path(filepath, root_dir, mirror_base) + '.xml'
-        
-        # If summary exists, incorporate it
-        if os.path.exists(mirror_path):
+        rel_path = relative_path(os.path.join(dir_path, child.get('name')), root_dir)
+        if child.tag == 'file':
+            summary_tag = 'file-summary'
+            summary = read_summary_text(store, FILE_SUMMARY, rel_path, summary_tag)
+        else:
+            summary_tag = 'directory-summary'
+            summary = read_summary_text(store, DIRECTORY_SUMMARY, rel_path, summary_tag)
+        entry = ET.Element(child.tag, {'name': child.get('name')})
+        name_only = ET.tostring(entry, encoding='unicode')
+        if summary is not None:
+            ET.SubElement(entry, summary_tag).text = summary
+        entries.append((name_only, ET.tostring(entry, encoding='unicode')))
+
+    costs = [(estimate_tokens(name_only), estimate_tokens(full)) for name_only, full in entries]
+    total = sum(full for _, full in costs)
+    lines = [full for _, full in entries]
+    for i in reversed(range(len(entries))):
+        if total <= max_tokens:
+            break
+        lines[i] = entries[i][0]
+        total -= costs[i][1] - costs[i][0]
+    while total > max_tokens and lines:
+        lines.pop()
+        total -= costs[len(lines)][0]
+    omitted = len(entries) - len(lines)
+    if omitted:
+        lines.append(f"<!-- {omitted} more entries omitted -->")
+    return '\n'.join(lines)
+
+
+async def summarize_directory(job: DirectoryJob, root_dir: str, store: SummaryStore, repo_name: str,
+                              overwrite: bool, semaphore: asyncio.Semaphore,
+                              summary_cache: Optional[SummaryCache] = None,
+                              telemetry: Optional[Telemetry] = None,
+                              rate_limiter: Optional[RateLimiter] = None,
+                              branch_tokens: int = DEFAULT_DIRECTORY_BRANCH_TOKENS,
+                              journal: Optional[RunJournal] = None,
+                              router: Optional[Router] = None) -> bool:
+    """
+    Summarize a directory from the summaries of its direct children, which must be
+    done already. The summary is routed by the size of the branch sent and cached like
+    file summaries, keyed by that branch, and its stages and progress are recorded in
+    telemetry and the journal like a file's. Returns False if the summary failed.
+    """
+    dir_path = job.dir_path
+    rel_path = relative_path(dir_path, root_dir)
+    if journal is not None:
+        if journal.should_skip(DIRECTORY_SUMMARY, rel_path):
+            return True
+        journal.record(DIRECTORY_SUMMARY, rel_path, IN_FLIGHT)
+    # Without a cache key to tell, a directory in a retry-failed run is redone: it is
+    # there because a summary below it failed last time
+    rebuild = overwrite or (journal is not None and journal.mode == RUN_RETRY_FAILED)
+    if summary_cache is None and use_existing_summary(dir_path, store, DIRECTORY_SUMMARY, rel_path,
+                                                      None, None, rebuild):
+        if journal is not None:
+            journal.record(DIRECTORY_SUMMARY, rel_path, DONE)
+        return True
+
+    if router is None:
+        router = default_router()
+    try:
+        wait_start = time.perf_counter()
+        async with semaphore:
+            if telemetry is not None:
+                telemetry.observe('semaphore_wait', time.perf_counter() - wait_start)
+            with timed(telemetry, 'read'):
+                branch = build_filetree_branch(job.dir_element, dir_path, root_dir, store, branch_tokens)
+            prompt_template = load_prompt_template(SUMMARIZE_DIRECTORY_PROMPT_PATH)
+            route = router.route(dir_path, estimate_tokens(branch))
+
+            key = None
+            if summary_cache is not None:
+                key = summary_cache.make_key(branch, prompt_template.text, route.model)
+                if use_existing_summary(dir_path, store, DIRECTORY_SUMMARY, rel_path, key, summary_cache,
+                                        overwrite):
+                    if journal is not None:
+                        journal.record(DIRECTORY_SUMMARY, rel_path, DONE)
+                    return True
+
+            dir_name = repo_name if job.parent_path is None else os.path.basename(dir_path)
+            with timed(telemetry, 'render'):
+                system, prompt = prompt_template.render({
+                    "{{FILEPATH}}": dir_path,
+                    "{{DIR_NAME}}": dir_name,
+                    "{{REPO_NAME}}": repo_name,
+                    "{{FILETREE_BRANCH}}": branch
+                })
+            summary = await request_chat_completion([("user", prompt)], rate_limiter=rate_limiter, system=system,
+                                                    telemetry=telemetry, **router.request_options(route))
+            with timed(telemetry, 'parse'):
+                if telemetry is not None and find_xml(summary, "directory-summary") is None:
+                    telemetry.count('parse_failures')
+                root = ET.Element('directory')
+                ET.SubElement(root, 'directory-summary').text = extract_xml(summary, "directory-summary")
+            save_summary(store, DIRECTORY_SUMMARY, rel_path, root, key, summary_cache)
+            if journal is not None:
+                journal.record(DIRECTORY_SUMMARY, rel_path, DONE)
+            return True
+
+    except Exception as e:
+        log.error(f"Error summarizing directory {dir_path}: {e}")
+        if journal is not None:
+            journal.record(DIRECTORY_SUMMARY, rel_path, FAILED, e, is_transient_error(e))
+        return False
+
+
+def collect_file_jobs(dir_element: ET.Element, current_dir: str) -> List[FileJob]:
+    """Flatten the filetree into one list of file jobs, in filetree order"""
+    jobs = []
+    stack = [(dir_element, current_dir)]
+    while stack:
+        element, path = stack.pop()
+        for file_elem in element.findall('file'):
+            filepath = os.path.join(path, file_elem.get('name'))
             try:
-                summary_tree = ET.parse(mirror_path)
-                summary_root = summary_tree.getroot()
-                
-                # Preserve original attributes
-                original_attrs = file_elem.attrib
-                
-                # Replace the file element's children with summary content
-                file_elem.clear()
-                
-                # Restore original attributes
-                file_elem.attrib = original_attrs
-                
-                # Add all children from summary
-                for child in summary_root:
-                    file_elem.append(child)
-                    
-            except ET.ParseError as e:
-                log.error(f"Failed to parse summary XML for {filepath}: {e}")
+                size = os.path.getsize(filepath)
+            except OSError:
+                size = 0
+            jobs.append(FileJob(file_elem, path, size // BYTES_PER_TOKEN_ESTIMATE))
+        # Ignored directories are not summarized (and are dropped from the enriched filetree)
+        subdirs = [subdir for subdir in element.findall('directory')
+                   if subdir.get('ignore', '').lower() != 'true']
+        for subdir in reversed(subdirs):
+            stack.append((subdir, os.path.join(path, subdir.get('name'))))
+    return jobs
+
+
+def pack_small_files(jobs: List[FileJob], router: Router,
+                     packing: Dict[str, int]) -> List[Union[FileJob, FilePack]]:
+    """
+    Group files estimated at or below packing['max_file_tokens'] tokens into packs, in
+    filetree order, each within packing['pack_tokens'] tokens and packing['max_files']
+    files. The whole pack is answered within its route's max_tokens, so a pack also
+    holds no more files than that leaves packing['file_output_tokens'] of output for.
+    Files only share a pack with files on the same route, and files that end up alone
+    (or aren't summarized at all) stay file jobs.
+    """
+    result: List[Union[FileJob, FilePack]] = []
+    open_packs: Dict[str, FilePack] = {}
+
+    def close_pack(route_name: str) -> None:
+        pack = open_packs.pop(route_name)
+        result.append(pack.files[0] if len(pack.files) == 1 else pack)
+
+    for job in jobs:
+        if job.estimated_tokens > packing['max_file_tokens'] or not should_summarize(job.file_element):
+            result.append(job)
+            continue
+        route = router.route(os.path.join(job.current_dir, job.file_element.get('name')), job.estimated_tokens)
+        max_files = min(packing['max_files'], route.max_tokens // packing['file_output_tokens'])
+        if max_files < 2:
+            result.append(job)
+            continue
+        pack = open_packs.get(route.name)
+        if pack is not None and (pack.estimated_tokens + job.estimated_tokens > packing['pack_tokens'] or
+                                 len(pack.files) >= max_files):
+            close_pack(route.name)
+            pack = None
+        if pack is None:
+            pack = FilePack([], route, 0)
+        pack.files.append(job)
+        open_packs[route.name] = pack._replace(estimated_tokens=pack.estimated_tokens + job.estimated_tokens)
+    for route_name in list(open_packs):
+        close_pack(route_name)
+    return result
+
+
+def collect_directory_jobs(dir_element: ET.Element, current_dir: str) -> List[DirectoryJob]:
+    """Flatten the (non-ignored) directories of the filetree into directory jobs, parents first"""
+    jobs = []
+    stack = [(dir_element, current_dir, None)]
+    while stack:
+        element, path, parent_path = stack.pop()
+        jobs.append(DirectoryJob(element, path, parent_path))
+        for subdir in element.findall('directory'):
+            if subdir.get('ignore', '').lower() != 'true':
+                stack.append((subdir, os.path.join(path, subdir.get('name')), path))
+    return jobs
+
+
+async def process_filetree(dir_element: ET.Element, current_dir: str, root_dir: str,
+                          store: SummaryStore, repo_name: str, overwrite: bool,
+                        semaphore: asyncio.Semaphore,
+                        summary_cache: Optional[SummaryCache] = None,
+                        num_workers: int = DEFAULT_SEMAPHORE_SIZE,
+                        ordering: str = DEFAULT_ORDERING_POLICY,
+                        telemetry: Optional[Telemetry] = None,
+                        rate_limiter: Optional[RateLimiter] = None,
+                        chunking: Optional[Dict[str, int]] = None,
+                        directory_summaries: bool = False,
+                        directory_branch_tokens: int = DEFAULT_DIRECTORY_BRANCH_TOKENS,
+                        journal: Optional[RunJournal] = None,
+                        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                        router: Optional[Router] = None,
+                        preloaded: Optional[Dict[str, FileText]] = None,
+                        packing: Optional[Dict[str, int]] = None) -> None:
+    """
+    Summarize every file (and optionally every directory) in the tree through a
+    single work queue.
+
+    The tree is flattened up front and files are ordered by the given policy, then fed
+    into a queue that holds at most 2 * num_workers of them, from which num_workers
+    worker tasks pull jobs, so concurrency doesn't depend on how files are spread
+    across directories. A directory job is queued as soon as all of its children are
+    done, outside that bound, and goes ahead of the queued files, so directory
+    summaries are built bottom-up alongside file work instead of after it. Queue wait
+    and the stages of each summary are timed in telemetry, which also shows progress.
+
+    With a journal, summaries that fail with a transient error are queued again after
+    an exponential backoff, until they succeed or reach max_attempts; their parent
+    directory waits for them. Files in preloaded are summarized without reading them again.
+    With packing, small files are summarized several per request (see pack_small_files
+    and summarize_file_pack); a pack counts as done once each of its files is.
+    """
+    if telemetry is None:
+        telemetry = Telemetry()
+    if router is None:
+        router = default_router()
+    file_jobs = collect_file_jobs(dir_element, current_dir)
+    jobs: List[Union[FileJob, FilePack]] = list(file_jobs)
+    if packing is not None:
+        jobs = pack_small_files(file_jobs, router, packing)
+        log.info(f"Packed {len(file_jobs)} files into {len(jobs)} jobs")
+    jobs.sort(key=ORDERING_POLICIES[ordering])
+
+    # Items are (priority, sequence, job, enqueued_at, holds_slot): ready directories first,
+    # then files in policy order, then the stop signals. Files fed from the job list each
+    # hold one of the file slots while queued, so that at most 2 * num_workers of them wait
+    # in the queue; directories, retries and stop signals are few and never wait for a slot.
+    queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+    file_slots = asyncio.Semaphore(2 * num_workers)
+    sequence = itertools.count()
+
+    def enqueue(priority: int, job, holds_slot: bool = False) -> None:
+        queue.put_nowait((priority, next(sequence), job, time.perf_counter(), holds_slot))
+
+    async def feed_files() -> None:
+        for job in jobs:
+            await file_slots.acquire()
+            enqueue(1, job, holds_slot=True)
+
+    def stop_workers() -> None:
+        for _ in range(num_workers):
+            enqueue(2, None)  # One stop signal per worker
+
+    # Number of unfinished children (files and subdirectories) of each directory
+    pending: Dict[str, int] = {}
+    directory_jobs: Dict[str, DirectoryJob] = {}
+    if directory_summaries:
+        for dir_job in collect_directory_jobs(dir_element, current_dir):
+            directory_jobs[dir_job.dir_path] = dir_job
+            pending[dir_job.dir_path] = 0
+            if dir_job.parent_path is not None:
+                pending[dir_job.parent_path] += 1
+        for file_job in file_jobs:
+            pending[file_job.current_dir] += 1
+
+    remaining_files = len(file_jobs)  # Including files waiting to be retried
+
+    def child_done(parent_path: Optional[str]) -> None:
+        if parent_path is None:
+            stop_workers()  # The root directory is summarized last
+            return
+        pending[parent_path] -= 1
+        if pending[parent_path] == 0:
+            enqueue(0, directory_jobs[parent_path])
+
+    def job_done(job) -> None:
+        nonlocal remaining_files
+        telemetry.count('summaries')
+        if isinstance(job, DirectoryJob):
+            child_done(job.parent_path)
+        elif directory_summaries:
+            child_done(job.current_dir)
         else:
-            if file_elem.get('text-readable', '').lower() != 'false':
-                log.warning(f"Summary not found for {filepath}")
-    
-    # Process subdirectories recursively
-    for subdir in list(element.findall('directory')):  # Create a list to safely modify during iteration
-        # Skip if directory is marked as ignored
-        if subdir.get('ignore', '').lower() == 'true':
-            element.remove(subdir)
+            remaining_files -= 1
+            if remaining_files == 0:
+                stop_workers()
+
+    def retry_delay(kind: str, path: str) -> Optional[float]:
+        """Backoff before retrying a summary that just failed, or None if it should not be retried"""
+        entry = journal.get(kind, path) if journal is not None else None
+        if entry is None or entry.state != FAILED or not entry.transient or entry.attempts >= max_attempts:
+            return None
+        return min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * 2 ** (entry.attempts - 1))
+
+    async def worker() -> None:
+        while True:
+            priority, _, job, enqueued_at, holds_slot = await queue.get()
+            if holds_slot:
+                file_slots.release()
+            try:
+                if job is None:
+                    return
+                telemetry.observe('queue_wait', time.perf_counter() - enqueued_at)
+                if isinstance(job, DirectoryJob):
+                    await summarize_directory(job, root_dir, store, repo_name, overwrite, semaphore,
+                                              summary_cache, telemetry, rate_limiter, directory_branch_tokens,
+                                              journal, router)
+                    finished = [(job, DIRECTORY_SUMMARY, relative_path(job.dir_path, root_dir))]
+                else:
+                    if isinstance(job, FilePack):
+                        await summarize_file_pack(job, root_dir, store, repo_name, overwrite, semaphore,
+                                                  summary_cache, telemetry, rate_limiter, chunking, journal,
+                                                  router, preloaded)
+                        members = job.files
+                    else:
+                        await summarize_file(job.file_element, job.current_dir, root_dir, store, repo_name,
+                                             overwrite, semaphore, summary_cache, telemetry, rate_limiter,
+                                             chunking, journal, router, preloaded)
+                        members = [job]
+                    finished = [(member, FILE_SUMMARY, relative_path(
+                        os.path.join(member.current_dir, member.file_element.get('name')), root_dir))
+                                for member in members]
+                # Failed members of a pack are retried on their own
+                for done_job, kind, path in finished:
+                    delay = retry_delay(kind, path)
+                    if delay is None:
+                        job_done(done_job)
+                    else:
+                        log.info(f"Retrying {path or repo_name} in {delay:.0f}s")
+                        asyncio.get_running_loop().call_later(delay, enqueue, priority, done_job)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+    progress_task = asyncio.create_task(telemetry.show_progress(len(file_jobs) + len(directory_jobs)))
+    for dir_path, count in pending.items():
+        if count == 0:
+            enqueue(0, directory_jobs[dir_path])  # Empty directories are ready right away
+    feeder = asyncio.create_task(feed_files())
+    if not directory_summaries and not jobs:
+        stop_workers()
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        feeder.cancel()
+        progress_task.cancel()
+
+
+def build_queue_jobs(dir_element: ET.Element, current_dir: str, root_dir: str,
+                     ordering: str = DEFAULT_ORDERING_POLICY,
+                     directory_summaries: bool = False) -> List[QueueJob]:
+    """
+    The jobs of the shared work queue, in the same order process_filetree runs them:
+    files by the ordering policy, and each directory (priority 0, so it goes first
+    once it is unblocked) after all of its children.
+    """
+    file_jobs = collect_file_jobs(dir_element, current_dir)
+    file_jobs.sort(key=ORDERING_POLICIES[ordering])
+    jobs = []
+    for priority, job in enumerate(file_jobs, start=1):
+        parent = relative_path(job.current_dir, root_dir) if directory_summaries else None
+        jobs.append(QueueJob(FILE_SUMMARY, relative_path(os.path.join(job.current_dir, job.file_element.get('name')),
+                                                          root_dir), parent, priority))
+    if directory_summaries:
+        for dir_job in collect_directory_jobs(dir_element, current_dir):
+            parent = None if dir_job.parent_path is None else relative_path(dir_job.parent_path, root_dir)
+            jobs.append(QueueJob(DIRECTORY_SUMMARY, relative_path(dir_job.dir_path, root_dir), parent, 0))
+    return jobs
+
+
+async def process_work_queue(work_queue: WorkQueue, worker_id: str, dir_element: ET.Element,
+                             current_dir: str, root_dir: str, store: SummaryStore, repo_name: str,
+                             overwrite: bool, semaphore: asyncio.Semaphore,
+                             summary_cache: Optional[SummaryCache] = None,
+                             num_workers: int = DEFAULT_SEMAPHORE_SIZE,
+                             telemetry: Optional[Telemetry] = None,
+                             rate_limiter: Optional[RateLimiter] = None,
+                             chunking: Optional[Dict[str, int]] = None,
+                             directory_branch_tokens: int = DEFAULT_DIRECTORY_BRANCH_TOKENS,
+                             lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                             router: Optional[Router] = None,
+                             max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> None:
+    """
+    Summarize files and directories claimed from a work queue shared with other
+    processes, until every job in it is done or has failed max_attempts times.
+
+    num_workers tasks each lease one job at a time, and a heartbeat task renews this
+    process's leases while the requests run. Jobs whose worker died are picked up again
+    once their lease expires. Jobs that fail, or that are not in this process's
+    filetree, are handed back to the queue. When the queue has nothing pending (other workers hold
+    the remaining jobs, or directories wait on their children) the tasks poll until
+    the queue is finished. A queue that a previous run left finished doesn't count:
+    the tasks wait for the coordinator to seed a new run. Time spent waiting for a job
+    is timed in telemetry as queue wait, and progress counts only this process's summaries.
+    """
+    if telemetry is None:
+        telemetry = Telemetry()
+    file_jobs = {relative_path(os.path.join(job.current_dir, job.file_element.get('name')), root_dir): job
+                 for job in collect_file_jobs(dir_element, current_dir)}
+    directory_jobs = {relative_path(job.dir_path, root_dir): job
+                      for job in collect_directory_jobs(dir_element, current_dir)}
+    # This process joins the run in progress, or else the next one the coordinator seeds
+    previous_run = work_queue.seeded_at()
+    joined = work_queue.has_unfinished_jobs()
+    if not joined:
+        log.info(f"Waiting for the coordinator to fill the work queue {work_queue.path}")
+
+    def is_run_finished() -> bool:
+        nonlocal joined
+        if not joined:
+            joined = work_queue.seeded_at() != previous_run or work_queue.has_unfinished_jobs()
+        return joined and work_queue.is_finished()
+
+    async def heartbeat() -> None:
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            work_queue.heartbeat(worker_id, lease_seconds)
+
+    async def worker() -> None:
+        wait_start = time.perf_counter()
+        while True:
+            queue_job = work_queue.claim(worker_id, lease_seconds)
+            if queue_job is None:
+                if is_run_finished():
+                    return
+                await asyncio.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            telemetry.observe('queue_wait', time.perf_counter() - wait_start)
+            if queue_job.kind == DIRECTORY_SUMMARY and queue_job.path in directory_jobs:
+                succeeded = await summarize_directory(directory_jobs[queue_job.path], root_dir, store, repo_name,
+                                                      overwrite, semaphore, summary_cache, telemetry, rate_limiter,
+                                                      directory_branch_tokens, router=router)
+            elif queue_job.kind == FILE_SUMMARY and queue_job.path in file_jobs:
+                job = file_jobs[queue_job.path]
+                succeeded = await summarize_file(job.file_element, job.current_dir, root_dir, store, repo_name,
+                                                 overwrite, semaphore, summary_cache, telemetry, rate_limiter,
+                                                 chunking, router=router)
+            else:
+                log.warning(f"Job for {queue_job.path or repo_name} is not in this worker's filetree, "
+                            f"handing it back")
+                succeeded = False
+            if succeeded:
+                work_queue.complete(queue_job)
+                telemetry.count('summaries')
+            else:
+                state = work_queue.fail(queue_job, worker_id, max_attempts, RETRY_BASE_DELAY, MAX_RETRY_DELAY)
+                if state == FAILED:
+                    log.error(f"Giving up on {queue_job.path or repo_name} after {max_attempts} attempts")
+                elif state is None:
+                    log.warning(f"Lease on {queue_job.path or repo_name} expired before it failed; "
+                                f"another worker has it")
+            wait_start = time.perf_counter()
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    progress_task = asyncio.create_task(telemetry.show_progress())
+    try:
+        await asyncio.gather(*(worker() for _ in range(num_workers)))
+    finally:
+        heartbeat_task.cancel()
+        progress_task.cancel()
+        released = work_queue.release(worker_id)
+        if released:
+            log.info(f"Released {released} unfinished jobs back to the work queue")
+    if work_queue.reclaimed:
+        log.info(f"Reclaimed {work_queue.reclaimed} jobs whose lease had expired")
+
+
+async def submit_batch(batch_client: BatchClient, state: BatchState,
+                       requests: List[BatchRequest], targets: Dict[str, dict]) -> None:
+    """Submit one batch and record it immediately, so it is polled (not resubmitted) after a crash"""
+    batch_id = await batch_client.create(requests)
+    state.add_batch(batch_id, targets)
+    log.info(f"Submitted batch {batch_id} with {len(requests)} requests")
+
+
+async def collect_batch(batch_client: BatchClient, batch_id: str, targets: Dict[str, dict],
+                        root_dir: str, store: SummaryStore,
+                        summary_cache: Optional[SummaryCache] = None) -> None:
+    """Save the results of an ended batch to the summary store, like summarize_file does"""
+    succeeded = 0
+    async for result in batch_client.results(batch_id):
+        target = targets.get(result.custom_id)
+        if target is None:
+            log.warning(f"Unknown request {result.custom_id} in batch {batch_id}")
             continue
-            
-        subdir_path = os.path.join(current_dir, subdir.get('name'))
-        enrich_filetree_element(subdir, subdir_path, root_dir, mirror_base)
+        filepath = os.path.join(root_dir, *target['path'].split('/'))
+        if result.text is None:
+            log.error(f"Error summarizing file {filepath} in batch {batch_id}: {result.error}")
+            continue
+        try:
+            root = build_summary_element(result.text, filepath)
+            save_summary(store, FILE_SUMMARY, target['path'], root, target['key'], summary_cache)
+            succeeded += 1
+        except Exception as e:
+            log.error(f"Error saving summary for {filepath}: {e}")
+    log.info(f"Collected batch {batch_id}: {succeeded}/{len(targets)} summaries saved")
+
+
+async def process_filetree_batch(dir_element: ET.Element, current_dir: str, root_dir: str,
+                                 store: SummaryStore, repo_name: str, overwrite: bool,
+                                 batch_client: BatchClient,
+                                 summary_cache: Optional[SummaryCache] = None,
+                                 batch_size: int = DEFAULT_BATCH_SIZE,
+                                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                                 router: Optional[Router] = None) -> None:
+    """
+    Summarize every pending file through the provider's batch API instead of
+    interactive requests.
+
+    The same skip rules and prompt as summarize_file are used. Prompts are submitted
+    in chunks of at most batch_size requests, and the batch IDs are saved in the
+    output directory (next to the summary store) as soon as they are created. Batches
+    are then polled with increasing intervals until they end, and their results are
+    saved to the summary store. Re-running after an interruption polls the saved batches again and only
+    submits files that are in none of them. Each request takes the model and max_tokens
+    of its route; the batch client is the one of the routes' provider.
+    """
+    if router is None:
+        router = default_router()
+    state = BatchState(os.path.join(os.path.dirname(store.path), BATCH_STATE_FILENAME))
+    already_submitted = state.pending_paths()
+    if already_submitted:
+        log.info(f"Resuming {len(state.pending_batch_ids())} pending batches "
+                 f"({len(already_submitted)} files)")
+    prompt_template = load_prompt_template(SUMMARIZE_FILE_PROMPT_PATH)
+
+    requests: List[BatchRequest] = []
+    targets: Dict[str, dict] = {}
+    batch_bytes = 0
+    for job in collect_file_jobs(dir_element, current_dir):
+        if not should_summarize(job.file_element):
+            continue
+        filepath = os.path.join(job.current_dir, job.file_element.get('name'))
+        rel_path = relative_path(filepath, root_dir)
+        if rel_path in already_submitted:
+            continue
+        if summary_cache is None and use_existing_summary(filepath, store, FILE_SUMMARY, rel_path,
+                                                          None, None, overwrite):
+            continue
+        try:
+            file_content = read_file_to_text(filepath)
+        except IOError as e:
+            log.error(f"Error summarizing file {filepath}: {e}")
+            continue
+        route = router.route(filepath, estimate_tokens(file_content))
+        key = None
+        if summary_cache is not None:
+            key = summary_cache.make_key(file_content, prompt_template.text, route.model)
+            if use_existing_summary(filepath, store, FILE_SUMMARY, rel_path, key, summary_cache, overwrite):
+                continue
+
+        system, prompt = render_file_prompt(prompt_template, filepath, repo_name, file_content)
+        prompt_bytes = len(prompt.encode('utf-8'))
+        if requests and (len(requests) >= batch_size or batch_bytes + prompt_bytes > MAX_BATCH_BYTES):
+            await submit_batch(batch_client, state, requests, targets)
+            requests, targets, batch_bytes = [], {}, 0
+
+        # Custom IDs must be short and alphanumeric, so use a hash of the relative path
+        custom_id = hashlib.sha1(rel_path.encode('utf-8', errors='surrogatepass')).hexdigest()
+        requests.append(BatchRequest(custom_id, [{"role": "user", "content": prompt}],
+                                     route.model, route.max_tokens, system=system))
+        targets[custom_id] = {'path': rel_path, 'key': key}
+        batch_bytes += prompt_bytes
+    if requests:
+        await submit_batch(batch_client, state, requests, targets)
+
+    # Poll until every batch has ended, backing off between rounds
+    delay = poll_interval
+    pending = state.pending_batch_ids()
+    while pending:
+        for batch_id in pending:
+            if await batch_client.is_ended(batch_id):
+                await collect_batch(batch_client, batch_id, state.batches[batch_id]['requests'],
+                                    root_dir, store, summary_cache)
+                state.mark_collected(batch_id)
+        pending = state.pending_batch_ids()
+        if pending:
+            log.info(f"Waiting for {len(pending)} batches, next check in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(MAX_POLL_INTERVAL, delay * 1.5)
+
+
+def summary_fragment(summary: str) -> str:
+    """
+    Return the serialized children of a stored summary's root element, exactly as they
+    are stored. Summaries are always serialized by ElementTree, so the root's start tag
+    ends at the first '>'.
+    """
+    start = summary.index('>') + 1
+    if summary[start - 2] == '/':
+        return ''  # Empty root element
+    return summary[start:summary.rindex('</')]
+
+
+def write_enriched_element(emit: Callable[[str], None], element: ET.Element, current_dir: str,
+                           root_dir: str, store: SummaryStore) -> None:
+    """
+    Write a filetree element (without its tail) with the summaries of it and of
+    everything below it, copied from the summary store. Ignored files and
+    directories are left out.
+    """
+    if element.tag == 'file':
+        filepath = os.path.join(current_dir, element.get('name'))
+        summary = store.get(FILE_SUMMARY, relative_path(filepath, root_dir))
+        if summary is not None:
+            # The summary replaces the file element's contents
+            fragment = summary_fragment(summary)
+            emit(xml_start_tag('file', element.attrib, empty=not fragment))
+            if fragment:
+                emit(fragment + '</file>')
+            return
+        if element.get('text-readable', '').lower() != 'false':
+            log.warning(f"Summary not found for {filepath}")
+        dir_path = current_dir
+        fragment = ''
+    elif element.tag in ('directory', 'repository'):
+        dir_path = current_dir if element.tag == 'repository' else os.path.join(current_dir, element.get('name'))
+        summary = store.get(DIRECTORY_SUMMARY, relative_path(dir_path, root_dir))
+        fragment = '' if summary is None else summary_fragment(summary)
+    else:
+        dir_path = current_dir
+        fragment = ''
+
+    children = [child for child in element
+                if not (child.tag in ('file', 'directory') and child.get('ignore', '').lower() == 'true')]
+    if element.text is None and not fragment and not children:
+        emit(xml_start_tag(element.tag, element.attrib, empty=True))
+        return
+    emit(xml_start_tag(element.tag, element.attrib, empty=False))
+    emit(escape_xml_text(element.text or '') + fragment)  # The directory's summary goes first
+    for child in children:
+        write_enriched_element(emit, child, dir_path, root_dir, store)
+        emit(escape_xml_text(child.tail or ''))
+    emit(f"</{element.tag}>")
+
+
+def write_enriched_filetree(output_path: str, ft_root: ET.Element, root_dir: str, store: SummaryStore,
+                            token_counter: Optional[IncrementalTokenCounter] = None) -> None:
+    """
+    Stream the enriched filetree to output_path: the filetree with each summary copied
+    in from the summary store as it is written, so only the filetree and one summary
+    are held in memory. Written text is also fed to token_counter, if given.
+    """
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        def emit(text: str) -> None:
+            output_file.write(text)
+            if token_counter is not None:
+                token_counter.feed(text)
+
+        write_enriched_element(emit, ft_root, root_dir, root_dir, store)
+
+
+def add_enrichment_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options of the summarization step, shared with pipeline.py"""
+    parser.add_argument('-s', '--semaphore-size', 
+                        type=int, 
+                        default=DEFAULT_SEMAPHORE_SIZE,
+                        help=f'Maximum number of concurrent tasks (default: {DEFAULT_SEMAPHORE_SIZE})')
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        help='Overwrite output files if they exists')
+    parser.add_argument('--rpm', type=float,
+                        help='Provider limit on requests per minute (default: no client-side limit)')
+    parser.add_argument('--itpm', type=float,
+                        help='Provider limit on input tokens per minute (default: no client-side limit)')
+    parser.add_argument('--otpm', type=float,
+                        help='Provider limit on output tokens per minute (default: no client-side limit)')
+    parser.add_argument('--max-retries', type=int, default=6,
+                        help='Retries for rate-limited or failed requests before a file is skipped (default: 6)')
+    parser.add_argument('--routes',
+                        help='JSON file of providers and routes choosing the model and max_tokens of each request '
+                             'from the size and type of the file (default: every request to '
+                             f'{DEFAULT_MODEL} on Anthropic)')
+    parser.add_argument('--batch',
+                        action='store_true',
+                        help='Submit summaries through the Message Batches API instead of interactive requests '
+                             '(cheaper, resumable, but results can take up to 24h)')
+    parser.add_argument('--fake-batch', action='store_true',
+                        help='With --batch, submit to a local fake batch API that answers with placeholder '
+                             'summaries, to try the batch path offline')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'Maximum number of requests per batch (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f'Initial seconds between batch status checks (default: {DEFAULT_POLL_INTERVAL:.0f})')
+    parser.add_argument('--order',
+                        choices=sorted(ORDERING_POLICIES),
+                        default=DEFAULT_ORDERING_POLICY,
+                        help=f'Order in which files are summarized (default: {DEFAULT_ORDERING_POLICY})')
+    parser.add_argument('--no-directory-summaries',
+                        action='store_true',
+                        help='Only summarize files, not directories')
+    parser.add_argument('--directory-branch-tokens', type=int, default=DEFAULT_DIRECTORY_BRANCH_TOKENS,
+                        help='Maximum tokens of child summaries sent to summarize one directory '
+                             f'(default: {DEFAULT_DIRECTORY_BRANCH_TOKENS})')
+    parser.add_argument('--chunk-threshold', type=int, default=DEFAULT_CHUNKING['threshold'],
+                        help='Summarize files above this many tokens in chunks, then merge the partial summaries '
+                             f"(default: {DEFAULT_CHUNKING['threshold']}, 0 disables chunking)")
+    parser.add_argument('--chunk-tokens', type=int, default=DEFAULT_CHUNKING['chunk_tokens'],
+                        help=f"Maximum tokens per chunk (default: {DEFAULT_CHUNKING['chunk_tokens']})")
+    parser.add_argument('--pack', action='store_true',
+                        help='Summarize small files several per request (interactive single-process runs only)')
+    parser.add_argument('--pack-max-file-tokens', type=int, default=DEFAULT_PACKING['max_file_tokens'],
+                        help=f"Estimated tokens at or below which a file is packed "
+                             f"(default: {DEFAULT_PACKING['max_file_tokens']})")
+    parser.add_argument('--pack-tokens', type=int, default=DEFAULT_PACKING['pack_tokens'],
+                        help=f"Maximum estimated tokens of the files in one pack "
+                             f"(default: {DEFAULT_PACKING['pack_tokens']})")
+    parser.add_argument('--pack-max-files', type=int, default=DEFAULT_PACKING['max_files'],
+                        help=f"Maximum files in one pack (default: {DEFAULT_PACKING['max_files']})")
+    parser.add_argument('--pack-file-output-tokens', type=int, default=DEFAULT_PACKING['file_output_tokens'],
+                        help=f"Output tokens kept for each file of a pack, which caps the files of a pack "
+                             f"by its route's max_tokens (default: {DEFAULT_PACKING['file_output_tokens']})")
+    parser.add_argument('--no-summary-cache',
+                        action='store_true',
+                        help='Do not use the summary cache; skip files whose summary exists')
+    parser.add_argument('--summary-cache-path',
+                        default=DEFAULT_SUMMARY_CACHE_PATH,
+                        help=f'Path of the shared summary cache (default: {DEFAULT_SUMMARY_CACHE_PATH})')
+    parser.add_argument('--cache-max-size-mb',
+                        type=float,
+                        help='Evict least recently used summaries beyond this cache size')
+    parser.add_argument('--cache-max-age-days',
+                        type=float,
+                        help='Evict summaries that have not been used for this many days')
+    parser.add_argument('--export-mirror',
+                        action='store_true',
+                        help='Also write each summary as a loose XML file, mirroring the repository layout '
+                             'in the output directory')
+    parser.add_argument('--metrics-out',
+                        help="Write the run's timings, token counts and cost to this file at the end")
+    parser.add_argument('--metrics-format',
+                        choices=METRICS_FORMATS,
+                        default='json',
+                        help='Format of --metrics-out: JSON, or Prometheus text format (default: json)')
+    parser.add_argument('--retry-failed',
+                        action='store_true',
+                        help='Only summarize the files and directories that failed in the previous run')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help='Attempts per summary before a transient failure (with --coordinator and '
+                             '--worker, any failure) is given up on for this run '
+                             f'(default: {DEFAULT_MAX_ATTEMPTS})')
+    parser.add_argument('--coordinator',
+                        action='store_true',
+                        help='Fill a work queue in the output directory that --worker processes share, work on it '
+                             'too, and write the enriched filetree once every job is done')
+    parser.add_argument('--worker',
+                        action='store_true',
+                        help="Only summarize jobs pulled from the coordinator's work queue, until it is finished")
+    parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help='Seconds without a heartbeat before a job held by a worker is handed to another '
+                             f'(default: {DEFAULT_LEASE_SECONDS:.0f})')
 
 
 def parse_arguments():
@@ -173,16 +1412,167 @@ def parse_arguments():
                         help='Base directory path of the repository.')
     parser.add_argument('-o', '--output',
                         help='Output directory path (default: outputs/repo_name/summaries)')
-    parser.add_argument('-s', '--semaphore-size', 
-                        type=int, 
-                        default=DEFAULT_SEMAPHORE_SIZE,
-                        help=f'Maximum number of concurrent tasks (default: {DEFAULT_SEMAPHORE_SIZE})')
-    parser.add_argument('--overwrite',
-                        action='store_true',
-                        help='Overwrite output files if they exists')
+    add_enrichment_arguments(parser)
     return parser.parse_args()
 
 
+def validate_enrichment_arguments(args: argparse.Namespace) -> None:
+    if args.semaphore_size < 1:
+        raise ValueError("Semaphore size must be at least 1")
+    if args.batch_size < 1:
+        raise ValueError("Batch size must be at least 1")
+    if args.chunk_threshold and args.chunk_tokens < 1:
+        raise ValueError("Chunk tokens must be at least 1")
+    if args.coordinator and args.worker:
+        raise ValueError("A process is either the coordinator or a worker")
+    if args.batch and (args.coordinator or args.worker):
+        raise ValueError("Batch mode does not use the shared work queue")
+    if args.fake_batch and not args.batch:
+        raise ValueError("--fake-batch only applies with --batch")
+    if args.lease_seconds <= 0:
+        raise ValueError("Lease seconds must be positive")
+    if args.max_attempts < 1:
+        raise ValueError("Max attempts must be at least 1")
+    if args.retry_failed and (args.batch or args.coordinator or args.worker):
+        raise ValueError("--retry-failed only applies to interactive single-process runs")
+    if args.pack and (args.batch or args.coordinator or args.worker):
+        raise ValueError("--pack only applies to interactive single-process runs")
+    if args.pack and (args.pack_tokens < 1 or args.pack_max_files < 2 or args.pack_file_output_tokens < 1):
+        raise ValueError("Packs need at least 1 token, 2 files and 1 output token per file")
+
+
+async def run_enrichment(args: argparse.Namespace, ft_root: ET.Element, root_dir: str, output_dir: str,
+                         preloaded: Optional[Dict[str, FileText]] = None) -> None:
+    """
+    Summarize the files and directories of the filetree with the given options and
+    write the enriched filetree to output_dir (unless this process is a worker).
+    Files in preloaded are not read again in the default single-process mode.
+    """
+    # One pooled connection per concurrent request
+    if args.routes:
+        router = load_router(args.routes, max_connections=args.semaphore_size)
+    else:
+        router = build_router(max_connections=args.semaphore_size)
+    batch_providers = {router.providers[route.provider] for route in router.routes}
+    if not args.fake_batch:
+        for provider in router.providers.values():
+            provider.validate()  # Before any work, rather than on every request
+        if args.batch and (len(batch_providers) != 1 or
+                           not isinstance(next(iter(batch_providers)), AnthropicProvider)):
+            raise ValueError("Batch mode needs every route on the same Anthropic provider")
+
+    # Open the summary store in the output directory
+    repo_name = os.path.basename(os.path.abspath(root_dir))
+    store = SummaryStore(os.path.join(output_dir, SUMMARY_STORE_FILENAME))
+    if len(store) == 0:
+        imported = import_mirror_summaries(store, output_dir)
+        if imported:
+            log.info(f"Imported {imported} summaries from the mirror layout in {output_dir}")
+    
+    # Process the entire tree and generate summaries
+    summary_cache = None if args.no_summary_cache else SummaryCache(args.summary_cache_path)
+    semaphore = asyncio.Semaphore(args.semaphore_size)
+    try:
+        if args.batch:
+            if args.fake_batch:
+                batch_client = FakeBatchClient(os.path.join(output_dir, FAKE_BATCHES_FILENAME))
+            else:
+                batch_client = AnthropicBatchClient(next(iter(batch_providers)).client)
+            await process_filetree_batch(ft_root, root_dir, root_dir, store, repo_name, args.overwrite,
+                                         batch_client, summary_cache, args.batch_size, args.poll_interval, router)
+            if not args.no_directory_summaries:
+                log.info("Directory summaries are not generated in batch mode; "
+                         "re-run without --batch to add them from the cached file summaries")
+        else:
+            # Concurrency starts at the semaphore size and backs off when the provider rate limits us
+            rate_limiter = RateLimiter(args.rpm, args.itpm, args.otpm, max_concurrency=args.semaphore_size,
+                                       max_retries=args.max_retries)
+            chunking = None
+            if args.chunk_threshold:
+                chunking = {'threshold': args.chunk_threshold, 'chunk_tokens': args.chunk_tokens}
+            packing = None
+            if args.pack:
+                packing = {'max_file_tokens': args.pack_max_file_tokens, 'pack_tokens': args.pack_tokens,
+                           'max_files': args.pack_max_files, 'file_output_tokens': args.pack_file_output_tokens}
+            telemetry = Telemetry()
+            if args.coordinator or args.worker:
+                work_queue = WorkQueue(os.path.join(output_dir, WORK_QUEUE_FILENAME))
+                if args.coordinator:
+                    jobs = build_queue_jobs(ft_root, root_dir, root_dir, args.order, not args.no_directory_summaries)
+                    if work_queue.seed(jobs):
+                        log.info(f"Queued {len(jobs)} jobs in {work_queue.path}")
+                    else:
+                        log.info(f"Joining the unfinished run in {work_queue.path}: {work_queue.counts()}")
+                worker_id = f"{socket.gethostname()}:{os.getpid()}"
+                await process_work_queue(work_queue, worker_id, ft_root, root_dir, root_dir, store, repo_name,
+                                         args.overwrite, semaphore, summary_cache, args.semaphore_size, telemetry,
+                                         rate_limiter, chunking, args.directory_branch_tokens, args.lease_seconds,
+                                         router, args.max_attempts)
+                failed = work_queue.failed()
+                if failed and args.coordinator:
+                    log.warning(f"{len(failed)} summaries failed after {args.max_attempts} attempts: "
+                                f"{', '.join(job.path or repo_name for job in failed[:10])}"
+                                f"{', ...' if len(failed) > 10 else ''}; re-run the coordinator to retry them")
+                work_queue.close()
+            else:
+                # Progress is journaled so an interrupted run resumes where it stopped
+                journal = RunJournal(os.path.join(output_dir, RUN_JOURNAL_FILENAME))
+                if journal.start_run(args.retry_failed):
+                    log.info(f"Resuming the interrupted run in {journal.path}: {journal.counts()}")
+                elif args.retry_failed:
+                    log.info(f"Retrying {len(journal.entries)} summaries: the failed ones and the directories above them")
+                await process_filetree(ft_root, root_dir, root_dir, store, repo_name,
+                                       args.overwrite, semaphore, summary_cache,
+                                       args.semaphore_size, args.order, telemetry, rate_limiter, chunking,
+                                       not args.no_directory_summaries, args.directory_branch_tokens,
+                                       journal, args.max_attempts, router, preloaded, packing)
+                journal.finish()
+                failed = journal.failed()
+                if failed:
+                    log.warning(f"{len(failed)} summaries failed (see {journal.path}); "
+                                f"re-run with --retry-failed to retry only those")
+                journal.close()
+            rate_limiter.log_stats()
+            telemetry.log_summary()
+            if args.metrics_out:
+                telemetry.export(args.metrics_out, args.metrics_format)
+                log.info(f"Metrics written to {args.metrics_out}")
+    finally:
+        await router.close()
+    if summary_cache is not None:
+        summary_cache.log_stats()
+        max_bytes = None if args.cache_max_size_mb is None else int(args.cache_max_size_mb * 1024 * 1024)
+        evicted = summary_cache.evict(max_bytes, args.cache_max_age_days)
+        if evicted:
+            log.info(f"Evicted {evicted} summaries from the summary cache")
+        summary_cache.close()
+    if args.worker:
+        store.close()  # The coordinator writes the enriched filetree
+        return
+
+    # Write the enriched filetree, counting its tokens as it is written (if the encoding loads)
+    output_path = os.path.join(output_dir, 'enriched_filetree.xml')
+    encoding = get_tiktoken_encoding("o200k_base")
+    token_counter = None if encoding is None else IncrementalTokenCounter(encoding)
+    write_enriched_filetree(output_path, ft_root, root_dir, store, token_counter)
+    log.info(f"Enriched filetree saved to: {output_path}")
+    if token_counter is None:
+        log.warning("Skipping the token count of the enriched filetree: o200k_base encoding unavailable")
+    else:
+        token_count = token_counter.finish()
+        log.info(f"Token count of enriched filetree (o200k_base encoding): {token_count}")
+
+        # Let the token counting tools reuse the count
+        token_cache = TokenCountCache()
+        token_cache.put_many({TokenCountCache.file_key(output_path, "o200k_base"): token_count})
+        token_cache.close()
+
+    if args.export_mirror:
+        exported = export_summaries(store, output_dir)
+        log.info(f"Exported {exported} summaries to the mirror layout in {output_dir}")
+    store.close()
+
+
 async def main():
     args = parse_arguments()
     
@@ -191,40 +1581,16 @@ async def main():
         raise FileNotFoundError(f"Filetree file not found: {args.filetree_path}")
     if not os.path.isdir(args.directory):
         raise NotADirectoryError(f"Directory not found: {args.directory}")
-    if args.semaphore_size < 1:
-        raise ValueError("Semaphore size must be at least 1")
-    
+    validate_enrichment_arguments(args)
+
     # Parse the XML filetree
     tree = ET.parse(args.filetree_path)
     ft_root = tree.getroot()
-    
-    # Get repo name and create mirrored output directory
+
     repo_name = os.path.basename(os.path.abspath(args.directory))
-    if args.output:
-        mirror_base = args.output
-    else:
-        mirror_base = os.path.join('outputs', repo_name, 'summaries')
-    create_mirrored_repo_structure(args.directory, mirror_base)
-    
-    # Process the entire tree and generate summaries
-    semaphore = asyncio.Semaphore(args.semaphore_size)
-    root_dir = args.directory  # This is our reference point for all relative paths
-    await process_filetree(ft_root, root_dir, root_dir, mirror_base, repo_name, 
-                           args.overwrite, semaphore)
-    
-    # Enrich the filetree with summaries
-    enrich_filetree_element(ft_root, root_dir, root_dir, mirror_base)
-    
-    # Save the enriched filetree
-    output_path = os.path.join(mirror_base, 'enriched_filetree.xml')
-    tree.write(output_path, encoding='utf-8', xml_declaration=False, method='xml')
-    log.info(f"Enriched filetree saved to: {output_path}")
-    
-    # Count tokens in the enriched filetree
-    encoding = tiktoken.get_encoding("o200k_base")
-    xml_string = ET.tostring(ft_root, encoding='utf-8').decode('utf-8')
-    token_count = len(encoding.encode(xml_string))
-    log.info(f"Token count of enriched filetree (o200k_base encoding): {token_count}")
+    output_dir = args.output or os.path.join('outputs', repo_name, 'summaries')
+    # The repository directory is our reference point for all relative paths
+    await run_enrichment(args, ft_root, args.directory, output_dir)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
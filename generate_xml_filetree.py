@@ -1,78 +1,246 @@
 import os
+import re
+import json
+import time
+import sqlite3
+import threading
 import xml.etree.ElementTree as ET
-import fnmatch
-from utils import log, indent_xml_filetree
+from contextlib import closing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import log, indent_xml_filetree, xml_start_tag, CACHE_DIR
 
-def parse_gitignore(gitignore_path):
+class GitignoreSpec:
     """
-    Parse the .gitignore file and return a list of patterns to ignore.
-    Each pattern is a tuple (pattern, base_path)
+    The compiled rules of a single .gitignore file.
+
+    Every rule is translated to a regex once, when the file is parsed. The rules are
+    then fused into two alternations (one for files, one for directories, since
+    directory-only rules never apply to files), listed from the last rule to the first.
+    A single fullmatch therefore finds the last matching rule, which is the one git
+    uses, and the name of the matched group tells whether it was a negation.
     """
-    ignore_patterns = []
-    base_path = os.path.dirname(gitignore_path)
 
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if not line or line.startswith('#'):
+    def __init__(self, base_path, rules):
+        self.base_path = base_path
+        self.rules = rules
+        self.file_regex = self._compile([rule for rule in rules if not rule[2]])
+        self.dir_regex = self._compile(rules)
+
+    @staticmethod
+    def _compile(rules):
+        if not rules:
+            return None
+        alternatives = []
+        for index, (regex, is_negation, _) in reversed(list(enumerate(rules))):
+            group = f"{'n' if is_negation else 'i'}{index}"
+            alternatives.append(f"(?P<{group}>{regex})")
+        return re.compile('|'.join(alternatives), re.DOTALL)
+
+    def match(self, rel_path, is_dir):
+        """
+        Match a path relative to base_path (with '/' separators).
+        Returns True if ignored, False if re-included by a negation, None if no rule matches.
+        """
+        regex = self.dir_regex if is_dir else self.file_regex
+        if regex is None:
+            return None
+        match = regex.fullmatch(rel_path)
+        if match is None:
+            return None
+        return match.lastgroup[0] == 'i'
+
+def _translate_glob(pattern):
+    """
+    Translate an (unanchored) gitignore glob to a regex that never crosses '/',
+    except through '**' path components.
+    """
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i):
+                at_start = i == 0 or pattern[i - 1] == '/'
+                at_end = i + 2 == n or pattern[i + 2] == '/'
+                if at_start and at_end:
+                    if i + 2 == n:
+                        # Trailing "/**" matches everything inside (but not the directory itself)
+                        parts.append('.*')
+                    else:
+                        # Leading "**/" or "/**/" matches zero or more directories
+                        parts.append('(?:.*/)?')
+                        i += 1  # Consume the '/' after '**'
+                    i += 2
                     continue
-                ignore_patterns.append((line, base_path))
-    return ignore_patterns
+                # Any other "**" is a regular asterisk
+                while i < n and pattern[i] == '*':
+                    i += 1
+                parts.append('[^/]*')
+                continue
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                parts.append(re.escape(c))  # Unclosed bracket, match it literally
+            else:
+                body = pattern[i + 1:j]
+                negated = body[:1] in ('!', '^')
+                if negated:
+                    body = body[1:]
+                body = body.replace('\\', '\\\\').replace('^', '\\^').replace('[', '\\[').replace(']', '\\]')
+                parts.append(f"[^/{body}]" if negated else f"[{body}]")
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
 
-def matches_pattern(path, ignore_patterns):
+def compile_gitignore_line(line):
     """
-    Determines whether a path matches any of the ignore patterns.
+    Compile one .gitignore line into a rule tuple (regex, is_negation, directory_only),
+    or return None for blank lines and comments.
     """
-    ignored = False
+    line = line.rstrip('\n\r')
+    # Trailing spaces are ignored unless escaped with a backslash
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+
+    is_negation = line.startswith('!')
+    if is_negation:
+        line = line[1:]
+    elif line.startswith('\\!') or line.startswith('\\#'):
+        line = line[1:]
+
+    directory_only = line.endswith('/') and not line.endswith('\\/')
+    if directory_only:
+        line = line.rstrip('/')
+    if not line:
+        return None
+
+    # A slash at the start or in the middle anchors the pattern to the .gitignore's
+    # directory; otherwise it matches the basename at any depth.
+    anchored = '/' in line
+    line = line.lstrip('/')
+    regex = _translate_glob(line)
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return (regex, is_negation, directory_only)
 
-    for pattern, base_path in ignore_patterns:
-        is_negation = pattern.startswith('!')
-        if is_negation:
-            pattern = pattern[1:]
-
-        pattern = pattern.strip()
-
-        if not pattern:
-            continue  # Skip empty patterns
-        if pattern.startswith('#'):
-            continue  # Skip comments
+def parse_gitignore(gitignore_path):
+    """
+    Parse the .gitignore file and return its compiled GitignoreSpec,
+    or None if the file does not exist or has no rules.
+    """
+    base_path = os.path.dirname(gitignore_path)
+    rules = []
 
-        # Adjust for escaping spaces
-        pattern = pattern.replace('\\ ', ' ')  # Unescape spaces
+    try:
+        with open(gitignore_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                rule = compile_gitignore_line(line)
+                if rule is not None:
+                    rules.append(rule)
+    except (IOError, OSError):
+        return None
 
-        # Convert path to match to relative path from base_path
-        rel_path = os.path.relpath(path, base_path)
-        rel_path = rel_path.replace(os.sep, '/')  # Normalize path separators
+    if not rules:
+        return None
+    return GitignoreSpec(base_path, rules)
 
-        # Handle patterns starting with '/'
-        if pattern.startswith('/'):
-            pattern = pattern.lstrip('/')
-        else:
-            # For patterns without leading '/', they can match any subpath
-            pass
+def matches_pattern(path, ignore_patterns, is_dir=None):
+    """
+    Determines whether a path matches the compiled ignore patterns (a list of
+    GitignoreSpec, from the repository root down to the path's directory).
+    Deeper .gitignore files take precedence, and within a file the last matching
+    rule wins. Pass is_dir if it is already known to avoid a stat call.
+    """
+    if not ignore_patterns:
+        return False
+    if is_dir is None:
+        is_dir = os.path.isdir(path)
 
-        # Handle patterns ending with '/'
-        match_directory_only = False
-        if pattern.endswith('/'):
-            match_directory_only = True
-            pattern = pattern.rstrip('/')
-            if not os.path.isdir(path):
-                continue  # Skip if pattern is for directory but path is not a directory
+    for spec in reversed(ignore_patterns):
+        prefix = spec.base_path.rstrip(os.sep) + os.sep
+        if not path.startswith(prefix):
+            continue
+        rel_path = path[len(prefix):]
+        if os.sep != '/':
+            rel_path = rel_path.replace(os.sep, '/')  # Normalize path separators
+        result = spec.match(rel_path, is_dir)
+        if result is not None:
+            return result
+
+    return False
+
+# Extensions that are always binary; files with these are classified without being opened.
+# Extensions that are sometimes text (.obj Wavefront models, .lib KiCad libraries, .pb,
+# .db, protocol 0 pickles) are left to the content sniff.
+BINARY_EXTENSIONS = frozenset({
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.icns', '.webp', '.tif', '.tiff', '.psd',
+    '.mp3', '.mp4', '.wav', '.ogg', '.flac', '.mov', '.avi', '.mkv', '.webm',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jar', '.war', '.whl', '.egg',
+    '.so', '.dylib', '.dll', '.exe', '.o', '.a', '.rlib', '.class',
+    '.pyc', '.pyo', '.pyd', '.pt', '.ckpt', '.safetensors', '.onnx',
+    '.h5', '.hdf5', '.npy', '.npz', '.parquet', '.arrow', '.feather',
+    '.ttf', '.otf', '.woff', '.woff2', '.eot', '.sqlite',
+})
+
+# File signatures of common binary formats, checked before scanning the sample for NULL bytes
+BINARY_MAGIC_NUMBERS = (
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'\x7fELF', b'\xca\xfe\xba\xbe',
+    b'\xcf\xfa\xed\xfe', b'\xce\xfa\xed\xfe', b'PK\x03\x04', b'\x1f\x8b', b'BZh',
+    b'\xfd7zXZ', b'7z\xbc\xaf', b'Rar!', b'SQLite format 3', b'OggS', b'\x00asm',
+    b'wOFF', b'wOF2', b'\x93NUMPY',
+)
+MAGIC_SAMPLE_SIZE = 16
+
+DEFAULT_SNIFF_CACHE_PATH = os.path.join(CACHE_DIR, 'text_verdicts.sqlite')
+SNIFF_CACHE_MAX_AGE_DAYS = 30
+
+def looks_like_text(sample):
+    """
+    Check if the first bytes of a file look like text: no known binary magic number,
+    no NULL bytes, and decodable as UTF-8 or latin-1.
+    """
+    if sample.startswith(BINARY_MAGIC_NUMBERS):
+        return False
 
-        # Perform the match
-        # Using fnmatchcase to match case-sensitive (consistent with gitignore behavior in Unix)
-        if fnmatch.fnmatchcase(rel_path, pattern):
-            if match_directory_only and not os.path.isdir(path):
-                continue  # Skip if pattern is directory-only but path is not a directory
-            ignored = not is_negation
+    # Check for NULL bytes - a strong indicator of binary content
+    if b'\x00' in sample:
+        return False
 
-    return ignored
+    # Try to decode as UTF-8
+    try:
+        sample.decode('utf-8')
+        return True
+    # Try to decode as latin-1
+    except UnicodeDecodeError:
+        try:
+            sample.decode('latin-1')
+            return True
+        except UnicodeDecodeError:
+            return False
 
 def is_text_file(file_path, sample_size=8192):
     """
-    Check if a file is readable as text by examining its contents.
+    Check if a file is readable as text, using (in order) its size, its extension,
+    its magic number, and finally the contents of its first chunk.
 
     Args:
         file_path (str): Path to the file to check
@@ -86,85 +254,421 @@ def is_text_file(file_path, sample_size=8192):
         if os.path.getsize(file_path) == 0:
             return True
 
-        # Try to read the first chunk of the file
-        with open(file_path, 'rb') as f:
-            chunk = f.read(sample_size)
-
-        # Check for NULL bytes - a strong indicator of binary content
-        if b'\x00' in chunk:
+        # Known binary extensions don't need to be opened
+        if os.path.splitext(file_path)[1].lower() in BINARY_EXTENSIONS:
             return False
 
-        # Try to decode as UTF-8
-        try:
-            chunk.decode('utf-8')
-            return True
-        # Try to decode as latin-1
-        except UnicodeDecodeError:
-            try:
-                chunk.decode('latin-1')
-                return True
-            except UnicodeDecodeError:
+        with open(file_path, 'rb') as f:
+            # Check the magic number before reading the rest of the sample
+            head = f.read(MAGIC_SAMPLE_SIZE)
+            if head.startswith(BINARY_MAGIC_NUMBERS):
                 return False
+            chunk = head + f.read(sample_size - len(head))
+        return looks_like_text(chunk)
 
     # If we can't read the file, assume it's not text
     except (IOError, OSError):
         return False
 
-def add_directory_to_xml(root_element, current_path, ignore_patterns):
+class TextFileClassifier:
     """
-    Recursively add directories and files to the XML element,
-    excluding those that match the ignore patterns or are hidden.
+    Classify files as text or binary in batches, with a persistent verdict cache.
+
+    Verdicts are keyed by (device, inode, size, mtime), so an unchanged file is never
+    opened twice. Cache misses are sniffed with is_text_file on a dedicated thread
+    pool, separate from the directory-scanning pool so that scans can wait on it.
+    Batches are classified from several scan threads at once, so each batch merges
+    its verdicts and stats under a lock.
     """
-    # Check for .gitignore in current directory
-    gitignore_path = os.path.join(current_path, '.gitignore')
-    if os.path.exists(gitignore_path):
-        current_ignore_patterns = parse_gitignore(gitignore_path)
-        # Combine ignore patterns from parent directories with current directory
-        ignore_patterns = ignore_patterns + current_ignore_patterns
 
-    entries = []
+    def __init__(self, cache_path=DEFAULT_SNIFF_CACHE_PATH, workers=None, sample_size=8192):
+        self.cache_path = cache_path
+        self.sample_size = sample_size
+        self.verdicts = {}
+        self.new_verdicts = {}
+        self.stats = {'extension': 0, 'cached': 0, 'sniffed': 0}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def load(self):
+        """Load all cached verdicts into memory."""
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with closing(sqlite3.connect(self.cache_path)) as conn:
+                for dev, ino, size, mtime_ns, text in conn.execute(
+                        'SELECT dev, ino, size, mtime_ns, text FROM verdicts'):
+                    self.verdicts[(dev, ino, size, mtime_ns)] = bool(text)
+        except sqlite3.Error as e:
+            log.warning(f"Could not read text verdict cache '{self.cache_path}': {e}")
+
+    def save(self):
+        """Persist new verdicts and drop entries that haven't been seen for a while."""
+        if self.cache_path is None:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        now = int(time.time())
+        try:
+            with closing(sqlite3.connect(self.cache_path)) as conn, conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS verdicts ('
+                             'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                             'text INTEGER, last_seen INTEGER, '
+                             'PRIMARY KEY (dev, ino, size, mtime_ns))')
+                conn.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)',
+                                 [key + (int(text), now) for key, text in self.new_verdicts.items()])
+                conn.execute('DELETE FROM verdicts WHERE last_seen < ?',
+                             (now - SNIFF_CACHE_MAX_AGE_DAYS * 86400,))
+        except sqlite3.Error as e:
+            log.warning(f"Could not write text verdict cache '{self.cache_path}': {e}")
+        self.new_verdicts = {}
+
+    def close(self):
+        self.executor.shutdown()
+
+    def classify_batch(self, entries):
+        """
+        Classify a batch of os.DirEntry objects and return a list of booleans
+        (True for text). Only cache misses are opened, concurrently.
+        """
+        results = [None] * len(entries)
+        to_sniff = []
+        counts = {'extension': 0, 'cached': 0, 'sniffed': 0}
+        new_verdicts = {}
+        for i, entry in enumerate(entries):
+            try:
+                st = entry.stat()
+            except OSError:
+                results[i] = False
+                continue
+            if st.st_size == 0:
+                results[i] = True
+                continue
+            if os.path.splitext(entry.name)[1].lower() in BINARY_EXTENSIONS:
+                counts['extension'] += 1
+                results[i] = False
+                continue
+            key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            with self.lock:
+                cached = self.verdicts.get(key)
+            if cached is not None:
+                counts['cached'] += 1
+                new_verdicts[key] = cached  # Refresh last_seen
+                results[i] = cached
+                continue
+            to_sniff.append((i, key, entry.path))
+
+        if to_sniff:
+            counts['sniffed'] += len(to_sniff)
+            paths = [path for _, _, path in to_sniff]
+            verdicts = self.executor.map(is_text_file, paths, [self.sample_size] * len(paths))
+            for (i, key, _), text in zip(to_sniff, verdicts):
+                new_verdicts[key] = text
+                results[i] = text
+
+        with self.lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+            self.verdicts.update(new_verdicts)
+            self.new_verdicts.update(new_verdicts)
+        return results
+
+# Result of scanning one directory:
+# - children:           sorted (name, path, is_dir, attributes) tuples that are neither hidden nor ignored
+# - ignore_patterns:    the parent's patterns plus this directory's .gitignore, for its subdirectories
+# - mtime_ns:           the directory's mtime, taken before it was listed
+# - gitignore_mtime_ns: the mtime of the directory's .gitignore, or None
+DirectoryListing = namedtuple('DirectoryListing',
+                              ['children', 'ignore_patterns', 'mtime_ns', 'gitignore_mtime_ns'])
+
+def extend_ignore_patterns(current_path, ignore_patterns):
+    """Combine ignore patterns from parent directories with the .gitignore of current_path."""
+    current_spec = parse_gitignore(os.path.join(current_path, '.gitignore'))
+    if current_spec is None:
+        return ignore_patterns
+    return ignore_patterns + [current_spec]
+
+def scan_directory(current_path, ignore_patterns, use_gitignore=True, classifier=None):
+    """
+    List a single directory with os.scandir, reusing each DirEntry's cached type
+    information instead of separate isdir/exists calls. Files are classified as
+    text or binary in one batch through the classifier, if given.
+
+    Returns a DirectoryListing.
+    """
     try:
-        entries = os.listdir(current_path)
-    except PermissionError as e:
+        # Stat before listing, so a change made during the scan shows up as a newer mtime
+        mtime_ns = os.stat(current_path).st_mtime_ns
+        with os.scandir(current_path) as it:
+            dir_entries = list(it)
+    except OSError as e:
         # Skip directories that can't be accessed
         log.error(f"Permission error: {e}")
-        return
+        return DirectoryListing([], ignore_patterns, None, None)
+
+    # Check for .gitignore in current directory
+    gitignore_mtime_ns = None
+    if use_gitignore:
+        gitignore_entry = next((entry for entry in dir_entries if entry.name == '.gitignore'), None)
+        if gitignore_entry is not None:
+            try:
+                gitignore_mtime_ns = gitignore_entry.stat().st_mtime_ns
+            except OSError:
+                pass
+            ignore_patterns = extend_ignore_patterns(current_path, ignore_patterns)
 
-    for entry in sorted(entries):
+    kept = []
+    for entry in sorted(dir_entries, key=lambda e: e.name):
         # Skip hidden files and directories
-        if entry.startswith('.'):
+        if entry.name.startswith('.'):
             continue
 
-        entry_path = os.path.join(current_path, entry)
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
 
         # Skip ignored files and directories
-        if matches_pattern(entry_path, ignore_patterns):
+        if matches_pattern(entry.path, ignore_patterns, is_dir):
             continue
+        kept.append((entry, is_dir))
+
+    files = [entry for entry, is_dir in kept if not is_dir]
+    if classifier is not None:
+        verdicts = iter(classifier.classify_batch(files))
+    else:
+        verdicts = iter([is_text_file(entry.path) for entry in files])
+
+    children = []
+    for entry, is_dir in kept:
+        attributes = {'name': entry.name}
+        if not is_dir and not next(verdicts):  # Flag non-readable files as not-text
+            attributes['text-readable'] = 'false'
+        children.append((entry.name, entry.path, is_dir, attributes))
+
+    return DirectoryListing(children, ignore_patterns, mtime_ns, gitignore_mtime_ns)
+
+def _manifest_key(path, root_path):
+    """Key of a directory in the manifest: its path relative to the repository root."""
+    return os.path.relpath(path, root_path).replace(os.sep, '/')
+
+def _manifest_entry(listing):
+    return {
+        'mtime_ns': listing.mtime_ns,
+        'gitignore_mtime_ns': listing.gitignore_mtime_ns,
+        'entries': [name for name, _, _, _ in listing.children],
+    }
+
+def add_directory_to_xml(root_element, current_path, ignore_patterns, workers=None, use_gitignore=True,
+                         classifier=None, manifest=None, root_path=None):
+    """
+    Add directories and files to the XML element, excluding those that match the
+    ignore patterns or are hidden.
 
-        # Recursively add entry to tree
-        if os.path.isdir(entry_path):
-            dir_element = ET.SubElement(root_element, 'directory', name=entry)
-            add_directory_to_xml(dir_element, entry_path, ignore_patterns)
-        else:
-            attributes = {'name': entry}
-            if not is_text_file(entry_path):  # Flag non-readable files as not-text
-                attributes['text-readable'] = 'false'
-            ET.SubElement(root_element, 'file', attributes)
+    Each directory is listed by scan_directory on a thread pool, so subdirectories
+    (and the file sniffing they need) are processed concurrently. Child elements are
+    created when their parent's listing is assembled, which keeps the tree sorted
+    regardless of the order in which scans complete.
 
-def generate_xml_tree(input_filepath=".", use_gitignore=True,
-                      output_filepath=None, output_minified=False,
-                      output_indent=2, output_overwrite=False):
+    If a manifest dict is given, each scanned directory's mtimes and entry names are
+    recorded in it, keyed by its path relative to root_path (default: current_path).
     """
-    Generate an XML tree representation of the repository at repo_path,
-    excluding files and directories specified in .gitignore files.
+    root_path = current_path if root_path is None else root_path
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(scan_directory, current_path, ignore_patterns, use_gitignore, classifier):
+                (root_element, current_path)
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                element, path = pending.pop(future)
+                listing = future.result()
+                if manifest is not None:
+                    manifest[_manifest_key(path, root_path)] = _manifest_entry(listing)
+
+                for _, entry_path, is_dir, attributes in listing.children:
+                    if is_dir:
+                        dir_element = ET.SubElement(element, 'directory', attributes)
+                        future = executor.submit(scan_directory, entry_path, listing.ignore_patterns,
+                                                 use_gitignore, classifier)
+                        pending[future] = (dir_element, entry_path)
+                    else:
+                        ET.SubElement(element, 'file', attributes)
+
+def _insert_sorted(parent, element):
+    """Insert element among parent's children, before the first sibling with a larger name."""
+    name = element.get('name', '')
+    for index, child in enumerate(parent):
+        if child.get('name', '') > name:
+            parent.insert(index, element)
+            return
+    parent.append(element)
+
+def update_directory_in_xml(dir_element, current_path, ignore_patterns, old_manifest, new_manifest,
+                            root_path, stats, workers=None, use_gitignore=True, classifier=None,
+                            force=False):
+    """
+    Bring an existing XML directory element up to date with the disk, re-listing it
+    only if its mtime (or its .gitignore's) differs from the manifest.
 
-    Parameters:
-    - input_filepath:  Path to the repository root.
-    - output_filepath: File path to save the output XML. If None, defaults to
-                       'outputs/{repo_name}/filetree.xml'.
-    - output_minified: If True, output will be minified (no indentation).
-    - output_indent:   Number of spaces to use for indentation. Default is 2.
-                       If minified is True, indent is ignored.
+    Additions and removals are computed against the entry names recorded in the
+    manifest, not against the XML, so entries deleted from the XML by hand stay
+    deleted and attributes added by hand (e.g. ignore="true") are never touched.
+    New subdirectories are scanned in full; existing ones are updated recursively.
+    """
+    key = _manifest_key(current_path, root_path)
+    previous = old_manifest.get(key)
+    try:
+        mtime_ns = os.stat(current_path).st_mtime_ns
+    except OSError as e:
+        log.error(f"Cannot access directory '{current_path}': {e}")
+        return
+    gitignore_mtime_ns = None
+    if use_gitignore:
+        try:
+            gitignore_mtime_ns = os.stat(os.path.join(current_path, '.gitignore')).st_mtime_ns
+        except OSError:
+            pass
+
+    # Changed ignore rules can affect every directory below this one
+    if previous is not None and previous['gitignore_mtime_ns'] != gitignore_mtime_ns:
+        force = True
+
+    existing = {child.get('name'): child for child in dir_element if child.tag in ('file', 'directory')}
+    skip = set()  # Directories that were just scanned in full
+
+    if force or previous is None or previous['mtime_ns'] != mtime_ns:
+        stats['relisted'] += 1
+        listing = scan_directory(current_path, ignore_patterns, use_gitignore, classifier)
+        listed = {name: is_dir for name, _, is_dir, _ in listing.children}
+        # Without a manifest entry, fall back to what the XML contains
+        known_names = set(previous['entries']) if previous is not None else set(existing)
+
+        # Drop entries that no longer exist (or are now ignored)
+        for name in known_names - set(listed):
+            if name in existing:
+                dir_element.remove(existing.pop(name))
+                stats['removed'] += 1
+
+        for name, entry_path, is_dir, attributes in listing.children:
+            tag = 'directory' if is_dir else 'file'
+            element = existing.get(name)
+            if name in known_names and (element is None or element.tag == tag):
+                continue  # Unchanged, or deleted from the XML by hand
+            if element is not None:
+                dir_element.remove(element)  # A file replaced by a directory or vice versa
+            element = ET.Element(tag, attributes)
+            _insert_sorted(dir_element, element)
+            existing[name] = element
+            stats['added'] += 1
+            if is_dir:
+                add_directory_to_xml(element, entry_path, listing.ignore_patterns, workers,
+                                     use_gitignore, classifier, new_manifest, root_path)
+                skip.add(name)
+
+        new_manifest[key] = _manifest_entry(listing)
+        child_ignore_patterns = listing.ignore_patterns
+        on_disk = set(listed)
+    else:
+        new_manifest[key] = previous
+        child_ignore_patterns = ignore_patterns
+        if gitignore_mtime_ns is not None:
+            child_ignore_patterns = extend_ignore_patterns(current_path, ignore_patterns)
+        on_disk = None
+
+    stats['directories'] += 1
+    for name, element in existing.items():
+        if element.tag != 'directory' or name in skip or (on_disk is not None and name not in on_disk):
+            continue
+        update_directory_in_xml(element, os.path.join(current_path, name), child_ignore_patterns,
+                                old_manifest, new_manifest, root_path, stats, workers, use_gitignore,
+                                classifier, force)
+
+def get_manifest_path(output_filepath):
+    """Path of the sidecar manifest for a filetree, e.g. filetree.manifest.json."""
+    return os.path.splitext(output_filepath)[0] + '.manifest.json'
+
+def load_manifest(manifest_path):
+    """Load a filetree manifest, or return None if it is missing or unreadable."""
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log.warning(f"Could not read manifest '{manifest_path}': {e}")
+        return None
+
+def save_manifest(manifest_path, root_path, use_gitignore, directories):
+    """Write the manifest of per-directory mtimes and entry names next to the filetree."""
+    manifest = {
+        'version': 1,
+        'root': root_path,
+        'use_gitignore': use_gitignore,
+        'directories': directories,
+    }
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp_path, manifest_path)
+
+def write_xml_stream(output_file, repo_name, current_path, ignore_patterns, workers=None,
+                     use_gitignore=True, classifier=None, output_indent=2, output_minified=False,
+                     manifest=None):
+    """
+    Write the XML tree to output_file while the repository is walked, instead of
+    building it in memory. The output is byte-identical to indenting the equivalent
+    ElementTree with ET.indent and writing it.
+
+    Directories are emitted depth-first. When a directory is entered, all of its
+    subdirectories are submitted for scanning, so at most the listings of the
+    directories along the current path and their direct subdirectories are held
+    in memory at once. Directories are recorded in the manifest dict, if given.
+    """
+    newline = '' if output_minified else '\n'
+    space = '' if output_minified else ' ' * output_indent
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def scan(path, patterns):
+            return executor.submit(scan_directory, path, patterns, use_gitignore, classifier)
+
+        def open_directory(tag, attributes, path, listing, depth):
+            if manifest is not None:
+                manifest[_manifest_key(path, current_path)] = _manifest_entry(listing)
+            children = listing.children
+            output_file.write(xml_start_tag(tag, attributes, empty=not children))
+            if not children:
+                return None
+            # Prefetch all subdirectories of this directory
+            futures = [scan(child_path, listing.ignore_patterns) if is_dir else None
+                       for _, child_path, is_dir, _ in children]
+            return (tag, iter(zip(children, futures)), depth)
+
+        root_frame = open_directory('repository', {'name': repo_name}, current_path,
+                                    scan(current_path, ignore_patterns).result(), 0)
+        stack = [root_frame] if root_frame else []
+        while stack:
+            tag, children, depth = stack[-1]
+            child = next(children, None)
+            if child is None:
+                # Dedent after the last child
+                output_file.write(f"{newline}{space * depth}</{tag}>")
+                stack.pop()
+                continue
+
+            (_, path, is_dir, attributes), future = child
+            output_file.write(f"{newline}{space * (depth + 1)}")
+            if is_dir:
+                frame = open_directory('directory', attributes, path, future.result(), depth + 1)
+                if frame:
+                    stack.append(frame)
+            else:
+                output_file.write(xml_start_tag('file', attributes, empty=True))
+
+def resolve_paths(input_filepath, output_filepath):
+    """
+    Return the absolute input path, the repository name and the output file path,
+    creating the output directory if needed.
     """
     # Get the repository name from the path, if repo_name is empty (in case of '.'), use 'root'
     input_filepath = os.path.abspath(input_filepath)
@@ -179,37 +683,146 @@ def generate_xml_tree(input_filepath=".", use_gitignore=True,
         output_dir = os.path.dirname(output_filepath)
         if output_dir:  # Only create if there's actually a directory path
             os.makedirs(output_dir, exist_ok=True)
+    return input_filepath, repo_name, output_filepath
+
+def confirm_overwrite(output_filepath):
+    """Ask the user whether an existing output file should be overwritten."""
+    while True:
+        response = input(f"Output file '{output_filepath}' already exists. Overwrite? (y/n): ").lower()
+        if response in ['yes', 'y']:
+            return True
+        elif response in ['no', 'n']:
+            print("Operation cancelled.")
+            return False
+        else:
+            print("Please answer 'yes/y' to overwrite or 'no/n' to cancel.")
+
+def generate_xml_tree(input_filepath=".", use_gitignore=True,
+                      output_filepath=None, output_minified=False,
+                      output_indent=2, output_overwrite=False, workers=None,
+                      sniff_cache_path=DEFAULT_SNIFF_CACHE_PATH, output_stream=False):
+    """
+    Generate an XML tree representation of the repository at repo_path,
+    excluding files and directories specified in .gitignore files.
+
+    Parameters:
+    - input_filepath:  Path to the repository root.
+    - output_filepath: File path to save the output XML. If None, defaults to
+                       'outputs/{repo_name}/filetree.xml'.
+    - output_minified: If True, output will be minified (no indentation).
+    - output_indent:   Number of spaces to use for indentation. Default is 2.
+                       If minified is True, indent is ignored.
+    - workers:         Number of threads used to scan directories. If None, uses
+                       the ThreadPoolExecutor default.
+    - sniff_cache_path: SQLite file caching text/binary verdicts between runs.
+                       If None, verdicts are not persisted.
+    - output_stream:   If True, write elements to the output file as the repository
+                       is walked instead of building the whole tree in memory.
+    """
+    input_filepath, repo_name, output_filepath = resolve_paths(input_filepath, output_filepath)
+
+    # Check if user meant to overwrite (before scanning, so streamed output isn't clobbered)
+    if os.path.exists(output_filepath) and not output_overwrite:
+        if not confirm_overwrite(output_filepath):
+            return
 
     # Initialize ignore patterns
     ignore_patterns = []
+    manifest = {}
 
-    # Create the ElementTree from the repo
-    root_element = ET.Element('repository', name=repo_name)
-    add_directory_to_xml(root_element, input_filepath, ignore_patterns)
-    xml_tree = ET.ElementTree(root_element)
+    classifier = TextFileClassifier(sniff_cache_path, workers)
+    classifier.load()
+    try:
+        if output_stream:
+            # Write elements as the walk emits them, with the same encoding ElementTree uses
+            with open(output_filepath, 'w', encoding='utf-8', errors='xmlcharrefreplace',
+                      newline='\n') as output_file:
+                write_xml_stream(output_file, repo_name, input_filepath, ignore_patterns, workers,
+                                 use_gitignore, classifier, output_indent, output_minified, manifest)
+        else:
+            # Create the ElementTree from the repo
+            root_element = ET.Element('repository', name=repo_name)
+            add_directory_to_xml(root_element, input_filepath, ignore_patterns, workers, use_gitignore,
+                                 classifier, manifest)
+    finally:
+        classifier.close()
+    classifier.save()
+    log.info(f"Classified files: {classifier.stats['extension']} by extension, "
+             f"{classifier.stats['cached']} from cache, {classifier.stats['sniffed']} sniffed")
+
+    if not output_stream:
+        xml_tree = ET.ElementTree(root_element)
+
+        # Indent filetree
+        if not output_minified:
+            indent_xml_filetree(xml_tree, root_element, output_indent)
+        else:  # Minified output, remove any whitespace
+            pass  # No action needed, default output is minified
+
+        # Write the tree to a file with XML declaration
+        xml_tree.write(output_filepath, encoding='utf-8', xml_declaration=False)
+    save_manifest(get_manifest_path(output_filepath), input_filepath, use_gitignore, manifest)
+    print(f"XML tree has been saved to {output_filepath}")
+
+def update_xml_tree(input_filepath=".", use_gitignore=True,
+                    output_filepath=None, output_minified=False,
+                    output_indent=2, workers=None,
+                    sniff_cache_path=DEFAULT_SNIFF_CACHE_PATH):
+    """
+    Refresh an existing XML filetree in place instead of rescanning from scratch.
+
+    Only directories whose mtime changed since the last scan (according to the sidecar
+    manifest written next to the filetree) are listed again. Additions and removals are
+    merged into the existing tree, keeping hand edits such as ignore="true" marks and
+    deleted entries. Parameters are the same as for generate_xml_tree.
+    """
+    input_filepath, repo_name, output_filepath = resolve_paths(input_filepath, output_filepath)
+    if not os.path.exists(output_filepath):
+        log.warning(f"No filetree at '{output_filepath}' to update, generating a new one")
+        generate_xml_tree(input_filepath, use_gitignore, output_filepath, output_minified,
+                          output_indent, True, workers, sniff_cache_path)
+        return
 
-    # Indent filetree
+    xml_tree = ET.parse(output_filepath)
+    root_element = xml_tree.getroot()
+
+    manifest_path = get_manifest_path(output_filepath)
+    manifest = load_manifest(manifest_path) if os.path.exists(manifest_path) else None
+    force = False
+    if manifest is None:
+        log.warning("No manifest found, comparing against the filetree itself "
+                    "(entries deleted from it by hand will be added back)")
+        old_directories = {}
+    else:
+        old_directories = manifest['directories']
+        # Different ignore settings change every listing
+        force = manifest.get('use_gitignore') != use_gitignore
+
+    new_directories = {}
+    stats = {'directories': 0, 'relisted': 0, 'added': 0, 'removed': 0}
+    classifier = TextFileClassifier(sniff_cache_path, workers)
+    classifier.load()
+    try:
+        update_directory_in_xml(root_element, input_filepath, [], old_directories, new_directories,
+                                input_filepath, stats, workers, use_gitignore, classifier, force)
+    finally:
+        classifier.close()
+    classifier.save()
+
+    # Reset whitespace from the parsed file before re-indenting around new elements
+    for element in root_element.iter():
+        if element.text is not None and not element.text.strip():
+            element.text = None
+        if element.tail is not None and not element.tail.strip():
+            element.tail = None
     if not output_minified:
         indent_xml_filetree(xml_tree, root_element, output_indent)
-    else:  # Minified output, remove any whitespace
-        pass  # No action needed, default output is minified
-
-    # Check if user meant to overwrite
-    if os.path.exists(output_filepath):
-        if not output_overwrite:
-            while True:
-                response = input(f"Output file '{output_filepath}' already exists. Overwrite? (y/n): ").lower()
-                if response in ['yes', 'y']:
-                    break
-                elif response in ['no', 'n']:
-                    print("Operation cancelled.")
-                    return
-                else:
-                    print("Please answer 'yes/y' to overwrite or 'no/n' to cancel.")
-
-    # Write the tree to a file with XML declaration
+
     xml_tree.write(output_filepath, encoding='utf-8', xml_declaration=False)
-    print(f"XML tree has been saved to {output_filepath}")
+    save_manifest(manifest_path, input_filepath, use_gitignore, new_directories)
+    print(f"Re-listed {stats['relisted']} of {stats['directories']} directories: "
+          f"{stats['added']} entries added, {stats['removed']} removed")
+    print(f"XML tree has been updated at {output_filepath}")
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -241,18 +854,55 @@ def parse_arguments():
                       action='store_true',
                       help='Overwrite output file if it exists')
 
+    parser.add_argument('-w', '--workers',
+                      type=int,
+                      default=None,
+                      help='Number of threads used to scan directories (defaults to min(32, cpu_count + 4))')
+
+    parser.add_argument('--stream',
+                      action='store_true',
+                      help='Write the XML while scanning instead of building it in memory (for very large repos)')
+
+    parser.add_argument('-u', '--update',
+                      action='store_true',
+                      help='Update an existing filetree in place, re-listing only changed directories '
+                           'and keeping hand edits (ignore marks, deleted entries)')
+
+    parser.add_argument('--no-sniff-cache',
+                      action='store_true',
+                      help=f'Do not persist text/binary verdicts in {DEFAULT_SNIFF_CACHE_PATH}')
+
     args = parser.parse_args()
 
     # Validate tab size
     if args.tab_size <= 0:
         parser.error("Tab size must be greater than 0")
 
+    if args.update and args.stream:
+        parser.error("--update cannot be combined with --stream")
+
+    # Validate worker count
+    if args.workers is not None and args.workers <= 0:
+        parser.error("Number of workers must be greater than 0")
+
     return args
 
 def main():
     """Main function to handle argument parsing and XML tree generation."""
     args = parse_arguments()
 
+    if args.update:
+        update_xml_tree(
+            input_filepath   = args.input,
+            use_gitignore    = not args.no_ignore,
+            output_filepath  = args.output,
+            output_minified  = args.minified,
+            output_indent    = args.tab_size,
+            workers          = args.workers,
+            sniff_cache_path = None if args.no_sniff_cache else DEFAULT_SNIFF_CACHE_PATH
+        )
+        return
+
     # Generate XML tree with provided arguments
     generate_xml_tree(
         input_filepath   = args.input,
@@ -260,7 +910,10 @@ def main():
         output_filepath  = args.output,
         output_minified  = args.minified,
         output_indent    = args.tab_size,
-        output_overwrite = args.overwrite
+        output_overwrite = args.overwrite,
+        workers          = args.workers,
+        sniff_cache_path = None if args.no_sniff_cache else DEFAULT_SNIFF_CACHE_PATH,
+        output_stream    = args.stream
     )
 
 if __name__ == "__main__":
@@ -1,9 +1,13 @@
-import tiktoken
 import os
 import argparse
 import xml.etree.ElementTree as ET
 import statistics
-from utils import log
+from concurrent.futures import ThreadPoolExecutor
+from utils import log, load_encoding
+from token_cache import TokenCountCache
+
+# Files read and encoded per call to encode_batch
+TOKENIZE_BATCH_SIZE = 256
 
 def is_ignored(element):
     """
@@ -21,9 +25,56 @@ def count_tokens(text, encoding):
     tokens = encoding.encode(text, allowed_special={'<|endoftext|>'})
     return len(tokens)
 
-def traverse_xml(element, current_path, stats, thresholds, encoding):
+def read_file(file_path):
+    """
+    Read a file as text, returning None (after reporting the error) if it can't be read.
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read()
+    except Exception as e:
+        print(f"Error reading file '{file_path}': {e}")
+        return None
+
+def count_file_tokens(file_paths, encoding, jobs):
+    """
+    Count the tokens of each file, in order, with None for files that can't be read or
+    encoded. Files are read by a pool of `jobs` threads and encoded in batches with
+    encode_batch, which tokenizes on `jobs` threads outside the GIL.
+    """
+    counts = []
+    batches = [file_paths[start:start + TOKENIZE_BATCH_SIZE]
+               for start in range(0, len(file_paths), TOKENIZE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Read one batch ahead of the one being encoded, so only two batches are in memory
+        reads = [executor.submit(read_file, path) for path in batches[0]] if batches else []
+        for index, batch_paths in enumerate(batches):
+            batch = [future.result() for future in reads]
+            if index + 1 < len(batches):
+                reads = [executor.submit(read_file, path) for path in batches[index + 1]]
+            texts = [text for text in batch if text is not None]
+            try:
+                batch_counts = iter([len(tokens) for tokens in encoding.encode_batch(
+                    texts, num_threads=jobs, allowed_special={'<|endoftext|>'})])
+            except Exception:
+                batch_counts = None  # e.g. a disallowed special token: retry file by file to find it
+            for file_path, text in zip(batch_paths, batch):
+                if text is None:
+                    counts.append(None)
+                elif batch_counts is not None:
+                    counts.append(next(batch_counts))
+                else:
+                    try:
+                        counts.append(count_tokens(text, encoding))
+                    except Exception as e:
+                        print(f"Error reading file '{file_path}': {e}")
+                        counts.append(None)
+    return counts
+
+def traverse_xml(element, current_path, stats, thresholds, file_paths):
     """
-    Recursively traverse the XML tree, updating stats accordingly.
+    Recursively traverse the XML tree, updating stats accordingly. Paths of files whose
+    tokens should be counted are appended to file_paths, in filetree order.
     """
     if is_ignored(element) or is_not_text_readable(element):
         return
@@ -39,23 +90,8 @@ def traverse_xml(element, current_path, stats, thresholds, encoding):
         ext = ext.lower()
         stats['file_types'][ext] = stats['file_types'].get(ext, 0) + 1
 
-        if os.path.exists(file_path):
-            try:
-                if element.get('text-readable', 'true').lower() == 'true':
-                    try:
-                        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                            content = f.read()
-                        content_token_count = count_tokens(content, encoding)
-                        stats['file_content_token_count'] += content_token_count
-                        # Store tuple of (token_count, file_path)
-                        stats['file_content_token_counts'].append((content_token_count, file_path))
-                    except Exception as e:
-                        print(f"Error reading file '{file_path}': {e}")
-                else:
-                    # Non-text-readable file
-                    pass
-            except Exception as e:
-                log.error(f"Error accessing file '{file_path}': {e}")
+        if os.path.exists(file_path) and element.get('text-readable', 'true').lower() == 'true':
+            file_paths.append(file_path)
 
     elif element.tag == 'directory' or element.tag == 'repository':
         # Handle directories and the root 'repository' element
@@ -76,7 +112,7 @@ def traverse_xml(element, current_path, stats, thresholds, encoding):
 
         # Recursively traverse children
         for child in element:
-            traverse_xml(child, dir_path, stats, thresholds, encoding)
+            traverse_xml(child, dir_path, stats, thresholds, file_paths)
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Get information about the XML filetree.')
@@ -91,6 +127,10 @@ def parse_arguments():
                         help='Thresholds (in tokens) for large file warnings.')
     parser.add_argument('--encoding-name', default='o200k_base',
                         help='The tiktoken encoding name to use for tokenization (default: o200k_base).')
+    parser.add_argument('--no-token-cache', action='store_true',
+                        help='Tokenize every file instead of reusing counts of unchanged files.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of threads reading and tokenizing files (default: number of CPUs).')
     args = parser.parse_args()
     return args
 
@@ -105,11 +145,8 @@ def main():
         log.error(f"Base directory '{args.directory}' does not exist or is not a directory.")
         return
 
-    # Initialize tiktoken encoding
-    try:
-        encoding = tiktoken.get_encoding(args.encoding_name)
-    except Exception as e:
-        log.error(f"Error initializing tiktoken encoding '{args.encoding_name}': {e}")
+    if args.jobs < 1:
+        log.error("Jobs must be at least 1.")
         return
 
     # Parse the XML filetree
@@ -129,10 +166,39 @@ def main():
         'large_file_thresholds': sorted(args.large_file_thresholds),
     }
 
-    # Start traversal from the root element
-    traverse_xml(root, args.directory, stats, thresholds, encoding)
+    # Start traversal from the root element, then count the tokens of the files found
+    file_paths = []
+    traverse_xml(root, args.directory, stats, thresholds, file_paths)
 
-    # Print statistics
+    def count_uncached(paths):
+        # The encoding is only loaded if some files are not in the token count cache
+        return count_file_tokens(paths, load_encoding(args.encoding_name), args.jobs)
+
+    try:
+        if args.no_token_cache:
+            token_counts = count_uncached(file_paths)
+        else:
+            token_cache = TokenCountCache()
+            token_counts = token_cache.count_files(file_paths, args.encoding_name, count_uncached)
+            token_cache.log_stats()
+            token_cache.close()
+    except Exception as e:
+        log.error(f"Error initializing tiktoken encoding '{args.encoding_name}': {e}")
+        return
+    for file_path, content_token_count in zip(file_paths, token_counts):
+        if content_token_count is None:
+            continue
+        stats['file_content_token_count'] += content_token_count
+        # Store tuple of (token_count, file_path)
+        stats['file_content_token_counts'].append((content_token_count, file_path))
+
+    print_statistics(stats)
+
+def print_statistics(stats):
+    """
+    Print the totals, token statistics, largest files and file type distribution
+    gathered by traverse_xml and the token counts.
+    """
     print("\n=== Statistics ===")
     print(f"Total files: {stats['total_files']}")
     print(f"Total directories: {stats['total_directories']}")
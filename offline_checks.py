@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import tempfile
+import sqlite3
+import subprocess
+import xml.etree.ElementTree as ET
+from types import SimpleNamespace
+from typing import Callable, Dict
+from utils import log, RateLimiter
+
+
+class StubRateLimitError(Exception):
+    """Looks like the SDK's 429 error to the rate limiter: status code and retry-after header"""
+    status_code = 429
+
+    def __init__(self, retry_after: float = 0.01):
+        super().__init__("Stub rate limit")
+        self.response = SimpleNamespace(headers={'retry-after': str(retry_after)})
+
+
+def stub_request(failures: int) -> Callable:
+    """A request that is rate limited `failures` times, then succeeds with a usage report"""
+    calls = {'count': 0}
+
+    async def make_request():
+        calls['count'] += 1
+        if calls['count'] <= failures:
+            raise StubRateLimitError()
+        return SimpleNamespace(text='ok', usage=SimpleNamespace(input_tokens=10, output_tokens=5))
+
+    make_request.calls = calls
+    return make_request
+
+
+async def check_rate_limiter() -> None:
+    """RateLimiter.call retries 429s with backoff, halves concurrency, and gives up after max_retries"""
+    limiter = RateLimiter(requests_per_minute=6000, input_tokens_per_minute=100_000, max_concurrency=8,
+                          max_retries=3, base_backoff=0.01, max_backoff=0.05, encoding_name='unused')
+    make_request = stub_request(failures=3)
+    result = await limiter.call(make_request, input_tokens=100, output_tokens=50)
+    assert result.text == 'ok', result
+    assert make_request.calls['count'] == 4, make_request.calls
+    assert limiter.stats == {'requests': 4, 'rate_limited': 3, 'retries': 3, 'failures': 0}, limiter.stats
+    assert limiter.concurrency == 2, limiter.concurrency  # 8 halved three times, then one success
+    assert limiter.in_flight == 0, limiter.in_flight
+
+    make_request = stub_request(failures=10)
+    try:
+        await limiter.call(make_request, input_tokens=100, output_tokens=50)
+    except StubRateLimitError:
+        pass
+    else:
+        raise AssertionError("Expected the rate limit error once retries ran out")
+    assert make_request.calls['count'] == 4, make_request.calls
+    assert limiter.stats['failures'] == 1, limiter.stats
+    assert limiter.in_flight == 0, limiter.in_flight
+
+    # Concurrent requests all get through a limiter that keeps being rate limited
+    requests = [stub_request(failures=1) for _ in range(20)]
+    results = await asyncio.gather(*(limiter.call(request, 100, 50) for request in requests))
+    assert all(result.text == 'ok' for result in results)
+    assert limiter.in_flight == 0, limiter.in_flight
+
+
+async def check_batch() -> None:
+    """The batch path stores what a fake batch API returns, and a re-run only resubmits the failures"""
+    from batches import FakeBatchClient
+    from summary_store import SummaryStore, FILE_SUMMARY
+    from enrich_filetree import process_filetree_batch, BATCH_STATE_FILENAME
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        ft_root = ET.Element('repository', name='repo')
+        for i in range(12):
+            with open(os.path.join(root_dir, f"f{i}.py"), 'w', encoding='utf-8') as f:
+                f.write(f"X = {i}\n")
+            ET.SubElement(ft_root, 'file', name=f"f{i}.py")
+        output_dir = os.path.join(root_dir, 'output')
+        os.makedirs(output_dir)
+        store = SummaryStore(os.path.join(output_dir, 'summaries.db'))
+        try:
+            batch_client = FakeBatchClient(polls_to_end=2, error_ratio=0.25, seed=1)
+            await process_filetree_batch(ft_root, root_dir, root_dir, store, 'repo', False, batch_client,
+                                         batch_size=5, poll_interval=0)
+            assert len(batch_client.batches) == 3, batch_client.batches
+            failed = sum(1 for batch in batch_client.batches.values()
+                         for _, text, _ in batch['results'] if text is None)
+            assert 0 < failed < 12, failed
+            assert len(store) == 12 - failed, len(store)
+            assert 'Placeholder summary' in store.get(FILE_SUMMARY, next(iter(store.items()))[1])
+
+            # The saved batches have all been collected, so only the failed files are submitted again
+            batch_client = FakeBatchClient()
+            await process_filetree_batch(ft_root, root_dir, root_dir, store, 'repo', False, batch_client,
+                                         batch_size=5, poll_interval=0)
+            submitted = sum(len(batch['results']) for batch in batch_client.batches.values())
+            assert submitted == failed, (submitted, failed)
+            assert len(store) == 12, len(store)
+            assert os.path.exists(os.path.join(output_dir, BATCH_STATE_FILENAME))
+        finally:
+            store.close()
+
+
+async def check_work_queue() -> None:
+    """Failed jobs are handed back until max_attempts, then unblock their parent and finish the queue"""
+    from work_queue import WorkQueue, QueueJob, PENDING, FAILED
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        work_queue = WorkQueue(os.path.join(output_dir, 'work_queue.sqlite'))
+        try:
+            work_queue.seed([QueueJob('file', 'a.py', '', 1), QueueJob('file', 'b.py', '', 2),
+                             QueueJob('directory', '', None, 0)])
+            job = work_queue.claim('w1', lease_seconds=60)
+            assert job.path == 'a.py', job
+            assert work_queue.fail(job, 'w1', max_attempts=2, retry_delay=60) == PENDING
+            # Held back for the retry delay, so the next claim skips it
+            assert work_queue.claim('w1', lease_seconds=60).path == 'b.py'
+            assert work_queue.claim('w1', lease_seconds=60) is None
+            work_queue.complete(QueueJob('file', 'b.py', '', 2))
+
+            assert work_queue.fail(job, 'w1', max_attempts=2) is None  # No longer leased by w1
+            work_queue.conn.execute('UPDATE jobs SET lease_expires = 0 WHERE path = ?', ('a.py',))
+            job = work_queue.claim('w2', lease_seconds=60)
+            assert job.path == 'a.py', job
+            assert work_queue.fail(job, 'w2', max_attempts=2) == FAILED  # Second attempt: gives up
+            assert [failed.path for failed in work_queue.failed()] == ['a.py']
+
+            # The directory is unblocked without its failed child, and the queue finishes
+            assert work_queue.counts().get(PENDING) == 1, work_queue.counts()
+            directory = work_queue.claim('w2', lease_seconds=60)
+            assert directory.kind == 'directory', directory
+            work_queue.complete(directory)
+            assert work_queue.is_finished()
+            assert work_queue.counts() == {'done': 2, FAILED: 1}, work_queue.counts()
+            # A new run replaces a finished one, failures included
+            assert work_queue.seed([QueueJob('file', 'a.py', None, 1)])
+        finally:
+            work_queue.close()
+
+
+async def check_work_queue_processes() -> None:
+    """A coordinator and two workers started as processes share a run on a mock provider and finish it"""
+    from work_queue import WORK_QUEUE_FILENAME, DONE
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as work_dir:
+        root_dir = os.path.join(work_dir, 'repo')
+        ft_root = ET.Element('repository', name='repo')
+        for d in range(3):
+            dir_element = ET.SubElement(ft_root, 'directory', name=f"d{d}")
+            os.makedirs(os.path.join(root_dir, f"d{d}"))
+            for i in range(8):
+                with open(os.path.join(root_dir, f"d{d}", f"f{i}.py"), 'w', encoding='utf-8') as f:
+                    f.write(f"X = {i}\n")
+                ET.SubElement(dir_element, 'file', name=f"f{i}.py")
+        filetree_path = os.path.join(work_dir, 'filetree.xml')
+        ET.ElementTree(ft_root).write(filetree_path)
+        routes_path = os.path.join(work_dir, 'routes.json')
+        with open(routes_path, 'w', encoding='utf-8') as f:
+            json.dump({'providers': {'mock': {'type': 'mock', 'latency': 0.2, 'error_ratio': 0.1}},
+                       'routes': [{'name': 'default', 'provider': 'mock', 'model': 'mock-model'}]}, f)
+        output_dir = os.path.join(work_dir, 'output')
+
+        command = [sys.executable, os.path.join(package_dir, 'enrich_filetree.py'), '-f', filetree_path,
+                   '-d', root_dir, '-o', output_dir, '--routes', routes_path, '--no-summary-cache',
+                   '-s', '2', '--max-attempts', '10']
+        # The workers start first and wait for the coordinator to fill the queue
+        processes = [subprocess.Popen(command + ['--worker'], cwd=package_dir, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL) for _ in range(2)]
+        await asyncio.sleep(1)
+        processes.append(subprocess.Popen(command + ['--coordinator'], cwd=package_dir,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        try:
+            for process in processes:
+                assert await asyncio.to_thread(process.wait, 120) == 0, process.args[-1]
+        finally:
+            for process in processes:
+                process.kill()
+
+        conn = sqlite3.connect(os.path.join(output_dir, WORK_QUEUE_FILENAME))
+        try:
+            states = dict(conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+            workers = [row[0] for row in conn.execute('SELECT DISTINCT worker FROM jobs')]
+        finally:
+            conn.close()
+        assert states == {DONE: 28}, states  # 24 files, 3 directories and the root
+        assert len(workers) > 1, workers
+        assert os.path.exists(os.path.join(output_dir, 'enriched_filetree.xml'))
+
+
+CHECKS: Dict[str, Callable] = {
+    'rate-limiter': check_rate_limiter,
+    'batch': check_batch,
+    'work-queue': check_work_queue,
+    'work-queue-processes': check_work_queue_processes,
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Check request handling offline, against stubs instead of a provider.')
+    parser.add_argument('checks', nargs='*',
+                        help=f"Checks to run, among {', '.join(sorted(CHECKS))} (default: all)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the log output of the code under check')
+    args = parser.parse_args()
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"Unknown checks: {', '.join(unknown)}")
+    return args
+
+
+def main():
+    args = parse_arguments()
+    if not args.verbose:
+        log.setLevel(logging.CRITICAL)  # The stubs trigger warnings and errors (rate limits, failed requests) on purpose
+    failed = []
+    for name in args.checks or sorted(CHECKS):
+        try:
+            asyncio.run(CHECKS[name]())
+            print(f"{name}: ok")
+        except Exception as e:
+            print(f"{name}: FAILED: {e!r}")
+            failed.append(name)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import io
+import os
+import asyncio
+import argparse
+import xml.etree.ElementTree as ET
+from typing import Optional, List, Dict, Iterator, NamedTuple, Tuple
+from utils import log, load_encoding, indent_xml_filetree, DEFAULT_ENCODING_NAME
+from generate_xml_filetree import (
+    TextFileClassifier,
+    BINARY_EXTENSIONS,
+    DEFAULT_SNIFF_CACHE_PATH,
+    looks_like_text,
+    add_directory_to_xml,
+    resolve_paths,
+    get_manifest_path,
+    save_manifest
+)
+from get_input_tokens_info import traverse_xml, print_statistics, count_tokens, is_ignored, is_not_text_readable
+from token_cache import TokenCountCache
+from enrich_filetree import FileText, add_enrichment_arguments, validate_enrichment_arguments, run_enrichment
+
+# Stages of the pipeline, in order
+STAGES = ('scan', 'filter', 'summarize')
+# File contents kept in memory between reading a file and summarizing it
+DEFAULT_CONTENT_BUDGET_MB = 256
+
+
+class FileContents(NamedTuple):
+    """
+    A file read once: its text, its token count, whether the text is exactly what
+    enrichment reads, and its size in bytes
+    """
+    text: str
+    tokens: Optional[int]
+    exact: bool
+    size: int
+
+
+def decode_file_contents(data: bytes) -> Tuple[str, bool]:
+    """
+    Decode file bytes the way read_file_to_text does (locale encoding, universal
+    newlines), so summaries and their cache keys match. Undecodable files fall back
+    to UTF-8 with errors ignored, like get_input_tokens_info, and are flagged as inexact.
+    """
+    try:
+        return io.TextIOWrapper(io.BytesIO(data)).read(), True
+    except UnicodeDecodeError:
+        text = data.decode('utf-8', errors='ignore')
+        return text.replace('\r\n', '\n').replace('\r', '\n'), False
+
+
+def read_file_contents(file_path: str, encoding, sample_size: Optional[int] = None) -> Optional[FileContents]:
+    """
+    Read, decode and tokenize a file in one pass. With a sample_size, the first bytes
+    are sniffed with looks_like_text first and None is returned for binary files
+    without reading the rest. None is also returned if the file can't be read.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            if sample_size is None:
+                data = f.read()
+            else:
+                data = f.read(sample_size)
+                if not looks_like_text(data):
+                    return None
+                data += f.read()
+    except (IOError, OSError) as e:
+        log.error(f"Error reading file '{file_path}': {e}")
+        return None
+    text, exact = decode_file_contents(data)
+    try:
+        tokens = count_tokens(text, encoding)
+    except Exception as e:
+        log.error(f"Error tokenizing file '{file_path}': {e}")
+        tokens = None
+    return FileContents(text, tokens, exact, len(data))
+
+
+class ReadingClassifier(TextFileClassifier):
+    """
+    A TextFileClassifier that reads text files whole once their first sample_size
+    bytes look like text, and counts their tokens on the same thread. The contents are
+    held for summarization until content_budget bytes (of the files on disk) are held;
+    files beyond it are read again when summarized.
+
+    Files with a cached binary verdict (or a binary extension) are still never opened.
+    Files with a cached text verdict are read anyway, since their tokens are needed.
+    With read_contents False (nothing will be counted or summarized), files are only
+    sniffed, like TextFileClassifier does.
+    """
+
+    def __init__(self, cache_path=DEFAULT_SNIFF_CACHE_PATH, workers=None, sample_size=8192,
+                 encoding_name: str = DEFAULT_ENCODING_NAME,
+                 content_budget: int = DEFAULT_CONTENT_BUDGET_MB * 1024 * 1024,
+                 read_contents: bool = True):
+        super().__init__(cache_path, workers, sample_size)
+        self.encoding_name = encoding_name
+        self.content_budget = content_budget
+        self.read_contents = read_contents
+        self.held_bytes = 0
+        self.held_sizes: Dict[str, int] = {}
+        self.contents: Dict[str, FileText] = {}
+        self.token_counts: Dict[str, Optional[int]] = {}
+        self.stats.update(read=0, over_budget=0)
+
+    def read(self, file_path: str, sniff: bool = True) -> bool:
+        """Read one file, record its token count and hold its text if it fits; False if it isn't text"""
+        contents = read_file_contents(file_path, load_encoding(self.encoding_name),
+                                      self.sample_size if sniff else None)
+        if contents is None:
+            return False
+        with self.lock:
+            self.stats['read'] += 1
+            self.token_counts[file_path] = contents.tokens
+            if not contents.exact:
+                return True  # Enrichment reads it again and reports the decoding error
+            if self.held_bytes + contents.size > self.content_budget:
+                self.stats['over_budget'] += 1
+                return True
+            self.held_bytes += contents.size
+            self.held_sizes[file_path] = contents.size
+            # Summaries estimate tokens with the default encoding only
+            tokens = contents.tokens if self.encoding_name == DEFAULT_ENCODING_NAME else None
+            self.contents[file_path] = FileText(contents.text, tokens)
+        return True
+
+    def read_files(self, file_paths: List[str]) -> None:
+        """Read files already known to be text (e.g. listed in a filetree from disk), concurrently"""
+        list(self.executor.map(self.read, file_paths, [False] * len(file_paths)))
+
+    def release(self, file_path: str) -> None:
+        """Stop holding the contents of a file that won't be summarized"""
+        with self.lock:
+            if self.contents.pop(file_path, None) is not None:
+                self.held_bytes -= self.held_sizes.pop(file_path)
+
+    def classify_batch(self, entries):
+        """
+        Classify a batch of os.DirEntry objects like TextFileClassifier, reading each
+        text file whole on the classifier's thread pool instead of only sniffing it.
+        Verdicts and stats are merged under the lock, as in TextFileClassifier.
+        """
+        if not self.read_contents:
+            return super().classify_batch(entries)
+        results = [None] * len(entries)
+        to_read = []
+        counts = {'extension': 0, 'cached': 0, 'sniffed': 0}
+        new_verdicts = {}
+        for i, entry in enumerate(entries):
+            try:
+                st = entry.stat()
+            except OSError:
+                results[i] = False
+                continue
+            if os.path.splitext(entry.name)[1].lower() in BINARY_EXTENSIONS and st.st_size > 0:
+                counts['extension'] += 1
+                results[i] = False
+                continue
+            key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            with self.lock:
+                cached = self.verdicts.get(key)
+            if cached is False:
+                counts['cached'] += 1
+                new_verdicts[key] = cached  # Refresh last_seen
+                results[i] = False
+                continue
+            to_read.append((i, key, entry.path, cached is not None))
+
+        if to_read:
+            # Files with a cached text verdict are not sniffed again
+            verdicts = self.executor.map(self.read, [path for _, _, path, _ in to_read],
+                                         [not cached for _, _, _, cached in to_read])
+            for (i, key, _, cached), text in zip(to_read, verdicts):
+                counts['cached' if cached else 'sniffed'] += 1
+                new_verdicts[key] = text
+                results[i] = text
+        with self.lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+            self.verdicts.update(new_verdicts)
+            self.new_verdicts.update(new_verdicts)
+        return results
+
+
+def iter_file_elements(element: ET.Element, current_path: str) -> Iterator[Tuple[str, ET.Element]]:
+    """Paths and elements of the files that aren't ignored or flagged as not text-readable, in filetree order"""
+    for child in element:
+        if is_ignored(child) or is_not_text_readable(child):
+            continue
+        if child.tag == 'file':
+            yield os.path.join(current_path, child.get('name')), child
+        elif child.tag == 'directory':
+            yield from iter_file_elements(child, os.path.join(current_path, child.get('name')))
+
+
+def write_checkpoint(root: ET.Element, filetree_path: str, indent: int = 2) -> None:
+    """Write the in-memory filetree to disk, so it can be inspected or trimmed by hand"""
+    copy = ET.fromstring(ET.tostring(root))
+    tree = ET.ElementTree(copy)
+    indent_xml_filetree(tree, copy, indent)
+    tree.write(filetree_path, encoding='utf-8', xml_declaration=False)
+    log.info(f"Checkpoint written to {filetree_path}")
+
+
+def scan_stage(repo_dir: str, use_gitignore: bool, reader: ReadingClassifier,
+               workers: Optional[int]) -> Tuple[ET.Element, Dict[str, dict]]:
+    """List the repository into an in-memory filetree, reading every text file once on the way"""
+    root = ET.Element('repository', name=os.path.basename(repo_dir))
+    manifest = {}
+    reader.load()
+    add_directory_to_xml(root, repo_dir, [], workers, use_gitignore, reader, manifest)
+    reader.save()
+    log.info(f"Classified files: {reader.stats['extension']} by extension, {reader.stats['cached']} from cache, "
+             f"{reader.stats['sniffed']} sniffed; {reader.stats['read']} text files read")
+    return root, manifest
+
+
+def filter_stage(root: ET.Element, repo_dir: str, reader: ReadingClassifier, args: argparse.Namespace) -> int:
+    """
+    Count the tokens of every file to summarize (reading only files the scan didn't),
+    mark files above --max-file-tokens as ignored, print the statistics and release
+    the contents of files that won't be summarized. Returns the number of files left.
+    """
+    files = list(iter_file_elements(root, repo_dir))
+    unread = [file_path for file_path, _ in files if file_path not in reader.token_counts]
+    if unread:
+        log.info(f"Reading {len(unread)} files listed in the filetree")
+        reader.read_files(unread)
+
+    if args.max_file_tokens is not None:
+        for file_path, element in files:
+            tokens = reader.token_counts.get(file_path)
+            if tokens is not None and tokens > args.max_file_tokens:
+                element.set('ignore', 'true')
+                log.info(f"Ignoring '{file_path}' ({tokens:,} tokens)")
+
+    stats = {
+        'total_files': 0,
+        'total_directories': 0,
+        'file_content_token_count': 0,
+        'file_types': {},
+        'file_content_token_counts': [],
+    }
+    thresholds = {
+        'dir_items_threshold': args.dir_items_threshold,
+        'large_file_thresholds': sorted(args.large_file_thresholds),
+    }
+    file_paths = []
+    traverse_xml(root, repo_dir, stats, thresholds, file_paths)
+    for file_path in file_paths:
+        tokens = reader.token_counts.get(file_path)
+        if tokens is not None:
+            stats['file_content_token_count'] += tokens
+            stats['file_content_token_counts'].append((tokens, file_path))
+    print_statistics(stats)
+
+    # Share the counts with get_input_tokens_info.py and quick_token_count.py
+    if not args.no_token_cache:
+        token_cache = TokenCountCache()
+        keys = {file_path: TokenCountCache.file_key(file_path, args.encoding_name) for file_path in file_paths}
+        token_cache.put_many({key: reader.token_counts[file_path] for file_path, key in keys.items()
+                              if key is not None and reader.token_counts.get(file_path) is not None})
+        token_cache.close()
+
+    kept = set(file_paths)
+    for file_path in list(reader.contents):
+        if file_path not in kept:
+            reader.release(file_path)
+    return len(file_paths)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Scan a repository, count its tokens and summarize it in one pass, reading each file once.')
+    parser.add_argument('-d', '--directory', required=True,
+                        help='Base directory path of the repository.')
+    parser.add_argument('-f', '--filetree-path',
+                        help='Start from this (e.g. hand-trimmed) filetree instead of scanning the repository.')
+    parser.add_argument('--filetree-output',
+                        help='Where checkpoints of the filetree are written '
+                             '(default: the -f filetree, or outputs/repo_name/filetree.xml)')
+    parser.add_argument('-o', '--output',
+                        help='Output directory path (default: outputs/repo_name/summaries)')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='Write the filetree (and its manifest) to disk after the scan and filter stages.')
+    parser.add_argument('--stop-after', choices=STAGES[:-1],
+                        help='Stop after this stage, writing a checkpoint to trim by hand before resuming with -f.')
+    parser.add_argument('--no-ignore', action='store_true',
+                        help='Do not respect .gitignore patterns when scanning')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of threads scanning directories and reading files '
+                             '(defaults to min(32, cpu_count + 4))')
+    parser.add_argument('--no-sniff-cache', action='store_true',
+                        help=f'Do not persist text/binary verdicts in {DEFAULT_SNIFF_CACHE_PATH}')
+    parser.add_argument('--encoding-name', default=DEFAULT_ENCODING_NAME,
+                        help=f'The tiktoken encoding name to use for tokenization (default: {DEFAULT_ENCODING_NAME}).')
+    parser.add_argument('--no-token-cache', action='store_true',
+                        help='Do not store the token counts for get_input_tokens_info.py.')
+    parser.add_argument('--dir-items-threshold', type=int, default=100,
+                        help='Threshold for number of direct items in a directory to issue a warning.')
+    parser.add_argument('--large-file-thresholds', nargs='*', type=int, default=[50_000, 100_000],
+                        help='Thresholds (in tokens) for large file warnings.')
+    parser.add_argument('--max-file-tokens', type=int, default=None,
+                        help='Mark files with more tokens than this as ignored before summarizing.')
+    parser.add_argument('--content-budget-mb', type=float, default=DEFAULT_CONTENT_BUDGET_MB,
+                        help='File contents held in memory between reading and summarizing; files beyond it are '
+                             f'read again when summarized (default: {DEFAULT_CONTENT_BUDGET_MB})')
+    add_enrichment_arguments(parser)
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_arguments()
+
+    # Validate inputs
+    if not os.path.isdir(args.directory):
+        raise NotADirectoryError(f"Directory not found: {args.directory}")
+    if args.filetree_path and not os.path.exists(args.filetree_path):
+        raise FileNotFoundError(f"Filetree file not found: {args.filetree_path}")
+    if args.workers is not None and args.workers < 1:
+        raise ValueError("Number of workers must be at least 1")
+    if args.content_budget_mb < 0:
+        raise ValueError("Content budget can't be negative")
+    if args.stop_after is None:
+        validate_enrichment_arguments(args)
+
+    # Every stage uses the same absolute paths, which are the keys of the held contents
+    repo_dir = os.path.abspath(args.directory)
+    repo_name = os.path.basename(repo_dir)
+    checkpoint = args.checkpoint or args.stop_after is not None
+    # Contents are only reused by interactive single-process summaries, and not read at all
+    # when stopping after the scan
+    content_budget = int(args.content_budget_mb * 1024 * 1024)
+    if args.batch or args.coordinator or args.worker:
+        content_budget = 0
+    reader = ReadingClassifier(None if args.no_sniff_cache else DEFAULT_SNIFF_CACHE_PATH, args.workers,
+                               encoding_name=args.encoding_name, content_budget=content_budget,
+                               read_contents=args.stop_after != 'scan')
+    try:
+        if args.filetree_path:
+            root = ET.parse(args.filetree_path).getroot()
+            filetree_output = args.filetree_output or args.filetree_path
+        else:
+            _, _, filetree_output = resolve_paths(repo_dir, args.filetree_output)
+            root, manifest = scan_stage(repo_dir, not args.no_ignore, reader, args.workers)
+            if checkpoint:
+                write_checkpoint(root, filetree_output)
+                save_manifest(get_manifest_path(filetree_output), repo_dir, not args.no_ignore, manifest)
+            if args.stop_after == 'scan':
+                return
+
+        filter_stage(root, repo_dir, reader, args)
+        if checkpoint and args.max_file_tokens is not None:
+            write_checkpoint(root, filetree_output)
+        if args.stop_after == 'filter':
+            return
+    finally:
+        reader.close()
+
+    held = len(reader.contents)
+    log.info(f"Read {reader.stats['read']} files; holding {held} ({reader.held_bytes / 1024 / 1024:.1f} MB) "
+             f"for summarization, {reader.stats['over_budget']} over the content budget will be read again")
+    output_dir = args.output or os.path.join('outputs', repo_name, 'summaries')
+    await run_enrichment(args, root, repo_dir, output_dir, reader.contents)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
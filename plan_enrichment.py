@@ -0,0 +1,414 @@
+import os
+import heapq
+import math
+import argparse
+import xml.etree.ElementTree as ET
+from typing import Optional, List, Dict, NamedTuple
+from utils import (
+    log,
+    read_file_to_text,
+    load_prompt_template,
+    estimate_tokens,
+    load_encoding,
+    TokenBucket,
+    DEFAULT_MODEL,
+    DEFAULT_MAX_TOKENS,
+    MODEL_PRICES
+)
+from summary_cache import SummaryCache, DEFAULT_SUMMARY_CACHE_PATH
+from summary_store import SummaryStore, SUMMARY_STORE_FILENAME, FILE_SUMMARY, DIRECTORY_SUMMARY, relative_path
+from token_cache import TokenCountCache
+from get_input_tokens_info import count_file_tokens
+from enrich_filetree import (
+    collect_file_jobs,
+    collect_directory_jobs,
+    should_summarize,
+    ORDERING_POLICIES,
+    DEFAULT_ORDERING_POLICY,
+    DEFAULT_SEMAPHORE_SIZE,
+    DEFAULT_CHUNKING,
+    DEFAULT_DIRECTORY_BRANCH_TOKENS,
+    SUMMARIZE_FILE_PROMPT_PATH,
+    SUMMARIZE_DIRECTORY_PROMPT_PATH,
+    REDUCE_FILE_SUMMARIES_PROMPT_PATH,
+    FileJob,
+)
+
+# Output tokens of a summary, estimated from its input: ratio * input, within [min, max_tokens]
+DEFAULT_OUTPUT_RATIO = 0.25
+MIN_OUTPUT_TOKENS = 200
+# Tokens of one child's summary in a directory prompt, and of a directory or reduced summary
+ESTIMATED_CHILD_SUMMARY_TOKENS = 150
+ESTIMATED_SHORT_SUMMARY_TOKENS = 300
+
+# Request latency model: fixed overhead plus generation time
+DEFAULT_BASE_LATENCY = 2.0
+DEFAULT_OUTPUT_TOKENS_PER_SECOND = 60.0
+
+# USD per million tokens of the default model; batches are billed at half price
+DEFAULT_INPUT_PRICE = MODEL_PRICES[DEFAULT_MODEL]['input_tokens']
+DEFAULT_OUTPUT_PRICE = MODEL_PRICES[DEFAULT_MODEL]['output_tokens']
+BATCH_DISCOUNT = 0.5
+
+# Semaphore sizes tried when looking for the best one
+SEMAPHORE_CANDIDATES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+# A larger semaphore must be at least this much faster to be worth it
+SEMAPHORE_GAIN_THRESHOLD = 0.01
+
+
+class PlannedRequest(NamedTuple):
+    """One request enrichment would send; parent is the index of the request waiting on it"""
+    label: str
+    input_tokens: int
+    output_tokens: int
+    priority: tuple
+    parent: Optional[int]
+
+
+class Simulation(NamedTuple):
+    """Outcome of replaying the planned requests through the scheduler and rate limits"""
+    duration: float
+    start_times: List[float]
+    finish_times: List[float]
+    made_ready_by: List[Optional[int]]
+
+
+def estimate_output_tokens(input_tokens: int, output_ratio: float, max_tokens: int) -> int:
+    return min(max_tokens, max(MIN_OUTPUT_TOKENS, int(input_tokens * output_ratio)))
+
+
+def is_summary_current(filepath: str, rel_path: str, store: Optional[SummaryStore], prompt_text: str,
+                       summary_cache: Optional[SummaryCache], overwrite: bool) -> bool:
+    """Whether enrich_filetree would skip this file (same rules as use_existing_summary, without side effects)"""
+    if overwrite:
+        return False
+    exists, existing_key = store.get_key(FILE_SUMMARY, rel_path) if store is not None else (False, None)
+    if summary_cache is None:
+        return exists
+    try:
+        key = summary_cache.make_key(read_file_to_text(filepath), prompt_text, DEFAULT_MODEL)
+    except IOError:
+        return False
+    return existing_key == key or summary_cache.contains(key)
+
+
+def plan_requests(ft_root: ET.Element, root_dir: str, store: Optional[SummaryStore], token_counts: Dict[str, int],
+                  summary_cache: Optional[SummaryCache], args) -> Dict[str, object]:
+    """
+    List the requests enrich_filetree.py would send for this filetree: one per file
+    without a current summary (or one per chunk plus a reduce request for oversized
+    files), and one per directory whose summary is missing or has a child to redo.
+    """
+    file_template = load_prompt_template(SUMMARIZE_FILE_PROMPT_PATH)
+    file_overhead = estimate_tokens(file_template.text)
+    reduce_overhead = estimate_tokens(load_prompt_template(REDUCE_FILE_SUMMARIES_PROMPT_PATH).text)
+    directory_overhead = estimate_tokens(load_prompt_template(SUMMARIZE_DIRECTORY_PROMPT_PATH).text)
+    ordering = ORDERING_POLICIES[args.order]
+
+    requests: List[PlannedRequest] = []
+    plan = {'requests': requests, 'files': 0, 'up_to_date': 0, 'chunked': 0, 'directories': 0}
+
+    directory_jobs = collect_directory_jobs(ft_root, root_dir) if not args.no_directory_summaries else []
+    # Directories are added after their contents, so their indices are reserved up front
+    directory_index = {job.dir_path: i for i, job in enumerate(directory_jobs)}
+    pending_children = {job.dir_path: 0 for job in directory_jobs}
+    child_count = {job.dir_path: 0 for job in directory_jobs}
+    for job in directory_jobs:
+        if job.parent_path is not None:
+            child_count[job.parent_path] += 1
+    placeholder = PlannedRequest('', 0, 0, (), None)
+    requests.extend([placeholder] * len(directory_jobs))
+
+    for file_job in collect_file_jobs(ft_root, root_dir):
+        if not should_summarize(file_job.file_element):
+            continue
+        filepath = os.path.join(file_job.current_dir, file_job.file_element.get('name'))
+        if filepath not in token_counts:
+            continue
+        if file_job.current_dir in child_count:
+            child_count[file_job.current_dir] += 1
+        if is_summary_current(filepath, relative_path(filepath, root_dir), store, file_template.text,
+                              summary_cache, args.overwrite):
+            plan['up_to_date'] += 1
+            continue
+        plan['files'] += 1
+        tokens = token_counts[filepath]
+        parent = directory_index.get(file_job.current_dir)
+        if parent is not None:
+            pending_children[file_job.current_dir] += 1
+        priority = (1, ordering(FileJob(file_job.file_element, file_job.current_dir, tokens)), len(requests))
+        if args.chunk_threshold and tokens > args.chunk_threshold:
+            plan['chunked'] += 1
+            num_chunks = math.ceil(tokens / args.chunk_tokens)
+            requests.append(PlannedRequest(f"{filepath} (reduce)",
+                                           reduce_overhead + num_chunks * ESTIMATED_SHORT_SUMMARY_TOKENS,
+                                           ESTIMATED_SHORT_SUMMARY_TOKENS, (0, 0, len(requests)), parent))
+            reduce_index = len(requests) - 1
+            for i in range(num_chunks):
+                chunk_tokens = min(args.chunk_tokens, tokens - i * args.chunk_tokens)
+                requests.append(PlannedRequest(f"{filepath} (part {i + 1} of {num_chunks})",
+                                               file_overhead + chunk_tokens,
+                                               estimate_output_tokens(chunk_tokens, args.output_ratio,
+                                                                      args.max_tokens),
+                                               priority, reduce_index))
+        else:
+            requests.append(PlannedRequest(filepath, file_overhead + tokens,
+                                           estimate_output_tokens(tokens, args.output_ratio, args.max_tokens),
+                                           priority, parent))
+
+    # Directories, deepest first: redo a directory if its summary is missing or a child is redone
+    for job in reversed(directory_jobs):
+        index = directory_index[job.dir_path]
+        parent = directory_index.get(job.parent_path) if job.parent_path is not None else None
+        needed = (args.overwrite or pending_children[job.dir_path] > 0 or store is None or
+                  not store.exists(DIRECTORY_SUMMARY, relative_path(job.dir_path, root_dir)))
+        if not needed:
+            requests[index] = None
+            continue
+        plan['directories'] += 1
+        if parent is not None:
+            pending_children[job.parent_path] += 1
+        branch_tokens = min(args.directory_branch_tokens,
+                            child_count[job.dir_path] * ESTIMATED_CHILD_SUMMARY_TOKENS)
+        requests[index] = PlannedRequest(f"{job.dir_path}/ (directory)", directory_overhead + branch_tokens,
+                                         ESTIMATED_SHORT_SUMMARY_TOKENS, (0, 0, index), parent)
+
+    # Drop directories that don't need a request and renumber parents
+    new_index, kept = {}, []
+    for i, request in enumerate(requests):
+        if request is not None:
+            new_index[i] = len(kept)
+            kept.append(request)
+    plan['requests'] = [request._replace(parent=new_index.get(request.parent)) for request in kept]
+    return plan
+
+
+def request_duration(request: PlannedRequest, args) -> float:
+    return args.base_latency + request.output_tokens / args.output_tokens_per_second
+
+
+def simulate(requests: List[PlannedRequest], semaphore_size: int, args) -> Simulation:
+    """
+    Replay the planned requests as enrich_filetree.py would schedule them: at most
+    semaphore_size at once, ready directories and reduce steps ahead of files, and each
+    request waiting for RPM/ITPM/OTPM capacity (max_tokens reserved, unused output
+    returned when it completes), like utils.RateLimiter.
+    """
+    buckets = []
+    for limit, amount in ((args.rpm, lambda r: 1),
+                          (args.itpm, lambda r: r.input_tokens),
+                          (args.otpm, lambda r: args.max_tokens)):
+        if limit:
+            bucket = TokenBucket(limit)
+            bucket.updated = 0.0  # Simulated clock
+            buckets.append((bucket, amount))
+    otpm_bucket = buckets[-1][0] if args.otpm else None
+
+    waiting_on = [0] * len(requests)
+    for request in requests:
+        if request.parent is not None:
+            waiting_on[request.parent] += 1
+    ready = [(request.priority, i) for i, request in enumerate(requests) if waiting_on[i] == 0]
+    heapq.heapify(ready)
+    running: List[tuple] = []
+    start_times = [0.0] * len(requests)
+    finish_times = [0.0] * len(requests)
+    made_ready_by: List[Optional[int]] = [None] * len(requests)
+
+    now = 0.0
+    while ready or running:
+        wait = 0.0
+        while ready and len(running) < semaphore_size:
+            index = ready[0][1]
+            wait = max([bucket.time_until_available(amount(requests[index]), now)
+                        for bucket, amount in buckets] or [0.0])
+            if wait > 1e-9:  # Ignore rounding left over from refilling
+                break
+            heapq.heappop(ready)
+            for bucket, amount in buckets:
+                bucket.take(amount(requests[index]), now)
+            start_times[index] = now
+            heapq.heappush(running, (now + request_duration(requests[index], args), index))
+
+        next_times = [running[0][0]] if running else []
+        if ready and len(running) < semaphore_size:
+            next_times.append(now + wait)
+        now = min(next_times)
+        while running and running[0][0] <= now:
+            _, index = heapq.heappop(running)
+            finish_times[index] = now
+            request = requests[index]
+            if otpm_bucket is not None:
+                otpm_bucket.give_back(args.max_tokens - request.output_tokens, now)
+            if request.parent is not None:
+                waiting_on[request.parent] -= 1
+                if waiting_on[request.parent] == 0:
+                    made_ready_by[request.parent] = index
+                    heapq.heappush(ready, (requests[request.parent].priority, request.parent))
+    return Simulation(now, start_times, finish_times, made_ready_by)
+
+
+def critical_path(requests: List[PlannedRequest], simulation: Simulation) -> List[int]:
+    """The chain of requests, each waiting on the previous one, that ends with the last request"""
+    if not requests:
+        return []
+    index = max(range(len(requests)), key=lambda i: simulation.finish_times[i])
+    path = [index]
+    while simulation.made_ready_by[index] is not None:
+        index = simulation.made_ready_by[index]
+        path.append(index)
+    return list(reversed(path))
+
+
+def format_duration(seconds: float) -> str:
+    hours, rest = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s" if hours else f"{minutes}m {seconds:02d}s"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Estimate the cost and duration of enrich_filetree.py without sending any requests.')
+    parser.add_argument('-f', '--filetree-path', required=True,
+                        help='Path to the XML filetree file.')
+    parser.add_argument('-d', '--directory', required=True,
+                        help='Base directory path of the repository.')
+    parser.add_argument('-o', '--output',
+                        help='Output directory of the enrichment run, to skip files with current summaries '
+                             '(default: outputs/repo_name/summaries)')
+    parser.add_argument('-s', '--semaphore-size', type=int, default=DEFAULT_SEMAPHORE_SIZE,
+                        help=f'Maximum number of concurrent requests (default: {DEFAULT_SEMAPHORE_SIZE})')
+    parser.add_argument('--rpm', type=float, help='Provider limit on requests per minute')
+    parser.add_argument('--itpm', type=float, help='Provider limit on input tokens per minute')
+    parser.add_argument('--otpm', type=float, help='Provider limit on output tokens per minute')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Plan as if every summary is regenerated')
+    parser.add_argument('--order', choices=sorted(ORDERING_POLICIES), default=DEFAULT_ORDERING_POLICY,
+                        help=f'Order in which files are summarized (default: {DEFAULT_ORDERING_POLICY})')
+    parser.add_argument('--no-directory-summaries', action='store_true',
+                        help='Plan without directory summaries')
+    parser.add_argument('--directory-branch-tokens', type=int, default=DEFAULT_DIRECTORY_BRANCH_TOKENS,
+                        help=f'Cap on the branch sent per directory (default: {DEFAULT_DIRECTORY_BRANCH_TOKENS})')
+    parser.add_argument('--chunk-threshold', type=int, default=DEFAULT_CHUNKING['threshold'],
+                        help=f"Token count above which files are chunked (default: {DEFAULT_CHUNKING['threshold']})")
+    parser.add_argument('--chunk-tokens', type=int, default=DEFAULT_CHUNKING['chunk_tokens'],
+                        help=f"Maximum tokens per chunk (default: {DEFAULT_CHUNKING['chunk_tokens']})")
+    parser.add_argument('--no-summary-cache', action='store_true',
+                        help='Plan as if enrich_filetree.py runs with --no-summary-cache')
+    parser.add_argument('--summary-cache-path', default=DEFAULT_SUMMARY_CACHE_PATH,
+                        help=f'Path of the shared summary cache (default: {DEFAULT_SUMMARY_CACHE_PATH})')
+    parser.add_argument('--max-tokens', type=int, default=DEFAULT_MAX_TOKENS,
+                        help=f'max_tokens sent with each request (default: {DEFAULT_MAX_TOKENS})')
+    parser.add_argument('--output-ratio', type=float, default=DEFAULT_OUTPUT_RATIO,
+                        help=f'Estimated output tokens per input token (default: {DEFAULT_OUTPUT_RATIO})')
+    parser.add_argument('--base-latency', type=float, default=DEFAULT_BASE_LATENCY,
+                        help=f'Seconds of overhead per request (default: {DEFAULT_BASE_LATENCY})')
+    parser.add_argument('--output-tokens-per-second', type=float, default=DEFAULT_OUTPUT_TOKENS_PER_SECOND,
+                        help=f'Generation speed (default: {DEFAULT_OUTPUT_TOKENS_PER_SECOND})')
+    parser.add_argument('--input-price', type=float, default=DEFAULT_INPUT_PRICE,
+                        help=f'USD per million input tokens (default: {DEFAULT_INPUT_PRICE})')
+    parser.add_argument('--output-price', type=float, default=DEFAULT_OUTPUT_PRICE,
+                        help=f'USD per million output tokens (default: {DEFAULT_OUTPUT_PRICE})')
+    parser.add_argument('--encoding-name', default='o200k_base',
+                        help='The tiktoken encoding name to use for tokenization (default: o200k_base).')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of threads reading and tokenizing files (default: number of CPUs).')
+    parser.add_argument('--top', type=int, default=5,
+                        help='Number of critical-path and longest requests to list (default: 5)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if not os.path.exists(args.filetree_path):
+        log.error(f"XML file '{args.filetree_path}' does not exist.")
+        return
+    if not os.path.isdir(args.directory):
+        log.error(f"Base directory '{args.directory}' does not exist or is not a directory.")
+        return
+    if args.semaphore_size < 1 or args.jobs < 1:
+        log.error("Semaphore size and jobs must be at least 1.")
+        return
+
+    ft_root = ET.parse(args.filetree_path).getroot()
+    root_dir = args.directory
+    repo_name = os.path.basename(os.path.abspath(root_dir))
+    output_dir = args.output or os.path.join('outputs', repo_name, 'summaries')
+
+    # Token counts of the files enrichment would read, from the shared token count cache
+    file_paths = [os.path.join(job.current_dir, job.file_element.get('name'))
+                  for job in collect_file_jobs(ft_root, root_dir) if should_summarize(job.file_element)]
+    file_paths = [path for path in file_paths if os.path.exists(path)]
+
+    def count_uncached(paths):
+        return count_file_tokens(paths, load_encoding(args.encoding_name), args.jobs)
+
+    try:
+        token_cache = TokenCountCache()
+        counts = token_cache.count_files(file_paths, args.encoding_name, count_uncached)
+        token_cache.close()
+    except Exception as e:
+        log.error(f"Error initializing tiktoken encoding '{args.encoding_name}': {e}")
+        return
+    token_counts = {path: count for path, count in zip(file_paths, counts) if count is not None}
+
+    summary_cache = None
+    if not args.no_summary_cache and os.path.exists(args.summary_cache_path):
+        summary_cache = SummaryCache(args.summary_cache_path)
+    store_path = os.path.join(output_dir, SUMMARY_STORE_FILENAME)
+    store = SummaryStore(store_path) if os.path.exists(store_path) else None
+    plan = plan_requests(ft_root, root_dir, store, token_counts, summary_cache, args)
+    if summary_cache is not None:
+        summary_cache.close()
+    if store is not None:
+        store.close()
+    requests = plan['requests']
+
+    input_tokens = sum(request.input_tokens for request in requests)
+    output_tokens = sum(request.output_tokens for request in requests)
+    cost = (input_tokens * args.input_price + output_tokens * args.output_price) / 1_000_000
+
+    print("\n=== Plan ===")
+    print(f"Files to summarize: {plan['files']} ({plan['chunked']} in chunks), "
+          f"up to date: {plan['up_to_date']}")
+    print(f"Directories to summarize: {plan['directories']}")
+    print(f"Requests: {len(requests)}")
+    print(f"Estimated input tokens: {input_tokens:,}")
+    print(f"Estimated output tokens: {output_tokens:,}")
+    print(f"Estimated cost: ${cost:,.2f} (${cost * BATCH_DISCOUNT:,.2f} with --batch)")
+    if not requests:
+        return
+
+    simulation = simulate(requests, args.semaphore_size, args)
+    print(f"\n=== Schedule (semaphore size {args.semaphore_size}) ===")
+    print(f"Projected duration: {format_duration(simulation.duration)}")
+    limits = ", ".join(f"{name}={value:g}" for name, value in
+                       (("rpm", args.rpm), ("itpm", args.itpm), ("otpm", args.otpm)) if value)
+    print(f"Rate limits: {limits or 'none'}")
+
+    print("\nCritical path (each request waits on the previous one):")
+    for index in critical_path(requests, simulation)[-args.top:]:
+        request = requests[index]
+        print(f"  {format_duration(simulation.start_times[index])} -> "
+              f"{format_duration(simulation.finish_times[index])}: {request.label} "
+              f"({request.input_tokens:,} in / {request.output_tokens:,} out)")
+    print("\nLongest requests:")
+    longest = sorted(range(len(requests)), key=lambda i: request_duration(requests[i], args), reverse=True)
+    for index in longest[:args.top]:
+        print(f"  {request_duration(requests[index], args):.0f}s: {requests[index].label}")
+
+    print("\n=== Semaphore size ===")
+    durations = {}
+    for size in sorted(set(SEMAPHORE_CANDIDATES) | {args.semaphore_size}):
+        durations[size] = simulate(requests, size, args).duration
+        print(f"  {size:>4}: {format_duration(durations[size])}")
+        if size >= len(requests):
+            break  # Larger semaphores can't run more at once
+    fastest = min(durations.values())
+    best = min(size for size, duration in durations.items()
+               if duration <= fastest * (1 + SEMAPHORE_GAIN_THRESHOLD))
+    print(f"Best semaphore size: {best} (larger sizes gain less than {SEMAPHORE_GAIN_THRESHOLD:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+import os
+import json
+import random
+import functools
+from types import SimpleNamespace
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, Any, NamedTuple, Tuple, TYPE_CHECKING
+# The SDKs take most of a tool's startup time, so they are only imported by a provider's
+# first request; tools that never send one (token counts, filetrees) don't load them.
+if TYPE_CHECKING:
+    import httpx
+    from anthropic import AsyncAnthropic
+
+DEFAULT_MODEL = "claude-3-5-sonnet-latest"
+DEFAULT_MAX_TOKENS = 8192
+
+# HTTP connection pool of each provider. Requests run concurrently up to the semaphore
+# size, so the pool keeps that many connections alive between requests instead of
+# reopening (and re-handshaking) them as requests finish.
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_REQUEST_TIMEOUT = 600.0
+
+# Retries of the OpenAI-compatible provider when no rate limiter handles them
+OPENAI_MAX_RETRIES = 2
+OPENAI_RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class Usage(NamedTuple):
+    """Token usage of one request, with the fields of the Anthropic SDK's usage object"""
+    input_tokens: int
+    output_tokens: int
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+
+
+class Completion(NamedTuple):
+    """The text of a response and its token usage"""
+    text: str
+    usage: Any
+
+
+class ProviderError(Exception):
+    """
+    An error response from a provider other than Anthropic. Like the SDK's errors it
+    has a status_code and the response (for its retry-after header), so the rate
+    limiter handles both alike.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None, response: Any = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = response
+
+
+class ProviderConnectionError(ProviderError):
+    """The provider could not be reached, or did not answer in time"""
+
+
+def cacheable_system_prompt(system: str) -> List[Dict[str, Any]]:
+    """System blocks marking the (static) system prompt as a cacheable prompt prefix"""
+    return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+
+def pool_limits(max_connections: int, keepalive_expiry: float) -> 'httpx.Limits':
+    import httpx
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                        keepalive_expiry=keepalive_expiry)
+
+
+class Provider(ABC):
+    """
+    A chat completion API. The SDK is imported and the HTTP client created on the
+    first request, so building a provider (or a router of several) costs nothing
+    until it is used.
+    """
+    name = 'provider'
+
+    @abstractmethod
+    async def complete(self, messages: List[Dict[str, str]], model: str, max_tokens: int,
+                       temperature: float = 0, system: Optional[str] = None,
+                       retry: bool = True) -> Completion:
+        """
+        Send one request and return its completion. With retry False, failures are
+        raised at once, for callers that retry through a rate limiter.
+        """
+
+    def validate(self) -> None:
+        """Raise ValueError if the provider can't send requests, e.g. for lack of an API key"""
+
+    async def close(self) -> None:
+        """Close the HTTP client and its pooled connections"""
+
+
+class AnthropicProvider(Provider):
+    """The Anthropic Messages API, with the system prompt sent as a cacheable prefix"""
+    name = 'Anthropic'
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+                 timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self._client: Optional['AsyncAnthropic'] = None
+        self._client_without_retries: Optional['AsyncAnthropic'] = None
+
+    def validate(self) -> None:
+        if not (self.api_key or os.environ.get("ANTHROPIC_API_KEY")):
+            raise ValueError("ANTHROPIC_API_KEY must be set as an evironment variable, "
+                             "e.g. `export ANTHROPIC_API_KEY=123abc123...`")
+
+    @property
+    def client(self) -> 'AsyncAnthropic':
+        if self._client is None:
+            self.validate()
+            api_key = self.api_key or os.environ.get("ANTHROPIC_API_KEY")
+            import httpx
+            from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+            http_client = DefaultAsyncHttpxClient(
+                limits=pool_limits(self.max_connections, self.keepalive_expiry),
+                timeout=httpx.Timeout(self.timeout, connect=DEFAULT_CONNECT_TIMEOUT))
+            self._client = AsyncAnthropic(api_key=api_key, base_url=self.base_url, http_client=http_client)
+            # Shares the connection pool; the rate limiter must see every 429
+            self._client_without_retries = self._client.with_options(max_retries=0)
+        return self._client
+
+    async def complete(self, messages: List[Dict[str, str]], model: str, max_tokens: int,
+                       temperature: float = 0, system: Optional[str] = None,
+                       retry: bool = True) -> Completion:
+        client = self.client
+        if not retry:
+            client = self._client_without_retries
+        params = {"messages": messages, "model": model, "temperature": temperature, "max_tokens": max_tokens}
+        if system:
+            params["system"] = cacheable_system_prompt(system)
+        response = await client.messages.create(**params)
+        return Completion(response.content[0].text, response.usage)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = self._client_without_retries = None
+
+
+class OpenAICompatibleProvider(Provider):
+    """
+    The chat completions endpoint of an OpenAI-compatible server (vLLM, llama.cpp,
+    Ollama, LM Studio, ...), called directly over HTTP.
+    """
+
+    def __init__(self, base_url: str, api_key: Optional[str] = None,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+                 timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.name = f"OpenAI-compatible server at {self.base_url}"
+        self._client: Optional['httpx.AsyncClient'] = None
+
+    @property
+    def client(self) -> 'httpx.AsyncClient':
+        if self._client is None:
+            import httpx
+            headers = {'Authorization': f"Bearer {self.api_key}"} if self.api_key else {}
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, headers=headers,
+                limits=pool_limits(self.max_connections, self.keepalive_expiry),
+                timeout=httpx.Timeout(self.timeout, connect=DEFAULT_CONNECT_TIMEOUT))
+        return self._client
+
+    async def _post(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        import httpx
+        try:
+            response = await self.client.post('/chat/completions', json=body)
+        except httpx.TransportError as e:  # Includes timeouts
+            raise ProviderConnectionError(f"{type(e).__name__}: {e}") from e
+        if response.status_code >= 400:
+            raise ProviderError(f"Error code: {response.status_code} - {response.text[:500]}",
+                                response.status_code, response)
+        return response.json()
+
+    async def complete(self, messages: List[Dict[str, str]], model: str, max_tokens: int,
+                       temperature: float = 0, system: Optional[str] = None,
+                       retry: bool = True) -> Completion:
+        import asyncio
+        body = {
+            "model": model,
+            "messages": ([{"role": "system", "content": system}] if system else []) + messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+        attempt = 0
+        while True:
+            try:
+                data = await self._post(body)
+                break
+            except ProviderError as e:
+                retryable = isinstance(e, ProviderConnectionError) or e.status_code in OPENAI_RETRY_STATUS_CODES
+                if not retry or not retryable or attempt >= OPENAI_MAX_RETRIES:
+                    raise
+                attempt += 1
+                await asyncio.sleep(0.5 * 2 ** attempt * random.uniform(0.5, 1.5))
+
+        usage = data.get('usage') or {}
+        cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        text = data['choices'][0]['message'].get('content') or ''
+        return Completion(text, Usage(input_tokens=(usage.get('prompt_tokens') or 0) - cached,
+                                      output_tokens=usage.get('completion_tokens') or 0,
+                                      cache_read_input_tokens=cached))
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class MockProvider(Provider):
+    """
+    A local stand-in for an API, to try runs (e.g. several --worker processes) offline.
+    Answers every request after latency ± jitter seconds with a summary that parses as
+    a file or directory summary. rate_limit_ratio of the requests get a 429 asking to
+    retry after retry_after seconds, and error_ratio of them a 500.
+    """
+    name = 'mock provider'
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, rate_limit_ratio: float = 0.0,
+                 retry_after: float = 0.05, error_ratio: float = 0.0, output_tokens: int = 200,
+                 seed: Optional[int] = None, max_connections: int = DEFAULT_MAX_CONNECTIONS):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.error_ratio = error_ratio
+        self.output_tokens = output_tokens
+        self.rng = random.Random(seed)
+
+    async def complete(self, messages: List[Dict[str, str]], model: str, max_tokens: int,
+                       temperature: float = 0, system: Optional[str] = None,
+                       retry: bool = True) -> Completion:
+        import asyncio
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-1, 1) * self.jitter))
+        if self.rng.random() < self.rate_limit_ratio:
+            raise ProviderError("Mock rate limit", 429, SimpleNamespace(headers={'retry-after': str(self.retry_after)}))
+        if self.error_ratio and self.rng.random() < self.error_ratio:
+            raise ProviderError("Mock server error", 500, SimpleNamespace(headers={}))
+        prompt_chars = sum(len(message['content']) for message in messages)
+        text = ("<file-summary>Synthetic summary.</file-summary>"
+                "<directory-summary>Synthetic directory summary.</directory-summary>")
+        return Completion(text, Usage(input_tokens=prompt_chars // 4,
+                                      output_tokens=min(max_tokens, self.output_tokens)))
+
+
+PROVIDER_TYPES = {'anthropic': AnthropicProvider, 'openai': OpenAICompatibleProvider, 'mock': MockProvider}
+
+
+class Route(NamedTuple):
+    """
+    Where to send the summary of a file: the provider (by name in the router), the
+    model and its max_tokens. A route applies to files of at most max_input_tokens
+    tokens (any size if None) with one of the given extensions (any if empty).
+    """
+    name: str
+    provider: str
+    model: str
+    max_tokens: int
+    max_input_tokens: Optional[int] = None
+    extensions: Tuple[str, ...] = ()
+
+    def matches(self, path: str, tokens: int) -> bool:
+        if self.max_input_tokens is not None and tokens > self.max_input_tokens:
+            return False
+        return not self.extensions or os.path.splitext(path)[1].lower() in self.extensions
+
+
+class Router:
+    """
+    Picks a route for each request from the size and type of what is summarized.
+    Routes are tried in order and the first match wins; requests matching none take
+    the last route, which is usually the catch-all.
+    """
+
+    def __init__(self, providers: Dict[str, Provider], routes: List[Route]):
+        if not routes:
+            raise ValueError("A router needs at least one route")
+        for route in routes:
+            if route.provider not in providers:
+                raise ValueError(f"Route '{route.name}' uses unknown provider '{route.provider}'")
+        self.providers = providers
+        self.routes = routes
+
+    def route(self, path: str, tokens: int) -> Route:
+        for route in self.routes:
+            if route.matches(path, tokens):
+                return route
+        return self.routes[-1]
+
+    def request_options(self, route: Route) -> Dict[str, Any]:
+        """Keyword arguments of request_chat_completion that send a request along a route"""
+        return {'provider': self.providers[route.provider], 'model': route.model,
+                'max_tokens': route.max_tokens, 'route': route.name}
+
+    async def close(self) -> None:
+        for provider in self.providers.values():
+            await provider.close()
+
+
+def build_router(max_connections: int = DEFAULT_MAX_CONNECTIONS) -> Router:
+    """Every request to DEFAULT_MODEL on Anthropic, with the key from ANTHROPIC_API_KEY"""
+    return Router({'anthropic': AnthropicProvider(max_connections=max_connections)},
+                  [Route('default', 'anthropic', DEFAULT_MODEL, DEFAULT_MAX_TOKENS)])
+
+
+def load_router(path: str, max_connections: int = DEFAULT_MAX_CONNECTIONS) -> Router:
+    """
+    Build a router from a JSON file:
+
+        {"providers": {"<name>": {"type": "anthropic" | "openai", "base_url": ..., "api_key_env": ...,
+                                  "max_connections": ..., "keepalive_expiry": ..., "timeout": ...}},
+         "routes": [{"name": ..., "provider": "<name>", "model": ..., "max_tokens": ...,
+                     "max_input_tokens": ..., "extensions": [".py", ...]}]}
+
+    API keys are read from the environment variable named by api_key_env. Providers
+    without max_connections get the given default. A provider of type "mock" takes the
+    options of MockProvider instead, and sends no requests.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    providers = {}
+    for name, options in config.get('providers', {}).items():
+        options = dict(options)
+        provider_type = options.pop('type', 'anthropic')
+        if provider_type not in PROVIDER_TYPES:
+            raise ValueError(f"Provider '{name}' has unknown type '{provider_type}' "
+                             f"(expected one of {', '.join(PROVIDER_TYPES)})")
+        api_key_env = options.pop('api_key_env', None)
+        if api_key_env:
+            options['api_key'] = os.environ.get(api_key_env)
+        options.setdefault('max_connections', max_connections)
+        providers[name] = PROVIDER_TYPES[provider_type](**options)
+    routes = [Route(route['name'], route['provider'], route['model'], route.get('max_tokens', DEFAULT_MAX_TOKENS),
+                    route.get('max_input_tokens'), tuple(ext.lower() for ext in route.get('extensions', ())))
+              for route in config.get('routes', [])]
+    return Router(providers, routes)
+
+
+@functools.lru_cache(maxsize=None)
+def default_provider() -> AnthropicProvider:
+    """Provider of requests that don't name one"""
+    return AnthropicProvider()
+
+
+@functools.lru_cache(maxsize=None)
+def default_router() -> Router:
+    """Router of summaries that don't name one: everything to DEFAULT_MODEL on the default provider"""
+    return Router({'anthropic': default_provider()}, [Route('default', 'anthropic', DEFAULT_MODEL, DEFAULT_MAX_TOKENS)])
@@ -1,6 +1,8 @@
 # get a quick token count on a text input file
+import sqlite3
 import argparse
-import tiktoken
+from utils import load_encoding
+from token_cache import TokenCountCache
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Get a quick token count on a file using tiktoken')
@@ -8,13 +10,15 @@ def parse_arguments():
                         help='Path to the input file for token count.')
     parser.add_argument('--encoding-name', default='o200k_base',
                         help='The tiktoken encoding name to use for tokenization (default: o200k_base).')
+    parser.add_argument('--no-token-cache', action='store_true',
+                        help='Tokenize the file even if its count is cached.')
     return parser.parse_args()
 
 def count_tokens(file_path, encoding):
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
             text = file.read()
-            tokens = encoding.encode(text)
+            tokens = encoding.encode(text, allowed_special={'<|endoftext|>'})  # Same as get_input_tokens_info
             return len(tokens)
     except FileNotFoundError:
         print(f"Error: File '{file_path}' not found.")
@@ -26,15 +30,26 @@ def count_tokens(file_path, encoding):
 def main():
     args = parse_arguments()
     
-    # Initialize tiktoken encoding
-    try:
-        encoding = tiktoken.get_encoding(args.encoding_name)
-    except Exception as e:
-        print(f"Error initializing tiktoken encoding '{args.encoding_name}': {e}")
-        return
-    
+    def count_uncached(paths):
+        # The encoding is only loaded if the count is not cached
+        try:
+            encoding = load_encoding(args.encoding_name)
+        except Exception as e:
+            print(f"Error initializing tiktoken encoding '{args.encoding_name}': {e}")
+            return [None] * len(paths)
+        return [count_tokens(path, encoding) for path in paths]
+
     # Count tokens
-    token_count = count_tokens(args.input, encoding)
+    if args.no_token_cache:
+        token_count = count_uncached([args.input])[0]
+    else:
+        try:
+            token_cache = TokenCountCache()
+            token_count = token_cache.count_files([args.input], args.encoding_name, count_uncached)[0]
+            token_cache.close()
+        except sqlite3.Error as e:
+            print(f"Error using the token count cache, counting without it: {e}")
+            token_count = count_uncached([args.input])[0]
     
     if token_count is not None:
         print(f"Number of tokens in {args.input}: {token_count}")
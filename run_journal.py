@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import posixpath
+from typing import Optional, List, Dict, NamedTuple, Tuple
+from utils import log
+from summary_store import DIRECTORY_SUMMARY
+
+RUN_JOURNAL_FILENAME = 'run_journal.jsonl'
+
+# States of a file or directory in a run. Anything without an entry is pending.
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# Run modes: summarize everything, or only what failed in the previous run
+RUN_ALL = 'all'
+RUN_RETRY_FAILED = 'retry-failed'
+
+
+class JournalEntry(NamedTuple):
+    """The latest state of one file or directory summary in the current run"""
+    state: str
+    attempts: int
+    error_class: Optional[str] = None
+    error: Optional[str] = None
+    transient: bool = False
+
+
+class RunJournal:
+    """
+    Append-only log of the state of every summary in an enrichment run, one JSON
+    object per line in the output directory.
+
+    Each line is flushed as soon as it is written, so after a crash or Ctrl-C the
+    journal says exactly which summaries were done, which failed (with the error class
+    and the number of attempts) and which were in flight; the next run resumes from
+    there. A line starting a run ({"event": "run", "mode": ...}) clears the states
+    before it, and a finished run ends with {"event": "finished"}.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[Tuple[str, str], JournalEntry] = {}
+        self.mode: Optional[str] = None
+        self.finished = False
+        if os.path.exists(path):
+            self._replay()
+        journal_dir = os.path.dirname(path)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def _replay(self) -> None:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    log.warning(f"Ignoring unreadable line {line_number} of {self.path}")  # Torn by a crash
+                    continue
+                event = record.get('event')
+                if event == 'run':
+                    self.entries = {}
+                    self.mode = record['mode']
+                    self.finished = False
+                elif event == 'finished':
+                    self.finished = True
+                else:
+                    self.entries[(record['kind'], record['path'])] = JournalEntry(
+                        record['state'], record['attempts'], record.get('error_class'),
+                        record.get('error'), record.get('transient', False))
+
+    def _append(self, record: dict) -> None:
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def start_run(self, retry_failed: bool = False) -> bool:
+        """
+        Resume the unfinished run of the same mode if there is one, otherwise start a new
+        run, dropping the previous one from the journal. A new retry-failed run covers
+        only the summaries that failed in the previous run, and the directories above
+        them, whose summaries were made without them. Returns whether a run was resumed.
+        """
+        mode = RUN_RETRY_FAILED if retry_failed else RUN_ALL
+        if self.mode == mode and not self.finished:
+            return True
+        failed = self.failed() if retry_failed else []
+        seen = set(failed)
+        for kind, path in list(failed):
+            while path:
+                path = posixpath.dirname(path)
+                if (DIRECTORY_SUMMARY, path) in seen:
+                    break  # Its ancestors are covered too
+                seen.add((DIRECTORY_SUMMARY, path))
+                failed.append((DIRECTORY_SUMMARY, path))
+        self.file.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'event': 'run', 'mode': mode, 'time': time.time()}) + '\n')
+            for kind, path in failed:
+                f.write(json.dumps({'kind': kind, 'path': path, 'state': PENDING, 'attempts': 0}) + '\n')
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.entries = {key: JournalEntry(PENDING, 0) for key in failed}
+        self.mode = mode
+        self.finished = False
+        return False
+
+    def record(self, kind: str, path: str, state: str, error: Optional[Exception] = None,
+               transient: bool = False) -> None:
+        """Record the new state of a summary; entering IN_FLIGHT counts as one more attempt"""
+        previous = self.entries.get((kind, path))
+        attempts = previous.attempts if previous is not None else 0
+        if state == IN_FLIGHT:
+            attempts += 1
+        record = {'kind': kind, 'path': path, 'state': state, 'attempts': attempts, 'time': time.time()}
+        if error is not None:
+            record.update(error_class=type(error).__name__, error=str(error), transient=transient)
+        self._append(record)
+        self.entries[(kind, path)] = JournalEntry(state, attempts, record.get('error_class'),
+                                                  record.get('error'), transient)
+
+    def get(self, kind: str, path: str) -> Optional[JournalEntry]:
+        return self.entries.get((kind, path))
+
+    def should_skip(self, kind: str, path: str) -> bool:
+        """Whether this run has nothing to do for a summary: it is done, or outside a retry-failed run"""
+        entry = self.entries.get((kind, path))
+        if entry is None:
+            return self.mode == RUN_RETRY_FAILED
+        return entry.state == DONE
+
+    def failed(self) -> List[Tuple[str, str]]:
+        """(kind, path) of the summaries that failed"""
+        return [key for key, entry in self.entries.items() if entry.state == FAILED]
+
+    def counts(self) -> Dict[str, int]:
+        """Number of summaries in each state (pending ones of a new run have no entry yet)"""
+        counts: Dict[str, int] = {}
+        for entry in self.entries.values():
+            counts[entry.state] = counts.get(entry.state, 0) + 1
+        return counts
+
+    def finish(self) -> None:
+        """Mark the run as finished, so the next one starts over"""
+        self._append({'event': 'finished', 'time': time.time()})
+        self.finished = True
+
+    def close(self) -> None:
+        self.file.close()
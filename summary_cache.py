@@ -0,0 +1,99 @@
+import os
+import time
+import sqlite3
+import hashlib
+from typing import Optional
+from utils import log, CACHE_DIR
+
+DEFAULT_SUMMARY_CACHE_PATH = os.path.join(CACHE_DIR, 'summaries.sqlite')
+
+
+class SummaryCache:
+    """
+    Content-addressed store of file summaries, shared across runs and repositories.
+
+    Summaries are keyed by the hash of the file contents, the prompt template and the
+    model name, so a file is only sent to the model again when one of those changes,
+    and identical files (in this or any other repo) share one summary. The file path
+    is deliberately not part of the key.
+    """
+
+    def __init__(self, path: str = DEFAULT_SUMMARY_CACHE_PATH):
+        self.path = path
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')  # Allow concurrent runs to share the cache
+        self.conn.execute('PRAGMA busy_timeout=10000')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS summaries ('
+                              'key TEXT PRIMARY KEY, summary TEXT NOT NULL, size INTEGER NOT NULL, '
+                              'created_at REAL NOT NULL, last_used REAL NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)')
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def make_key(file_content: str, prompt_template: str, model: str) -> str:
+        """Hash the inputs that determine a summary"""
+        digest = hashlib.sha256()
+        for part in (file_content, prompt_template, model):
+            part_digest = hashlib.sha256(part.encode('utf-8', errors='surrogatepass')).digest()
+            digest.update(part_digest)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached summary XML for key, or None"""
+        row = self.conn.execute('SELECT summary FROM summaries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.conn:
+            self.conn.execute('UPDATE summaries SET last_used = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def contains(self, key: str) -> bool:
+        """Whether a summary is cached for key, without counting a lookup or marking it used"""
+        return self.conn.execute('SELECT 1 FROM summaries WHERE key = ?', (key,)).fetchone() is not None
+
+    def put(self, key: str, summary: str) -> None:
+        """Store the summary XML for key"""
+        now = time.time()
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?)',
+                              (key, summary, len(summary.encode('utf-8')), now, now))
+        self.stores += 1
+
+    def evict(self, max_bytes: Optional[int] = None, max_age_days: Optional[float] = None) -> int:
+        """
+        Drop summaries not used for max_age_days, then the least recently used ones
+        until the cache holds at most max_bytes. Returns the number of evicted entries.
+        """
+        evicted = 0
+        with self.conn:
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 86400
+                evicted += self.conn.execute('DELETE FROM summaries WHERE last_used < ?', (cutoff,)).rowcount
+            if max_bytes is not None:
+                total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM summaries').fetchone()[0]
+                if total > max_bytes:
+                    to_delete = []
+                    for key, size in self.conn.execute('SELECT key, size FROM summaries ORDER BY last_used'):
+                        if total <= max_bytes:
+                            break
+                        to_delete.append((key,))
+                        total -= size
+                    self.conn.executemany('DELETE FROM summaries WHERE key = ?', to_delete)
+                    evicted += len(to_delete)
+        return evicted
+
+    def log_stats(self) -> None:
+        lookups = self.hits + self.misses
+        hit_rate = f" ({self.hits / lookups:.0%} hit rate)" if lookups else ""
+        log.info(f"Summary cache: {self.hits} hits, {self.misses} misses{hit_rate}, {self.stores} stored")
+
+    def close(self) -> None:
+        self.conn.close()
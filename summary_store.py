@@ -0,0 +1,72 @@
+import os
+import time
+import sqlite3
+from typing import Optional, Iterator, Tuple
+
+SUMMARY_STORE_FILENAME = 'summary_store.sqlite'
+
+# Kinds of summaries in the store
+FILE_SUMMARY = 'file'
+DIRECTORY_SUMMARY = 'directory'
+
+
+def relative_path(path: str, root_dir: str) -> str:
+    """Path relative to root_dir with '/' separators, '' for root_dir itself"""
+    rel_path = os.path.relpath(path, root_dir)
+    return '' if rel_path == '.' else rel_path.replace(os.sep, '/')
+
+
+class SummaryStore:
+    """
+    The summaries of one repository, packed into a single SQLite file in the output
+    directory instead of one small XML file per source file.
+
+    Summaries are keyed by kind (file or directory) and path relative to the
+    repository root, and stored as the XML of their root element along with the
+    summary cache key they were made from. WAL mode lets several processes write to
+    the same store at once.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        store_dir = os.path.dirname(path)
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA busy_timeout=10000')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS summaries ('
+                              'kind TEXT NOT NULL, path TEXT NOT NULL, summary TEXT NOT NULL, key TEXT, '
+                              'updated_at REAL NOT NULL, PRIMARY KEY (kind, path))')
+
+    def get(self, kind: str, rel_path: str) -> Optional[str]:
+        """Return the summary XML stored for rel_path, or None"""
+        row = self.conn.execute('SELECT summary FROM summaries WHERE kind = ? AND path = ?',
+                                (kind, rel_path)).fetchone()
+        return None if row is None else row[0]
+
+    def get_key(self, kind: str, rel_path: str) -> Tuple[bool, Optional[str]]:
+        """Return whether a summary is stored for rel_path, and the cache key it was made from"""
+        row = self.conn.execute('SELECT key FROM summaries WHERE kind = ? AND path = ?',
+                                (kind, rel_path)).fetchone()
+        return (False, None) if row is None else (True, row[0])
+
+    def exists(self, kind: str, rel_path: str) -> bool:
+        return self.get_key(kind, rel_path)[0]
+
+    def put(self, kind: str, rel_path: str, summary: str, key: Optional[str] = None) -> None:
+        """Store the summary XML for rel_path, replacing any previous one"""
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?)',
+                              (kind, rel_path, summary, key, time.time()))
+
+    def items(self) -> Iterator[Tuple[str, str, str, Optional[str]]]:
+        """Iterate over (kind, rel_path, summary, key) in path order"""
+        yield from self.conn.execute('SELECT kind, path, summary, key FROM summaries ORDER BY kind, path')
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM summaries').fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,215 @@
+import sys
+import json
+import time
+import asyncio
+from array import array
+from contextlib import contextmanager, nullcontext
+from typing import Optional, List, Dict, Any, Iterator, ContextManager
+from utils import log, new_usage_totals, add_usage, format_usage, USAGE_FIELDS, MODEL_PRICES
+
+# Stages of a summary, in the order they happen
+SPANS = ('queue_wait', 'semaphore_wait', 'read', 'render', 'rate_limit_wait', 'api', 'parse')
+PERCENTILES = (0.5, 0.95, 0.99)
+
+# Seconds between progress updates, on a terminal and in logs
+TTY_PROGRESS_INTERVAL = 1.0
+LOG_PROGRESS_INTERVAL = 30.0
+
+METRICS_FORMATS = ('json', 'prometheus')
+# Prefix of every exported Prometheus metric
+METRIC_PREFIX = 'enrich'
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class Telemetry:
+    """
+    Timings and counters of one enrichment run.
+
+    Each stage of a summary (see SPANS) is timed as a span and kept as a list of
+    durations, from which percentiles are computed at the end. Requests also add their
+    token usage, which is priced per model with MODEL_PRICES. Counters track requests,
+    summaries done and responses that could not be parsed. The progress task samples
+    throughput over time while the run goes on.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, array] = {}
+        self.counters: Dict[str, int] = {}
+        self.usage = new_usage_totals()
+        self.cost = 0.0
+        # (seconds since start, summaries done, output tokens) at each progress update
+        self.timeline: List[tuple] = []
+        # Requests, failures, API seconds, tokens and cost of each route, with its model
+        self.routes: Dict[str, Dict[str, Any]] = {}
+
+    def observe(self, span: str, seconds: float) -> None:
+        self.spans.setdefault(span, array('d')).append(seconds)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as one sample of the named span"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _route(self, route: str, model: Optional[str] = None) -> Dict[str, Any]:
+        if route not in self.routes:
+            self.routes[route] = {'model': model, 'requests': 0, 'failures': 0, 'api_seconds': 0.0,
+                                  'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0}
+        return self.routes[route]
+
+    def record_request(self, seconds: float, model: str, usage: Any, route: Optional[str] = None) -> None:
+        """Record one successful API request: its duration, token usage and cost, also per route"""
+        self.observe('api', seconds)
+        self.count('requests')
+        add_usage(self.usage, usage)
+        prices = MODEL_PRICES.get(model)
+        cost = 0.0
+        if prices is not None:
+            cost = sum((getattr(usage, field, None) or 0) * prices[field] for field in USAGE_FIELDS) / 1_000_000
+        self.cost += cost
+        if route is not None:
+            route_stats = self._route(route, model)
+            route_stats['model'] = model
+            route_stats['requests'] += 1
+            route_stats['api_seconds'] += seconds
+            route_stats['input_tokens'] += sum(getattr(usage, field, None) or 0 for field in USAGE_FIELDS
+                                               if field != 'output_tokens')
+            route_stats['output_tokens'] += getattr(usage, 'output_tokens', None) or 0
+            route_stats['cost'] += cost
+
+    def record_failure(self, route: Optional[str] = None) -> None:
+        self.count('failed_requests')
+        if route is not None:
+            self._route(route)['failures'] += 1
+
+    def route_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Totals of each route, with its throughput over the run and its mean request latency"""
+        elapsed = self.elapsed()
+        route_stats = {}
+        for name, stats in sorted(self.routes.items()):
+            requests = stats['requests']
+            route_stats[name] = {**stats,
+                                 'requests_per_sec': requests / elapsed if elapsed > 0 else 0.0,
+                                 'output_tokens_per_sec': stats['output_tokens'] / elapsed if elapsed > 0 else 0.0,
+                                 'mean_latency': stats['api_seconds'] / requests if requests else 0.0}
+        return route_stats
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def span_stats(self) -> Dict[str, Dict[str, float]]:
+        """Count, sum, mean and percentiles of each span, in stage order"""
+        span_stats = {}
+        for name in sorted(self.spans, key=lambda name: (SPANS.index(name) if name in SPANS else len(SPANS), name)):
+            ordered = sorted(self.spans[name])
+            span_stats[name] = {'count': len(ordered), 'sum': sum(ordered), 'mean': sum(ordered) / len(ordered),
+                                **{f"p{int(q * 100)}": percentile(ordered, q) for q in PERCENTILES},
+                                'max': ordered[-1]}
+        return span_stats
+
+    def progress_line(self, total: Optional[int]) -> str:
+        elapsed = self.elapsed()
+        done = self.counters.get('summaries', 0)
+        line = f"[{elapsed:.0f}s] {done}" + (f"/{total} summaries ({done / total:.0%})" if total else " summaries")
+        if elapsed > 0:
+            line += (f", {self.counters.get('requests', 0) / elapsed:.2f} req/s, "
+                     f"{self.usage['output_tokens'] / elapsed:.0f} output tok/s")
+        line += f", ${self.cost:.2f}"
+        if total and 0 < done < total:
+            line += f", ETA {elapsed / done * (total - done):.0f}s"
+        return line
+
+    async def show_progress(self, total: Optional[int] = None) -> None:
+        """
+        Keep a progress line up to date until cancelled: rewritten in place on a
+        terminal, logged periodically otherwise. Each update is added to the timeline.
+        """
+        interactive = sys.stderr.isatty()
+        interval = TTY_PROGRESS_INTERVAL if interactive else LOG_PROGRESS_INTERVAL
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.timeline.append((round(self.elapsed(), 3), self.counters.get('summaries', 0),
+                                      self.usage['output_tokens']))
+                if interactive:
+                    sys.stderr.write('\r' + self.progress_line(total).ljust(100))
+                    sys.stderr.flush()
+                else:
+                    log.info(self.progress_line(total))
+        finally:
+            if interactive:
+                sys.stderr.write('\n')
+
+    def log_summary(self) -> None:
+        for name, stats in self.span_stats().items():
+            log.info(f"Span {name}: n={stats['count']}, mean={stats['mean']:.3f}s, p50={stats['p50']:.3f}s, "
+                     f"p95={stats['p95']:.3f}s, p99={stats['p99']:.3f}s, max={stats['max']:.3f}s")
+        for name, stats in self.route_stats().items():
+            log.info(f"Route {name} ({stats['model']}): {stats['requests']} requests, {stats['failures']} failed, "
+                     f"{stats['requests_per_sec']:.2f} req/s, {stats['output_tokens_per_sec']:.0f} output tok/s, "
+                     f"mean latency {stats['mean_latency']:.2f}s, ${stats['cost']:.2f}")
+        counters = ', '.join(f"{value} {name.replace('_', ' ')}" for name, value in sorted(self.counters.items()))
+        log.info(f"Counters: {counters or 'none'}")
+        log.info(f"Token usage: {format_usage(self.usage)}, cost ${self.cost:.2f}")
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'elapsed_seconds': self.elapsed(),
+            'spans': self.span_stats(),
+            'counters': dict(self.counters),
+            'usage': dict(self.usage),
+            'cost_usd': self.cost,
+            'routes': self.route_stats(),
+            'timeline': [{'seconds': seconds, 'summaries': done, 'output_tokens': output_tokens}
+                         for seconds, done, output_tokens in self.timeline],
+        }
+
+    def to_prometheus(self) -> str:
+        """The metrics in Prometheus text exposition format"""
+        lines = [f"# HELP {METRIC_PREFIX}_span_seconds Duration of each stage of a summary",
+                 f"# TYPE {METRIC_PREFIX}_span_seconds summary"]
+        for name, stats in self.span_stats().items():
+            for q in PERCENTILES:
+                lines.append(f'{METRIC_PREFIX}_span_seconds{{span="{name}",quantile="{q}"}} '
+                             f'{stats[f"p{int(q * 100)}"]}')
+            lines.append(f'{METRIC_PREFIX}_span_seconds_sum{{span="{name}"}} {stats["sum"]}')
+            lines.append(f'{METRIC_PREFIX}_span_seconds_count{{span="{name}"}} {stats["count"]}')
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {METRIC_PREFIX}_{name}_total counter", f"{METRIC_PREFIX}_{name}_total {value}"]
+        route_stats = self.route_stats()
+        for metric, field in (('route_requests_total', 'requests'), ('route_failures_total', 'failures'),
+                              ('route_api_seconds_total', 'api_seconds'),
+                              ('route_input_tokens_total', 'input_tokens'),
+                              ('route_output_tokens_total', 'output_tokens'), ('route_cost_usd_total', 'cost')):
+            if route_stats:
+                lines.append(f"# TYPE {METRIC_PREFIX}_{metric} counter")
+            lines += [f'{METRIC_PREFIX}_{metric}{{route="{name}",model="{stats["model"] or ""}"}} {stats[field]}'
+                      for name, stats in route_stats.items()]
+        lines.append(f"# TYPE {METRIC_PREFIX}_tokens_total counter")
+        lines += [f'{METRIC_PREFIX}_tokens_total{{type="{field}"}} {value}' for field, value in self.usage.items()]
+        lines += [f"# TYPE {METRIC_PREFIX}_cost_usd_total counter", f"{METRIC_PREFIX}_cost_usd_total {self.cost}",
+                  f"# TYPE {METRIC_PREFIX}_elapsed_seconds gauge", f"{METRIC_PREFIX}_elapsed_seconds {self.elapsed()}"]
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, metrics_format: str = 'json') -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            if metrics_format == 'prometheus':
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent=2)
+
+
+def timed(telemetry: Optional[Telemetry], name: str) -> ContextManager[None]:
+    """telemetry.span(name), or an untimed block without telemetry"""
+    return nullcontext() if telemetry is None else telemetry.span(name)
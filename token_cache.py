@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+import hashlib
+from typing import Optional, List, Dict, Callable
+from utils import log, CACHE_DIR
+
+DEFAULT_TOKEN_CACHE_PATH = os.path.join(CACHE_DIR, 'token_counts.sqlite')
+# Least recently used counts beyond this many entries are evicted on close
+DEFAULT_MAX_TOKEN_CACHE_ENTRIES = 500_000
+# Keys per SELECT ... IN (...) query, below SQLite's variable limit
+LOOKUP_CHUNK_SIZE = 500
+
+
+class TokenCountCache:
+    """
+    Token counts shared by get_input_tokens_info.py, quick_token_count.py and
+    enrich_filetree.py, so unchanged files are not tokenized again on every run.
+
+    Files are keyed by (device, inode, size, mtime) and the encoding name, so a lookup
+    costs one stat call and no read. In-memory text is keyed by its hash and the
+    encoding name.
+    """
+
+    def __init__(self, path: str = DEFAULT_TOKEN_CACHE_PATH,
+                 max_entries: int = DEFAULT_MAX_TOKEN_CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')  # Allow the tools to run at the same time
+        self.conn.execute('PRAGMA busy_timeout=10000')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS token_counts ('
+                              'key TEXT PRIMARY KEY, tokens INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS token_counts_last_used ON token_counts (last_used)')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def file_key(file_path: str, encoding_name: str) -> Optional[str]:
+        """Key for the current version of a file, or None if it can't be stat'ed"""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return f"file:{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{encoding_name}"
+
+    @staticmethod
+    def text_key(text: str, encoding_name: str) -> str:
+        """Key for a piece of text"""
+        digest = hashlib.sha256(text.encode('utf-8', errors='surrogatepass')).hexdigest()
+        return f"text:{digest}:{encoding_name}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, int]:
+        """Return the cached counts of the given keys that are present"""
+        found = {}
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            chunk = keys[start:start + LOOKUP_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(self.conn.execute(
+                f'SELECT key, tokens FROM token_counts WHERE key IN ({placeholders})', chunk))
+        if found:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany('UPDATE token_counts SET last_used = ? WHERE key = ?',
+                                      [(now, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, counts: Dict[str, int]) -> None:
+        """Store token counts by key"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)',
+                                  [(key, tokens, now) for key, tokens in counts.items()])
+
+    def count_files(self, file_paths: List[str], encoding_name: str,
+                    count_uncached: Callable[[List[str]], List[Optional[int]]]) -> List[Optional[int]]:
+        """
+        Token counts of the given files, in order. Files missing from the cache are
+        counted with count_uncached (all in one call, and not at all if every file is
+        cached); None results are returned but not stored.
+        """
+        keys = [self.file_key(file_path, encoding_name) for file_path in file_paths]
+        cached = self.get_many([key for key in keys if key is not None])
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        counts = [cached.get(key) for key in keys]
+        if missing:
+            new_counts = count_uncached([file_paths[i] for i in missing])
+            for i, count in zip(missing, new_counts):
+                counts[i] = count
+            self.put_many({keys[i]: count for i, count in zip(missing, new_counts)
+                           if keys[i] is not None and count is not None})
+        return counts
+
+    def count_text(self, text: str, encoding_name: str, count_uncached: Callable[[str], int]) -> int:
+        """Token count of text, computed with count_uncached if it isn't cached"""
+        key = self.text_key(text, encoding_name)
+        cached = self.get_many([key])
+        if key in cached:
+            return cached[key]
+        count = count_uncached(text)
+        self.put_many({key: count})
+        return count
+
+    def evict(self) -> int:
+        """Drop the least recently used counts beyond max_entries. Returns the number evicted."""
+        with self.conn:
+            return self.conn.execute(
+                'DELETE FROM token_counts WHERE key IN '
+                '(SELECT key FROM token_counts ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)).rowcount
+
+    def log_stats(self) -> None:
+        lookups = self.hits + self.misses
+        hit_rate = f" ({self.hits / lookups:.0%} hit rate)" if lookups else ""
+        log.info(f"Token count cache: {self.hits} hits, {self.misses} misses{hit_rate}")
+
+    def close(self) -> None:
+        """Evict beyond max_entries and close the database"""
+        self.evict()
+        self.conn.close()
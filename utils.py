@@ -1,42 +1,413 @@
 import os
-from anthropic import AsyncAnthropic
-from typing import List, Tuple, Optional, Dict
+import sys
+import time
+import random
+import functools
+from typing import List, Tuple, Optional, Dict, Any, Callable, Awaitable, NamedTuple, TYPE_CHECKING
 import logging
 from custom_logging import get_logger_with_level
 import re
 import xml.etree.ElementTree as ET
+from providers import (
+    Provider,
+    ProviderConnectionError,
+    default_provider,
+    DEFAULT_MODEL,
+    DEFAULT_MAX_TOKENS
+)
+# asyncio and email.utils are imported where they are used: the offline tools import
+# this module only for logging and token counting, and start faster without them
+if TYPE_CHECKING:
+    import asyncio
+    from telemetry import Telemetry
 
 log = get_logger_with_level( logging.INFO ) # change logging level if the output is too verbose
 
-ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
-assert ANTHROPIC_API_KEY, "\n\nANTHROPIC_API_KEY must be set as an evironment variable, e.g. `export ANTHROPIC_API_KEY=123abc123...`"
+# Persistent caches shared across runs and repositories
+CACHE_DIR = os.path.join('outputs', '.cache')
+
+# USD per million tokens of each usage field, by model
+MODEL_PRICES = {
+    "claude-3-5-sonnet-latest": {'input_tokens': 3.0, 'output_tokens': 15.0,
+                                 'cache_creation_input_tokens': 3.75, 'cache_read_input_tokens': 0.30},
+    "claude-3-5-haiku-latest": {'input_tokens': 0.80, 'output_tokens': 4.0,
+                                'cache_creation_input_tokens': 1.0, 'cache_read_input_tokens': 0.08},
+}
+
+DEFAULT_ENCODING_NAME = 'o200k_base'
+# tiktoken downloads each encoding once and keeps it here, rather than in a temporary
+# directory the OS may clear (the TIKTOKEN_CACHE_DIR environment variable overrides it)
+TIKTOKEN_CACHE_DIR = os.path.join(CACHE_DIR, 'tiktoken')
+
+
+@functools.lru_cache(maxsize=None)
+def load_encoding(encoding_name: str = DEFAULT_ENCODING_NAME):
+    """Load a tiktoken encoding once per process, importing tiktoken on first use"""
+    os.environ.setdefault('TIKTOKEN_CACHE_DIR', os.path.abspath(TIKTOKEN_CACHE_DIR))
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_tiktoken_encoding(encoding_name: str = DEFAULT_ENCODING_NAME):
+    """Load a tiktoken encoding once per process, or return None if it can't be loaded"""
+    try:
+        return load_encoding(encoding_name)
+    except Exception as e:
+        log.warning(f"Could not load tiktoken encoding '{encoding_name}' ({e}), "
+                    "estimating 4 characters per token")
+        return None
+
+
+def estimate_tokens(text: str, encoding_name: str = DEFAULT_ENCODING_NAME) -> int:
+    """Estimate the token count of a prompt with tiktoken (or ~4 chars/token if unavailable)"""
+    encoding = get_tiktoken_encoding(encoding_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class IncrementalTokenCounter:
+    """
+    Count the tokens of text that is produced piece by piece, without holding all of it.
+
+    Pieces are buffered and encoded in chunks of about chunk_chars characters, each cut
+    just after a newline that is followed by neither whitespace nor '/'. The o200k and
+    cl100k pre-tokenizers never join text across such a point (o200k does join
+    punctuation with the newlines and slashes after it, as in ':\\n/'), so the total
+    equals the count of the whole text.
+    """
+
+    def __init__(self, encoding, chunk_chars: int = 1 << 20):
+        self.encoding = encoding
+        self.chunk_chars = chunk_chars
+        self.buffer: List[str] = []
+        self.buffered = 0
+        self.count = 0
+
+    def _encode(self, text: str) -> None:
+        self.count += len(self.encoding.encode(text, disallowed_special=()))
+
+    def feed(self, text: str) -> None:
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered < self.chunk_chars:
+            return
+        text = ''.join(self.buffer)
+        cut = text.rfind('\n', 0, len(text) - 1)
+        while cut >= 0 and (text[cut + 1].isspace() or text[cut + 1] == '/'):
+            cut = text.rfind('\n', 0, cut)
+        if cut < 0:
+            self.buffer = [text]  # No safe cut point yet, keep buffering
+            return
+        self._encode(text[:cut + 1])
+        self.buffer = [text[cut + 1:]]
+        self.buffered = len(self.buffer[0])
+
+    def finish(self) -> int:
+        """Encode what is left and return the total token count"""
+        self._encode(''.join(self.buffer))
+        self.buffer, self.buffered = [], 0
+        return self.count
+
+
+# Status codes that signal the provider is over capacity (rate limited or overloaded)
+RATE_LIMIT_STATUS_CODES = (429, 529)
+# Status codes worth retrying without reducing concurrency
+TRANSIENT_STATUS_CODES = (408, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """A bucket refilling continuously up to capacity_per_minute units"""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.rate = capacity_per_minute / 60
+        self.level = capacity_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_available(self, amount: float, now: float) -> float:
+        """Seconds until amount can be taken (amounts over capacity only need a full bucket)"""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount: float, now: float) -> None:
+        """Return unused units (a negative amount takes extra units that were used)"""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    return getattr(error, 'status_code', None)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether a failed request is worth retrying later: rate limits, overloads, server and connection errors"""
+    if get_status_code(error) in RATE_LIMIT_STATUS_CODES + TRANSIENT_STATUS_CODES:
+        return True
+    import asyncio
+    anthropic = sys.modules.get('anthropic')  # Errors can only come from the SDK once it is imported
+    if anthropic is not None and isinstance(error, anthropic.APIConnectionError):
+        return True
+    return isinstance(error, (ProviderConnectionError, asyncio.TimeoutError))
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Seconds to wait according to the retry-after header of a failed request, if any"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        import email.utils
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class RateLimiter:
+    """
+    Client-side limiter for provider requests.
+
+    Each request reserves its estimated input tokens and its max_tokens in per-minute
+    token buckets (requests, input tokens, output tokens; a limit of None is unlimited),
+    and the reservation is corrected with the actual usage once the response arrives.
+    Concurrency adapts AIMD-style: it grows by about one slot per window of successful
+    requests and halves on every 429/overloaded response, which also pauses all new
+    requests for the duration given by the retry-after header. Failed requests are
+    retried with jittered exponential backoff.
+    """
+
+    def __init__(self,
+                 requests_per_minute: Optional[float] = None,
+                 input_tokens_per_minute: Optional[float] = None,
+                 output_tokens_per_minute: Optional[float] = None,
+                 max_concurrency: int = 10,
+                 min_concurrency: int = 1,
+                 max_retries: int = 6,
+                 base_backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 encoding_name: str = DEFAULT_ENCODING_NAME):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.input_tokens = TokenBucket(input_tokens_per_minute) if input_tokens_per_minute else None
+        self.output_tokens = TokenBucket(output_tokens_per_minute) if output_tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.encoding_name = encoding_name
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition: Optional['asyncio.Condition'] = None
+        self.stats = {'requests': 0, 'rate_limited': 0, 'retries': 0, 'failures': 0}
+
+    def estimate_input_tokens(self, text: str) -> int:
+        return estimate_tokens(text, self.encoding_name)
+
+    def _buckets(self, input_tokens: int, output_tokens: int):
+        return [(bucket, amount) for bucket, amount in ((self.requests, 1),
+                                                        (self.input_tokens, input_tokens),
+                                                        (self.output_tokens, output_tokens))
+                if bucket is not None]
+
+    async def acquire(self, input_tokens: int, output_tokens: int) -> None:
+        """Wait for a concurrency slot and enough capacity in every bucket, then reserve it"""
+        import asyncio
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.in_flight >= max(self.min_concurrency, int(self.concurrency)):
+                    await self.condition.wait()
+                    continue
+                delay = self.paused_until - now
+                for bucket, amount in self._buckets(input_tokens, output_tokens):
+                    delay = max(delay, bucket.time_until_available(amount, now))
+                if delay <= 0:
+                    for bucket, amount in self._buckets(input_tokens, output_tokens):
+                        bucket.take(amount, now)
+                    self.in_flight += 1
+                    return
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, reserved_input: int, reserved_output: int,
+                      used_input: Optional[int] = None, used_output: Optional[int] = None) -> None:
+        """Free the concurrency slot and correct token reservations with the actual usage"""
+        async with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if self.input_tokens is not None and used_input is not None:
+                self.input_tokens.give_back(reserved_input - used_input, now)
+            if self.output_tokens is not None and used_output is not None:
+                self.output_tokens.give_back(reserved_output - used_output, now)
+            self.condition.notify_all()
+
+    def on_success(self) -> None:
+        # Additive increase: about one extra slot per window of successful requests
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> None:
+        # Multiplicative decrease, and stop sending until the provider's retry-after
+        self.stats['rate_limited'] += 1
+        self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        log.warning(f"Rate limited by provider, concurrency reduced to {int(self.concurrency)}"
+                    + (f", pausing {retry_after:.1f}s" if retry_after else ""))
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Jittered exponential backoff, never shorter than the provider's retry-after"""
+        delay = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+        return max(delay, retry_after or 0.0)
+
+    async def call(self, make_request: Callable[[], Awaitable[Any]], input_tokens: int,
+                   output_tokens: int) -> Any:
+        """
+        Run make_request under the limiter, retrying rate limits, overloads, server
+        errors and connection errors. The request's result may have a `usage` attribute
+        with input_tokens/output_tokens to correct the reservations.
+        """
+        import asyncio
+        attempt = 0
+        while True:
+            await self.acquire(input_tokens, output_tokens)
+            self.stats['requests'] += 1
+            try:
+                result = await make_request()
+            except Exception as e:
+                await self.release(input_tokens, output_tokens)
+                status_code = get_status_code(e)
+                retry_after = get_retry_after(e)
+                if status_code in RATE_LIMIT_STATUS_CODES:
+                    self.on_rate_limited(retry_after)
+                elif not is_transient_error(e):
+                    self.stats['failures'] += 1
+                    raise
+                if attempt >= self.max_retries:
+                    self.stats['failures'] += 1
+                    raise
+                delay = self.backoff(attempt, retry_after)
+                attempt += 1
+                self.stats['retries'] += 1
+                log.debug(f"Retrying request in {delay:.1f}s (attempt {attempt}/{self.max_retries}): {e}")
+                await asyncio.sleep(delay)
+                continue
+
+            usage = getattr(result, 'usage', None)
+            await self.release(input_tokens, output_tokens,
+                               getattr(usage, 'input_tokens', None), getattr(usage, 'output_tokens', None))
+            self.on_success()
+            return result
+
+    def log_stats(self) -> None:
+        log.info(f"Rate limiter: {self.stats['requests']} requests sent, {self.stats['rate_limited']} rate limited, "
+                 f"{self.stats['retries']} retries, {self.stats['failures']} failed, "
+                 f"final concurrency {int(self.concurrency)}")
+
+
+# Usage fields reported by the provider, accumulated by request_chat_completion
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+
+
+def new_usage_totals() -> Dict[str, int]:
+    return {field: 0 for field in USAGE_FIELDS}
+
+
+def add_usage(usage_totals: Dict[str, int], usage: Any) -> None:
+    """Add the token counts of a response's usage object to usage_totals"""
+    for field in USAGE_FIELDS:
+        usage_totals[field] += getattr(usage, field, None) or 0
+
+
+def format_usage(usage_totals: Dict[str, int]) -> str:
+    cached = usage_totals['cache_read_input_tokens']
+    total_input = usage_totals['input_tokens'] + usage_totals['cache_creation_input_tokens'] + cached
+    share = f" ({cached / total_input:.0%} of input read from cache)" if total_input else ""
+    return (f"{usage_totals['input_tokens']} uncached input tokens, "
+            f"{usage_totals['cache_creation_input_tokens']} cache writes, "
+            f"{cached} cache reads{share}, {usage_totals['output_tokens']} output tokens")
 
-anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
 
 async def request_chat_completion(
     msgs: List[Tuple[str,str]], 
-    model: str = "claude-3-5-sonnet-latest",
+    model: str = DEFAULT_MODEL,
     temperature: int = 0,
-    max_tokens: int = 8192,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    rate_limiter: Optional[RateLimiter] = None,
+    system: Optional[str] = None,
+    telemetry: Optional['Telemetry'] = None,
+    provider: Optional[Provider] = None,
+    route: Optional[str] = None,
 )-> Optional[str]:
-    """Request exam guide enhancement chat completion"""
+    """
+    Request a chat completion from the provider (Anthropic by default). With a rate
+    limiter, the request waits for capacity and rate-limited or transient failures
+    are retried instead of raised.
+
+    A system prompt is sent as a cacheable prefix, so instructions shared by many
+    requests are billed at the cache-read rate after the first one. With telemetry,
+    the HTTP call that succeeded is timed as an 'api' span, the rest of the time (rate
+    limiter waits, backoff and failed attempts) as a 'rate_limit_wait' span, and the
+    usage is counted, also under the name of its route if given.
+    """
+    if provider is None:
+        provider = default_provider()
     messages = [{"role": role, "content": msg_content} for role, msg_content in msgs]
+    request_start = time.perf_counter()
+    attempt_seconds = 0.0  # Of the latest HTTP call
+
+    async def make_request():
+        nonlocal attempt_seconds
+        attempt_start = time.perf_counter()
+        try:
+            # Without a rate limiter, the provider retries on its own
+            return await provider.complete(messages, model, max_tokens, temperature, system,
+                                           retry=rate_limiter is None)
+        finally:
+            attempt_seconds = time.perf_counter() - attempt_start
+
     try:
-        completion = await anthropic_client.messages.create(
-            messages=messages,
-            model="claude-3-5-sonnet-latest",
-            temperature=temperature,
-            max_tokens=max_tokens,
-        )
-        content = completion.content[0].text
+        if rate_limiter is None:
+            completion = await make_request()
+        else:
+            # The limiter handles retries, so the provider must surface every 429 to it
+            prompt_text = (system or "") + "".join(content for _, content in msgs)
+            input_tokens = rate_limiter.estimate_input_tokens(prompt_text)
+            completion = await rate_limiter.call(make_request, input_tokens, max_tokens)
+        if telemetry is not None:
+            telemetry.observe('rate_limit_wait', time.perf_counter() - request_start - attempt_seconds)
+            telemetry.record_request(attempt_seconds, model, completion.usage, route)
     except Exception as e:
-        model_provider = "Anthropic"
-        log.error(f"Error while requesting {model_provider} chat completion: {e}")
+        if telemetry is not None:
+            telemetry.record_failure(route)
+        log.error(f"Error while requesting {provider.name} chat completion: {e}")
         raise e
-    return str(content)
+    return str(completion.text)
 
 
-def extract_xml(response: str, tag: str):
+def find_xml(response: str, tag: str) -> Optional[str]:
+    """Return the stripped contents of the first <tag> element in response, or None if there is none"""
     # Match both simple tags and tags with attributes
     opening_pattern = f"<{tag}[^>]*>"
     closing_tag = f"</{tag}>"
@@ -44,13 +415,19 @@ def extract_xml(response: str, tag: str):
     opening_match = re.search(opening_pattern, response)
     
     if not (opening_match and closing_tag in response):
+        return None
+    start_index = opening_match.end()
+    end_index = response.find(closing_tag, start_index)
+    content = response[start_index:end_index]
+    return content.strip()
+
+
+def extract_xml(response: str, tag: str):
+    content = find_xml(response, tag)
+    if content is None:
         log.warning("Unable to extract information for given tag (LLM likely did not follow response formatting instructions). Returning full response")
         return response
-    else:
-        start_index = opening_match.end()
-        end_index = response.find(closing_tag, start_index)
-        content = response[start_index:end_index]
-        return content.strip()
+    return content
 
 def read_file_to_text(filepath: str) -> str:
     try:
@@ -65,7 +442,63 @@ def replace_placeholders(text: str, replacements: Dict[str, str]) -> str:
     for key, value in replacements.items():
         text = text.replace(key, value)
     return text
+
+
+class PromptTemplate(NamedTuple):
+    """
+    A prompt template split into its static sections (sent as a cacheable system
+    prompt) and the sections containing {{PLACEHOLDERS}} (sent as the user message).
+    """
+    text: str
+    system: str
+    user: str
+
+    def render(self, replacements: Dict[str, str]) -> Tuple[str, str]:
+        """Return the (system, user) prompts with placeholders replaced"""
+        return self.system, replace_placeholders(self.user, replacements)
+
+
+@functools.lru_cache(maxsize=None)
+def load_prompt_template(filepath: str) -> PromptTemplate:
+    """
+    Read a prompt template once and split it on its [Section] header lines. Sections
+    without placeholders keep their relative order in the system prompt, the others
+    keep theirs in the user message.
+    """
+    text = read_file_to_text(filepath)
+    sections: List[List[str]] = [[]]
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']') and any(sections[-1]):
+            sections.append([])
+        sections[-1].append(line)
+
+    system_sections, user_sections = [], []
+    for section in sections:
+        section_text = ''.join(section).strip('\n')
+        if not section_text:
+            continue
+        (user_sections if '{{' in section_text else system_sections).append(section_text)
+    return PromptTemplate(text, '\n\n'.join(system_sections), '\n\n'.join(user_sections))
             
+def escape_xml_text(text: str) -> str:
+    """Escape element text the same way ElementTree serializes it"""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def escape_xml_attrib(text: str) -> str:
+    """Escape an attribute value the same way ElementTree serializes it"""
+    return (text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                .replace('"', '&quot;').replace('\r', '&#13;').replace('\n', '&#10;')
+                .replace('\t', '&#09;'))
+
+
+def xml_start_tag(tag: str, attributes: Dict[str, str], empty: bool) -> str:
+    """Serialize a start tag (or an empty element) the same way ElementTree does"""
+    attrs = ''.join(f' {key}="{escape_xml_attrib(value)}"' for key, value in attributes.items())
+    return f"<{tag}{attrs} />" if empty else f"<{tag}{attrs}>"
+
+
 def indent_xml_filetree(tree: ET.ElementTree, element: ET.Element, level: int = 0) -> None:
     # Apply indentation for pretty printing
     try:
@@ -0,0 +1,194 @@
+import os
+import time
+import sqlite3
+from contextlib import contextmanager
+from typing import Optional, List, Dict, NamedTuple, Iterator
+
+WORK_QUEUE_FILENAME = 'work_queue.sqlite'
+
+# States of a job: blocked directories wait for their children, pending jobs can be
+# claimed, leased jobs are held by a worker until done or their lease expires, and
+# failed jobs gave up after their last attempt
+BLOCKED = 'blocked'
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueJob(NamedTuple):
+    """
+    A file or directory summary to make. Jobs are claimed in priority order (lowest
+    first); a job with children only becomes pending once they are all done.
+    """
+    kind: str
+    path: str
+    parent: Optional[str]
+    priority: int
+
+
+class WorkQueue:
+    """
+    Summary jobs of one run, shared by any number of worker processes through a SQLite
+    file in the output directory.
+
+    A worker claims a job by taking a lease on it, keeps the lease alive with
+    heartbeats while it works, and marks the job done at the end, or failed if it
+    could not make the summary. Failed jobs are handed out again until they have been
+    attempted max_attempts times. Leases that are not renewed in time (the worker
+    crashed or hung) expire, and the job is handed to the next worker that asks for
+    one. Each claim runs in an immediate transaction, so no two workers hold the same job.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        queue_dir = os.path.dirname(path)
+        if queue_dir:
+            os.makedirs(queue_dir, exist_ok=True)
+        # Transactions are managed explicitly, so claims can lock the database up front
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA busy_timeout=30000')
+        with self.transaction():
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                              'kind TEXT NOT NULL, path TEXT NOT NULL, parent TEXT, priority INTEGER NOT NULL, '
+                              'state TEXT NOT NULL, remaining INTEGER NOT NULL DEFAULT 0, worker TEXT, '
+                              'lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, '
+                              'PRIMARY KEY (kind, path))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, priority)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.reclaimed = 0
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run statements in one transaction that holds the write lock from the start"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def seeded_at(self) -> Optional[str]:
+        """When the current run was seeded, which identifies it; None if the queue was never seeded"""
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'seeded_at'").fetchone()
+        return None if row is None else row[0]
+
+    def is_seeded(self) -> bool:
+        return self.seeded_at() is not None
+
+    def has_unfinished_jobs(self) -> bool:
+        return self.conn.execute('SELECT 1 FROM jobs WHERE state NOT IN (?, ?) LIMIT 1',
+                                 (DONE, FAILED)).fetchone() is not None
+
+    def is_finished(self) -> bool:
+        """Whether the queue was seeded and every job in it is done or has failed for good"""
+        return self.is_seeded() and not self.has_unfinished_jobs()
+
+    def seed(self, jobs: List[QueueJob]) -> bool:
+        """
+        Fill the queue with the jobs of a new run. If a run is already in progress (the
+        queue holds unfinished jobs), it is left as is so a restarted coordinator joins
+        it. Returns whether the queue was filled.
+        """
+        with self.transaction():
+            if self.is_seeded() and self.has_unfinished_jobs():
+                return False
+            self.conn.execute('DELETE FROM jobs')
+            self.conn.executemany('INSERT INTO jobs (kind, path, parent, priority, state) VALUES (?, ?, ?, ?, ?)',
+                                  [(job.kind, job.path, job.parent, job.priority, PENDING) for job in jobs])
+            # Jobs with children wait for them
+            remaining: Dict[str, int] = {}
+            for job in jobs:
+                if job.parent is not None:
+                    remaining[job.parent] = remaining.get(job.parent, 0) + 1
+            parents = {job.path: job.kind for job in jobs if job.path in remaining}
+            self.conn.executemany('UPDATE jobs SET state = ?, remaining = ? WHERE kind = ? AND path = ?',
+                                  [(BLOCKED, remaining[path], kind, path) for path, kind in parents.items()])
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('seeded_at', ?)", (str(time.time()),))
+        return True
+
+    def claim(self, worker: str, lease_seconds: float) -> Optional[QueueJob]:
+        """Lease the next pending job to worker, first reclaiming expired leases. Returns None if none is pending."""
+        now = time.time()
+        with self.transaction():
+            self.reclaimed += self.conn.execute(
+                'UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL '
+                'WHERE state = ? AND lease_expires < ?', (PENDING, LEASED, now)).rowcount
+            # A pending job with a lease expiry was handed back after failing, and waits until then
+            row = self.conn.execute('SELECT kind, path, parent, priority FROM jobs WHERE state = ? '
+                                    'AND (lease_expires IS NULL OR lease_expires <= ?) '
+                                    'ORDER BY priority, rowid LIMIT 1', (PENDING, now)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 '
+                              'WHERE kind = ? AND path = ?', (LEASED, worker, now + lease_seconds, row[0], row[1]))
+        return QueueJob(*row)
+
+    def heartbeat(self, worker: str, lease_seconds: float) -> int:
+        """Extend the leases of every job held by worker. Returns the number of leases extended."""
+        with self.transaction():
+            return self.conn.execute('UPDATE jobs SET lease_expires = ? WHERE state = ? AND worker = ?',
+                                     (time.time() + lease_seconds, LEASED, worker)).rowcount
+
+    def _finish(self, job: QueueJob, state: str) -> bool:
+        """
+        Move a job to a final state, keeping the worker that last held it, and unblock
+        its parent if this was its last unfinished child. Returns False if the job was already finished (after its lease
+        expired and another worker redid it), in which case nothing changes.
+        """
+        updated = self.conn.execute('UPDATE jobs SET state = ?, lease_expires = NULL '
+                                    'WHERE kind = ? AND path = ? AND state NOT IN (?, ?)',
+                                    (state, job.kind, job.path, DONE, FAILED)).rowcount
+        if updated and job.parent is not None:
+            self.conn.execute('UPDATE jobs SET remaining = remaining - 1, '
+                              'state = CASE WHEN remaining = 1 THEN ? ELSE state END '
+                              'WHERE path = ? AND state = ?', (PENDING, job.parent, BLOCKED))
+        return bool(updated)
+
+    def complete(self, job: QueueJob) -> None:
+        """Mark a job done. Completing a job twice has no further effect."""
+        with self.transaction():
+            self._finish(job, DONE)
+
+    def fail(self, job: QueueJob, worker: str, max_attempts: int, retry_delay: float = 0.0,
+             max_retry_delay: float = float('inf')) -> Optional[str]:
+        """
+        Hand back a job that worker could not do, to be claimed again after retry_delay
+        seconds (doubling with each attempt, up to max_retry_delay), or mark it failed
+        once it has been attempted max_attempts times. A failed job unblocks its parent
+        like a done one, so the directory is summarized without it. Returns the job's
+        new state: PENDING if it will be attempted again, FAILED if it was given up on,
+        or None if worker no longer held its lease (nothing changes).
+        """
+        with self.transaction():
+            row = self.conn.execute('SELECT attempts FROM jobs WHERE kind = ? AND path = ? AND state = ? '
+                                    'AND worker = ?', (job.kind, job.path, LEASED, worker)).fetchone()
+            if row is None:
+                return None  # The lease expired and the job was handed to another worker
+            if row[0] >= max_attempts:
+                self._finish(job, FAILED)
+                return FAILED
+            delay = min(max_retry_delay, retry_delay * 2 ** (row[0] - 1))
+            self.conn.execute('UPDATE jobs SET state = ?, worker = NULL, lease_expires = ? '
+                              'WHERE kind = ? AND path = ?', (PENDING, time.time() + delay, job.kind, job.path))
+            return PENDING
+
+    def release(self, worker: str) -> int:
+        """Hand back the jobs still leased to worker (e.g. when it is interrupted). Returns how many."""
+        with self.transaction():
+            return self.conn.execute('UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL '
+                                     'WHERE state = ? AND worker = ?', (PENDING, LEASED, worker)).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs in each state"""
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def failed(self) -> List[QueueJob]:
+        """The jobs that failed for good"""
+        return [QueueJob(*row) for row in self.conn.execute(
+            'SELECT kind, path, parent, priority FROM jobs WHERE state = ? ORDER BY rowid', (FAILED,))]
+
+    def close(self) -> None:
+        self.conn.close()